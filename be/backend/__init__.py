@@ -3,13 +3,31 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from passlib.context import CryptContext
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.redis import RedisBackend
 from redis import asyncio as aioredis
 from contextlib import asynccontextmanager
 
 from .config import settings
-from .database import ensure_indexes, seed_database_if_empty
+from .database import (
+    connect_to_mongo,
+    close_mongo_connection,
+    connect_to_mongo_sync,
+    close_mongo_connection_sync,
+    ensure_indexes,
+    seed_database_if_empty,
+)
+from .services.session_cache import session_cache, session_activity_buffer
+from .services.log_sink import log_sink
+from .services.motion_rollups import motion_rollups
+from .services.heatmap import heatmap_accumulator
+from .services.product_cache import product_cache
+from .services.product_search import product_search
+from .services.navigation import navigator
+from .services.map_tiles import map_tiles
+from .services.order_commits import order_commit_batcher
+from .services.vietqr import vietqr_client
 
 # --- Lifespan Manager ---
 @asynccontextmanager
@@ -17,19 +35,44 @@ async def lifespan(app: FastAPI):
     """
     Handles startup and shutdown events.
     - Initializes Redis cache on startup.
+    - Opens the shared MongoDB connection pool on startup.
     - Seeds the database on startup.
-    - Closes Redis connection on shutdown.
+    - Starts the session activity, motion rollup, heatmap and order batch flush loops and the product search, navigation and map tile refreshes.
+    - Hands pending order batches to Celery, drains buffered log writes and closes the VietQR API, Redis and MongoDB connections on shutdown.
     """
     # Startup
     redis = aioredis.from_url(settings.REDIS_URI, encoding="utf8", decode_responses=False)
     FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
     print("FastAPI-Cache initialized.")
-    ensure_indexes()
-    seed_database_if_empty()  # Now safe - only seeds if collections are empty
+    if settings.SESSION_CACHE_USE_REDIS:
+        session_cache.attach_redis(redis)
+    product_cache.attach_redis(redis)
+    await connect_to_mongo()
+    print("MongoDB connection pool initialized.")
+    await ensure_indexes()
+    await seed_database_if_empty()  # Now safe - only seeds if collections are empty
+    session_activity_buffer.start()
+    motion_rollups.start()
+    heatmap_accumulator.start()
+    product_search.start()
+    navigator.start()
+    map_tiles.start()
+    order_commit_batcher.start()
     yield
     # Shutdown
+    await order_commit_batcher.stop()
+    await session_activity_buffer.stop()
+    await log_sink.stop()
+    await motion_rollups.stop()
+    await heatmap_accumulator.stop()
+    await product_search.stop()
+    await navigator.stop()
+    await map_tiles.stop()
+    await vietqr_client.close()
     await redis.close()
     print("Redis connection closed.")
+    await close_mongo_connection()
+    print("MongoDB connection closed.")
 
 # --- App Initialization ---
 app = FastAPI(title="Shopping Cart API", lifespan=lifespan)
@@ -54,6 +97,19 @@ celery_app = Celery(
 )
 celery_app.conf.update(task_track_started=True)
 
+@worker_process_init.connect
+def open_worker_connections(**kwargs):
+    """Opens the worker process's pooled MongoDB client once, after the fork, for all its tasks."""
+    connect_to_mongo_sync()
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def close_worker_connections(**kwargs):
+    """Closes the worker's MongoDB and Redis clients (solo and thread pools only send worker_shutdown)."""
+    from .orders.tasks import close_redis_client
+    close_mongo_connection_sync()
+    close_redis_client()
+
 # --- API Routers ---
 from .products.routes import router as products_router
 from .users.routes import router as users_router
@@ -87,8 +87,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> TokenData:
                     detail="Session expired or invalid",
                     headers={"WWW-Authenticate": "Bearer"},
                 )
-            # Update session activity
-            await SessionService.update_session_activity(session_id)
+            # Record session activity (coalesced, written in bulk)
+            SessionService.record_session_activity(session_id)
             
         token_data = TokenData(identity=identity, role=role, session_id=session_id)
     except JWTError:
@@ -1,11 +1,15 @@
 # cart/routes.py
 
 from fastapi import APIRouter, HTTPException, Depends
-from typing import List
+from typing import List, Optional
 from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.asynchronous.collection import AsyncCollection
 from ..models import Product, CartOpRequest, CartOpResponse, CartLogEntry
 from ..auth import get_current_user, TokenData
-from ..database import get_carts_collection, get_products_collection, get_cart_logs_collection
+from ..database import get_carts_collection, get_products_collection
+from ..services.log_sink import log_sink
+from ..services.product_cache import product_cache
 
 router = APIRouter(
     prefix="/api/cart",
@@ -15,18 +19,16 @@ router = APIRouter(
 
 @router.get("/op", response_model=List[Product])
 async def get_cart(
-    user: TokenData = Depends(get_current_user)
+    user: TokenData = Depends(get_current_user),
+    carts_collection: AsyncCollection = Depends(get_carts_collection),
 ):
     """
     Get current cart contents for the authenticated user.
     Returns a list of products with quantities.
     """
     try:
-        # Get MongoDB collections
-        carts_collection = get_carts_collection()
-        
         # Get current cart
-        user_cart = await carts_collection.find_one({"user_identity": user.identity})
+        user_cart = await carts_collection.find_one({"user_identity": user.identity}, {"items": 1})
         if not user_cart:
             return []
         
@@ -52,27 +54,100 @@ async def get_cart(
         raise HTTPException(status_code=500, detail=f"Failed to get cart: {str(e)}")
 
 
+def _cart_total(items_expression) -> dict:
+    """Pipeline expression for the stored total_items, summing the items of carts saved before it existed."""
+    return {"$ifNull": ["$total_items", {"$sum": items_expression}]}
+
+
+def _total_items(cart: Optional[dict]) -> int:
+    if not cart:
+        return 0
+    if "total_items" in cart:
+        return cart["total_items"]
+    return sum(item.get("quantity", 0) for item in cart.get("items", []))
+
+
+async def add_to_cart(carts_collection: AsyncCollection, user_identity: str, product: dict, quantity: int) -> dict:
+    """
+    Adds `quantity` of a product in one atomic update: the line's quantity is
+    increased, or a new line is appended (the cart is created if needed), and
+    total_items moves with it. Returns the cart's total_items afterwards.
+    """
+    barcode = {"$literal": product["barcode"]}
+    new_item = {"$literal": {
+        "barcode": product["barcode"],
+        "name": product.get("name"),
+        "price": product.get("price"),
+        "quantity": quantity,
+    }}
+    items = {"$ifNull": ["$items", []]}
+    return await carts_collection.find_one_and_update(
+        {"user_identity": user_identity},
+        [{"$set": {
+            "items": {"$cond": [
+                {"$in": [barcode, {"$map": {"input": items, "as": "item", "in": "$$item.barcode"}}]},
+                {"$map": {"input": items, "as": "item", "in": {"$cond": [
+                    {"$eq": ["$$item.barcode", barcode]},
+                    {"$mergeObjects": ["$$item", {"quantity": {"$add": ["$$item.quantity", quantity]}}]},
+                    "$$item",
+                ]}}},
+                {"$concatArrays": [items, [new_item]]},
+            ]},
+            "total_items": {"$add": [_cart_total("$items.quantity"), quantity]},
+            "updated_at": "$$NOW",
+        }}],
+        projection={"total_items": 1, "_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def remove_from_cart(carts_collection: AsyncCollection, user_identity: str, barcode: str, quantity: int) -> Optional[dict]:
+    """
+    Removes `quantity` of a product in one atomic update, dropping the line
+    when it reaches zero. Only matches while the cart holds at least that
+    many, so concurrent removals cannot go negative. Returns the cart's
+    total_items afterwards, or None if the cart does not hold enough.
+    """
+    literal = {"$literal": barcode}
+    return await carts_collection.find_one_and_update(
+        {"user_identity": user_identity, "items": {"$elemMatch": {"barcode": barcode, "quantity": {"$gte": quantity}}}},
+        [{"$set": {
+            "items": {"$filter": {
+                "input": {"$map": {"input": "$items", "as": "item", "in": {"$cond": [
+                    {"$eq": ["$$item.barcode", literal]},
+                    {"$mergeObjects": ["$$item", {"quantity": {"$subtract": ["$$item.quantity", quantity]}}]},
+                    "$$item",
+                ]}}},
+                "as": "item",
+                "cond": {"$gt": ["$$item.quantity", 0]},
+            }},
+            "total_items": {"$subtract": [_cart_total("$items.quantity"), quantity]},
+            "updated_at": "$$NOW",
+        }}],
+        projection={"total_items": 1, "_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
 @router.post("/op", response_model=CartOpResponse)
 async def cart_operation(
     request: CartOpRequest,
-    user: TokenData = Depends(get_current_user)
+    user: TokenData = Depends(get_current_user),
+    products_collection: AsyncCollection = Depends(get_products_collection),
+    carts_collection: AsyncCollection = Depends(get_carts_collection),
 ):
     """
-    Execute cart operation (add/remove items) with transactional safety.
+    Execute cart operation (add/remove items) atomically.
     
     This endpoint handles cart modifications with:
     - Product existence validation
     - Stock availability checks
-    - Atomic cart operations
+    - A single atomic update per operation, so concurrent scans of the same item are never lost
     """
     try:
-        # Get MongoDB collections
-        products_collection = get_products_collection()
-        carts_collection = get_carts_collection()
-        cart_logs_collection = get_cart_logs_collection()
-        
-        # 1. Validate product exists
-        product = await products_collection.find_one({"barcode": request.barcode})
+        # 1. Validate product exists (served from the product cache during scan bursts)
+        product = await product_cache.get_by_barcode(request.barcode, products_collection)
         if not product:
             return CartOpResponse(
                 success=False,
@@ -80,77 +155,38 @@ async def cart_operation(
                 cart_total_items=0
             )
         
-        # 2. Get current cart
-        user_cart = await carts_collection.find_one({"user_identity": user.identity})
-        if not user_cart:
-            user_cart = {"user_identity": user.identity, "items": []}
-        
-        # Find item in cart
-        cart_item = None
-        for item in user_cart.get("items", []):
-            if item.get("barcode") == request.barcode:
-                cart_item = item
-                break
-        
-        # 3. Validate operation based on action
+        # 2. Apply the operation; only failures read the cart back
         if request.action == "add":
             # Check stock availability
             if product.get("quantity", 0) < request.quantity:
+                user_cart = await carts_collection.find_one({"user_identity": user.identity}, {"items": 1, "total_items": 1})
                 return CartOpResponse(
                     success=False,
                     message=f"Insufficient stock. Available: {product.get('quantity', 0)}, Requested: {request.quantity}",
-                    cart_total_items=sum(item.get("quantity", 0) for item in user_cart.get("items", []))
+                    cart_total_items=_total_items(user_cart)
                 )
+            updated_cart = await add_to_cart(carts_collection, user.identity, product, request.quantity)
         elif request.action == "remove":
-            # Check if enough items in cart
-            current_cart_quantity = cart_item.get("quantity", 0) if cart_item else 0
-            if current_cart_quantity < request.quantity:
+            updated_cart = await remove_from_cart(carts_collection, user.identity, request.barcode, request.quantity)
+            if updated_cart is None:
+                user_cart = await carts_collection.find_one({"user_identity": user.identity}, {"items": 1, "total_items": 1})
+                current_cart_quantity = sum(
+                    item.get("quantity", 0) for item in (user_cart or {}).get("items", []) if item.get("barcode") == request.barcode
+                )
                 return CartOpResponse(
                     success=False,
                     message=f"Not enough items in cart. Available: {current_cart_quantity}, Requested: {request.quantity}",
-                    cart_total_items=sum(item.get("quantity", 0) for item in user_cart.get("items", []))
-                )
-        
-        # 4. Execute operation atomically
-        if request.action == "add":
-            if cart_item:
-                # Update existing item
-                await carts_collection.update_one(
-                    {"user_identity": user.identity, "items.barcode": request.barcode},
-                    {"$inc": {"items.$.quantity": request.quantity}}
+                    cart_total_items=_total_items(user_cart)
                 )
-            else:
-                # Add new item
-                new_item = {
-                    "barcode": request.barcode,
-                    "name": product.get("name"),
-                    "price": product.get("price"),
-                    "quantity": request.quantity
-                }
-                await carts_collection.update_one(
-                    {"user_identity": user.identity},
-                    {"$push": {"items": new_item}},
-                    upsert=True
-                )
-        elif request.action == "remove":
-            if cart_item.get("quantity", 0) == request.quantity:
-                # Remove item completely
-                await carts_collection.update_one(
-                    {"user_identity": user.identity},
-                    {"$pull": {"items": {"barcode": request.barcode}}}
-                )
-            else:
-                # Decrease quantity
-                await carts_collection.update_one(
-                    {"user_identity": user.identity, "items.barcode": request.barcode},
-                    {"$inc": {"items.$.quantity": -request.quantity}}
-                )
-        
-        # 5. Get updated cart for response
-        updated_cart = await carts_collection.find_one({"user_identity": user.identity})
-        total_items = sum(item.get("quantity", 0) for item in updated_cart.get("items", []))
+        else:
+            return CartOpResponse(
+                success=False,
+                message=f"Unknown action: {request.action}",
+                cart_total_items=0
+            )
+        total_items = updated_cart["total_items"]
         
-        # 6. Log the cart operation
+        # 3. Log the cart operation (buffered, off the request's critical path)
         try:
             cart_log_entry = CartLogEntry(
                 user_identity=user.identity,
@@ -162,7 +198,8 @@ async def cart_operation(
                 timestamp=datetime.utcnow(),
                 session_id=user.session_id or request.session_id
             )
-            await cart_logs_collection.insert_one(cart_log_entry.model_dump())
+            if not await log_sink.emit("cart_logs", cart_log_entry.model_dump()):
+                print("Cart log dropped: log sink queue is full")
         except Exception as log_error:
             # Log the error but don't fail the cart operation
             print(f"Failed to log cart operation: {log_error}")
@@ -1,64 +1,276 @@
 # backend/database.py
-from pymongo import MongoClient, ASCENDING, collection
+from pymongo import AsyncMongoClient, MongoClient, ASCENDING, UpdateOne
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.database import AsyncDatabase
+from typing import Optional
+import hashlib
+import unicodedata
 from .config import settings
 import random
 import os
 import json
 import logging
 # --- Database Connection ---
-# This setup creates a single client that can be shared across the application.
-# PyMongo's client is thread-safe and includes connection pooling.
+# A single pooled async client is created in the application lifespan and shared
+# by every router. Pool size and timeouts come from Settings.
 
-client = MongoClient(settings.MONGO_URI)
-db = client["shopping_cart_db"]
+_client: Optional[AsyncMongoClient] = None
+
+def _client_options() -> dict:
+    return dict(
+        maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+        minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=settings.MONGO_MAX_IDLE_TIME_MS,
+        connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    )
+
+def create_client() -> AsyncMongoClient:
+    """Builds an AsyncMongoClient configured from Settings."""
+    return AsyncMongoClient(settings.MONGO_URI, **_client_options())
+
+async def connect_to_mongo() -> AsyncMongoClient:
+    """Creates the shared client. Called once from the lifespan hook."""
+    global _client
+    if _client is None:
+        _client = create_client()
+        await _client.aconnect()
+    return _client
+
+async def close_mongo_connection():
+    """Closes the shared client and its connection pool."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+# Celery workers are synchronous: each worker process gets one pooled MongoClient,
+# opened after the fork (clients are not fork-safe) and shared by all its tasks.
+_sync_client: Optional[MongoClient] = None
+
+def connect_to_mongo_sync() -> MongoClient:
+    """Creates the worker process's shared client. Called from the Celery worker_process_init signal."""
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = MongoClient(settings.MONGO_URI, **_client_options())
+    return _sync_client
+
+def close_mongo_connection_sync():
+    """Closes the worker process's shared client."""
+    global _sync_client
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
+
+def get_sync_db() -> Database:
+    """The database on the worker's shared client; the client is created on first use (e.g. solo pools)."""
+    return connect_to_mongo_sync()[settings.MONGO_DB_NAME]
+
+def get_db() -> AsyncDatabase:
+    if _client is None:
+        raise RuntimeError("MongoDB client is not initialized. It is created in the application lifespan.")
+    return _client[settings.MONGO_DB_NAME]
 
 # --- Collection Getters (for Dependency Injection) ---
-def get_products_collection() -> collection.Collection:
-    return db["products"]
+async def get_collection(name: str) -> AsyncCollection:
+    """Default collection resolver of the background writers (log sink, rollup flushes)."""
+    return get_db()[name]
+
+async def get_products_collection() -> AsyncCollection:
+    return get_db()["products"]
+
+async def get_users_collection() -> AsyncCollection:
+    return get_db()["users"]
+
+async def get_orders_collection() -> AsyncCollection:
+    return get_db()["order_history"]
+
+async def get_map_collection() -> AsyncCollection:
+    return get_db()["map"]
 
-def get_users_collection() -> collection.Collection:
-    return db["users"]
+async def get_carts_collection() -> AsyncCollection:
+    return get_db()['carts']
 
-def get_orders_collection() -> collection.Collection:
-    return db["order_history"]
+async def get_cart_logs_collection() -> AsyncCollection:
+    return get_db()["cart_logs"]
 
-def get_map_collection() -> collection.Collection:
-    return db["map"]
+async def get_purchase_logs_collection() -> AsyncCollection:
+    return get_db()["purchase_logs"]
 
-def get_carts_collection()-> collection.Collection:
-    return db['carts']
+async def get_motion_logs_collection() -> AsyncCollection:
+    return get_db()["motion_logs"]
 
-def get_cart_logs_collection() -> collection.Collection:
-    return db["cart_logs"]
+async def get_motion_events_collection() -> AsyncCollection:
+    return get_db()["motion_events"]
 
-def get_purchase_logs_collection() -> collection.Collection:
-    return db["purchase_logs"]
+async def get_uwb_locations_collection() -> AsyncCollection:
+    return get_db()["uwb_locations"]
 
-def get_motion_logs_collection() -> collection.Collection:
-    return db["motion_logs"]
+async def get_sessions_collection() -> AsyncCollection:
+    return get_db()["sessions"]
 
-def get_motion_events_collection() -> collection.Collection:
-    return db["motion_events"]
+async def get_motion_rollups_collection() -> AsyncCollection:
+    return get_db()["motion_rollups"]
 
-def get_uwb_locations_collection() -> collection.Collection:
-    return db["uwb_locations"]
+async def get_motion_rollup_watermarks_collection() -> AsyncCollection:
+    return get_db()["motion_rollup_watermarks"]
 
-def get_sessions_collection() -> collection.Collection:
-    return db["sessions"]
+async def get_uwb_heatmap_collection() -> AsyncCollection:
+    return get_db()["uwb_heatmap"]
+
+async def get_counters_collection() -> AsyncCollection:
+    return get_db()["counters"]
+
+async def get_catalog_changes_collection() -> AsyncCollection:
+    return get_db()["catalog_changes"]
+
+# --- Time-Series Telemetry ---
+# motion_logs and uwb_locations are stored as native time-series collections.
+# cart_id and session_id live under the "meta" field so MongoDB buckets samples
+# per cart/session; the helpers below convert documents and filters so routes
+# keep working with the flat API shape.
+TIMESERIES_COLLECTIONS = ("motion_logs", "uwb_locations")
+TIMESERIES_META_FIELDS = ("cart_id", "session_id")
+
+def timeseries_options() -> dict:
+    """Returns the create_collection options for the telemetry time-series collections."""
+    options = {
+        "timeseries": {
+            "timeField": "timestamp",
+            "metaField": "meta",
+            "granularity": settings.MOTION_TIMESERIES_GRANULARITY,
+        }
+    }
+    if settings.MOTION_TIMESERIES_EXPIRE_AFTER_SECONDS:
+        options["expireAfterSeconds"] = settings.MOTION_TIMESERIES_EXPIRE_AFTER_SECONDS
+    return options
+
+def to_timeseries_document(doc: dict) -> dict:
+    """Moves the metadata fields of a flat telemetry document under 'meta'."""
+    doc = dict(doc)
+    doc["meta"] = {field: doc.pop(field, None) for field in TIMESERIES_META_FIELDS}
+    return doc
+
+def from_timeseries_document(doc: dict) -> dict:
+    """Flattens 'meta' back into a telemetry document for API responses."""
+    meta = doc.pop("meta", None) or {}
+    for field in TIMESERIES_META_FIELDS:
+        doc.setdefault(field, meta.get(field))
+    return doc
+
+def timeseries_filter(filter_query: dict) -> dict:
+    """Rewrites a flat telemetry filter so metadata fields target 'meta'."""
+    return {
+        (f"meta.{key}" if key in TIMESERIES_META_FIELDS else key): value
+        for key, value in filter_query.items()
+    }
+
+async def ensure_timeseries_collections():
+    """
+    Creates the telemetry time-series collections if they don't exist yet.
+    Existing plain collections are left untouched; convert them with
+    `python -m backend.scripts.migrate_timeseries`.
+    """
+    db = get_db()
+    existing = {
+        info["name"]: info.get("type")
+        async for info in await db.list_collections(filter={"name": {"$in": list(TIMESERIES_COLLECTIONS)}})
+    }
+    for name in TIMESERIES_COLLECTIONS:
+        if name not in existing:
+            await db.create_collection(name, **timeseries_options())
+            print(f"Created time-series collection '{name}'.")
+        elif existing[name] != "timeseries":
+            print(f"WARNING: '{name}' is a plain collection. Run `python -m backend.scripts.migrate_timeseries` to convert it.")
 
 # --- Database Helpers ---
-def ensure_indexes():
+def product_name_key(name: str) -> str:
+    """Case-insensitive lookup key of a product name (NFC, casefolded, single spaces)."""
+    return " ".join(unicodedata.normalize("NFC", name).casefold().split())
+
+async def backfill_product_name_keys(products_collection: AsyncCollection) -> int:
+    """Sets name_key on products stored before it existed."""
+    missing = await products_collection.find(
+        {"name_key": {"$exists": False}, "name": {"$type": "string"}}, {"_id": 1, "name": 1}
+    ).to_list()
+    if not missing:
+        return 0
+    await products_collection.bulk_write(
+        [UpdateOne({"_id": doc["_id"]}, {"$set": {"name_key": product_name_key(doc["name"])}}) for doc in missing],
+        ordered=False
+    )
+    return len(missing)
+
+async def ensure_indexes():
     """Creates unique indexes for collections if they don't exist."""
-    get_products_collection().create_index([("id", ASCENDING)], unique=True)
-    get_users_collection().create_index([("email", ASCENDING)], unique=True)
-    get_sessions_collection().create_index([("session_id", ASCENDING)], unique=True)
-    get_sessions_collection().create_index([("user_identity", ASCENDING)])
-    get_sessions_collection().create_index([("created_at", ASCENDING)], expireAfterSeconds=86400*7)  # Sessions expire after 7 days
+    products_collection = await get_products_collection()
+    users_collection = await get_users_collection()
+    orders_collection = await get_orders_collection()
+    sessions_collection = await get_sessions_collection()
+    motion_logs_collection = await get_motion_logs_collection()
+    uwb_locations_collection = await get_uwb_locations_collection()
+    motion_rollups_collection = await get_motion_rollups_collection()
+    motion_rollup_watermarks_collection = await get_motion_rollup_watermarks_collection()
+    uwb_heatmap_collection = await get_uwb_heatmap_collection()
+    catalog_changes_collection = await get_catalog_changes_collection()
+    carts_collection = await get_carts_collection()
+
+    await products_collection.create_index([("id", ASCENDING)], unique=True)
+    # Barcode scans look products up by barcode; products without one (null) are left out
+    try:
+        await products_collection.create_index(
+            [("barcode", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"barcode": {"$type": "string"}},
+            name="barcode_unique"
+        )
+    except OperationFailure as e:
+        print(f"WARNING: Could not create unique barcode index (duplicate barcodes?): {e}")
+    # Location lookups match the normalized name exactly
+    backfilled = await backfill_product_name_keys(products_collection)
+    if backfilled:
+        print(f"Added name_key to {backfilled} products.")
+    await products_collection.create_index([("name_key", ASCENDING)])
+    # Delta sync returns products changed after a catalog version
+    await products_collection.create_index([("catalog_version", ASCENDING)])
+    # Sub-counters of products whose stock is sharded (services/stock_shards.py)
+    await get_db()["stock_shards"].create_index([("product_id", ASCENDING), ("shard", ASCENDING)], unique=True)
+    await catalog_changes_collection.create_index([("version", ASCENDING)], unique=True)
+    await catalog_changes_collection.create_index(
+        [("timestamp", ASCENDING)], expireAfterSeconds=86400*settings.CATALOG_JOURNAL_RETENTION_DAYS
+    )
+    await users_collection.create_index([("email", ASCENDING)], unique=True)
+    # One cart per user: cart operations upsert by user_identity
+    try:
+        await carts_collection.create_index([("user_identity", ASCENDING)], unique=True)
+    except OperationFailure as e:
+        print(f"WARNING: Could not create unique cart index (duplicate carts?): {e}")
+        await carts_collection.create_index([("user_identity", ASCENDING)], name="user_identity_lookup")
+    # The order commit batcher sweeps for paid orders that were never completed
+    await orders_collection.create_index([("status", ASCENDING), ("paid_at", ASCENDING)])
+    await sessions_collection.create_index([("session_id", ASCENDING)], unique=True)
+    await sessions_collection.create_index([("user_identity", ASCENDING)])
+    await sessions_collection.create_index([("created_at", ASCENDING)], expireAfterSeconds=86400*7)  # Sessions expire after 7 days
+    
+    # Telemetry indexes: every query combines a time range with a cart or session filter
+    await ensure_timeseries_collections()
+    for telemetry_collection in (motion_logs_collection, uwb_locations_collection):
+        await telemetry_collection.create_index([("meta.cart_id", ASCENDING), ("timestamp", ASCENDING)])
+        await telemetry_collection.create_index([("meta.session_id", ASCENDING), ("timestamp", ASCENDING)])
     
-    # UWB location indexes for efficient querying
-    get_uwb_locations_collection().create_index([("timestamp", ASCENDING)])
-    get_uwb_locations_collection().create_index([("cart_id", ASCENDING)])
-    get_uwb_locations_collection().create_index([("session_id", ASCENDING)])
+    # One rollup document per granularity, source, cart, key and bucket
+    await motion_rollups_collection.create_index(
+        [("source", ASCENDING), ("granularity", ASCENDING), ("bucket", ASCENDING), ("cart_id", ASCENDING), ("key", ASCENDING)],
+        unique=True
+    )
+    # /stats reads the oldest live flush watermark per source
+    await motion_rollup_watermarks_collection.create_index([("source", ASCENDING), ("flushed_through", ASCENDING)])
+    # One occupancy grid document per cell size and hour
+    await uwb_heatmap_collection.create_index([("cell_size", ASCENDING), ("bucket", ASCENDING)], unique=True)
     
     print("Database indexes ensured.")
 
@@ -132,7 +344,7 @@ def generate_uwb_location_data(n=50):
         
         # Generate mock anchor distances based on position
         distances = []
-        for anchor_x, anchor_y in [(1040, 150), (5881, 150), (3811, 1877), (1040, 3025)]:
+        for anchor_x, anchor_y in settings.UWB_ANCHORS:
             distance = int(math.sqrt((current_x - anchor_x)**2 + (current_y - anchor_y)**2))
             distance += random.randint(-10, 10)  # Add noise
             distances.append(max(100, min(8000, distance)))
@@ -151,26 +363,28 @@ def generate_uwb_location_data(n=50):
     
     return locations
 
-def seed_database_if_empty():
+async def seed_database_if_empty():
     """Seeds the products and map collections with initial data only if they are completely empty."""
     if getattr(settings, "APP_ENV", "development") != "development":
         print("Skipping database seeding: not in development environment.")
         return
     
-    products_collection = get_products_collection()
-    map_collection = get_map_collection()
-    uwb_locations_collection = get_uwb_locations_collection()
+    products_collection = await get_products_collection()
+    map_collection = await get_map_collection()
+    uwb_locations_collection = await get_uwb_locations_collection()
     
     # Always ensure text index exists
-    products_collection.create_index([("name", "text")])
+    await products_collection.create_index([("name", "text")])
 
     # Check if collections already have data - if so, don't reseed
-    if products_collection.count_documents({}) > 0:
-        print(f"Products collection already has {products_collection.count_documents({})} documents - skipping seed.")
+    products_count = await products_collection.count_documents({})
+    if products_count > 0:
+        print(f"Products collection already has {products_count} documents - skipping seed.")
         return
     
-    if map_collection.count_documents({}) > 0:
-        print(f"Map collection already has {map_collection.count_documents({})} documents - skipping seed.")
+    map_count = await map_collection.count_documents({})
+    if map_count > 0:
+        print(f"Map collection already has {map_count} documents - skipping seed.")
         return
 
     print("Collections are empty, proceeding with seeding...")
@@ -200,22 +414,29 @@ def seed_database_if_empty():
         loaded_products = generate_products(20)
     else:
         print(f"Loaded {len(loaded_products)} products from JSONL.")
+    for prod in loaded_products:
+        prod["name_key"] = product_name_key(prod["name"])
 
     print("Seeding database with products...")
-    products_collection.insert_many(loaded_products)
+    await products_collection.insert_many(loaded_products)
     print("Database seeded.")
 
     # Seed UWB location data only if empty
-    if uwb_locations_collection.count_documents({}) == 0:
+    if await uwb_locations_collection.count_documents({}) == 0:
         print("Seeding UWB location data...")
         uwb_data = generate_uwb_location_data(100)  # Generate 100 sample points
-        uwb_locations_collection.insert_many(uwb_data)
+        await uwb_locations_collection.insert_many([to_timeseries_document(doc) for doc in uwb_data])
         print(f"Seeded {len(uwb_data)} UWB location records.")
 
     # Seed default_map.png
     default_map_path = os.path.join(os.path.dirname(__file__), "default_map.png")
     with open(default_map_path, "rb") as f:
         image_bytes = f.read()
-    map_doc = {"name": "mall_map", "image": image_bytes, "content_type": "image/png"}
-    map_collection.insert_one(map_doc)
+    map_doc = {
+        "name": "mall_map",
+        "image": image_bytes,
+        "content_type": "image/png",
+        "sha256": hashlib.sha256(image_bytes).hexdigest(),
+    }
+    await map_collection.insert_one(map_doc)
     print("Seeded mall map image from default_map.png.")
\ No newline at end of file
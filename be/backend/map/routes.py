@@ -1,11 +1,31 @@
 # backend/map/routes.py
-from fastapi import APIRouter, Query, HTTPException, Depends
-from fastapi.responses import StreamingResponse
-from pymongo.collection import Collection
-from typing import List, Optional
+from fastapi import APIRouter, Query, HTTPException, Depends, Request, UploadFile, File
+from fastapi.responses import FileResponse, Response
+from pymongo import DESCENDING
+from pymongo.asynchronous.collection import AsyncCollection
+from typing import List, Literal, Optional
 from io import BytesIO
-from bson.binary import Binary
-from ..database import get_products_collection, get_map_collection
+from datetime import datetime, timedelta
+from PIL import Image
+from ..database import (
+    get_products_collection,
+    get_uwb_heatmap_collection,
+    get_uwb_locations_collection,
+    product_name_key,
+    timeseries_filter,
+)
+from ..models import Role, PickRouteRequest
+from ..config import settings
+from ..services import heatmap
+from ..services.product_search import product_search, LOCATION_FIELDS
+from ..services.spatial_index import GridIndex, location_points
+from ..services.navigation import navigator
+from ..services.product_cache import product_cache
+from ..services import pick_route
+from ..services import stock_shards
+from ..services.map_tiles import map_tiles, TILE_FORMATS
+from ..products.routes import etag_matches
+from .. import auth
 
 router = APIRouter(
     prefix="/api/map",
@@ -15,26 +35,43 @@ router = APIRouter(
 @router.get("/search", response_model=List[str])
 async def search_products(
     q: str = Query(..., min_length=1, description="Product search query"),
-    products_collection: Collection = Depends(get_products_collection),
+    limit: int = Query(20, ge=1, le=100, description="Maximum number of suggestions"),
+    products_collection: AsyncCollection = Depends(get_products_collection),
 ):
-    """Return product name suggestions based on text search."""
-    # MongoDB text search (ensure text index on 'name')
+    """
+    Return product name suggestions, best match first. Prefix, accent-insensitive
+    and typo-tolerant matching is served from the in-memory search index.
+    """
+    if product_search.ready:
+        return product_search.search(q, limit)
+    # Index not loaded yet: MongoDB text search (ensure text index on 'name')
     results = products_collection.find({"$text": {"$search": q}}, {"name": 1, "_id": 0})
-    names = [doc["name"] for doc in results]
+    names = [doc["name"] async for doc in results]
     if not names:
         # fallback: partial match
         results = products_collection.find({"name": {"$regex": q, "$options": "i"}}, {"name": 1, "_id": 0})
-        names = [doc["name"] for doc in results]
-    return names
+        names = [doc["name"] async for doc in results]
+    return names[:limit]
 
 @router.get("/location")
 async def get_product_location(
     name: str = Query(..., description="Product name"),
-    products_collection: Collection = Depends(get_products_collection),
+    products_collection: AsyncCollection = Depends(get_products_collection),
 ):
     """Return product location(s) and details. Case-insensitive name match."""
-    # Use case-insensitive exact match for name
-    product = products_collection.find_one({"name": {"$regex": f"^{name}$", "$options": "i"}}, {"location": 1, "name": 1, "subtitle": 1, "price": 1, "currency": 1, "quantity": 1, "unit": 1, "product_img_url": 1, "_id": 0})
+    if product_search.ready:
+        product = product_search.locate(name)
+    else:
+        # Index not loaded yet: exact match on the indexed normalized name
+        projection = {field: 1 for field in LOCATION_FIELDS}
+        projection["_id"] = 0
+        product = await products_collection.find_one(
+            {"name_key": product_name_key(name)}, {**projection, "id": 1, stock_shards.SHARD_COUNT_FIELD: 1}
+        )
+        if product:
+            await stock_shards.sum_into([product], products_collection)
+            product.pop("id")
+            product.pop(stock_shards.SHARD_COUNT_FIELD, None)
     if not product or "location" not in product:
         raise HTTPException(status_code=404, detail="Product or location not found")
     # Ensure location is always a list
@@ -43,11 +80,303 @@ async def get_product_location(
         product["location"] = [loc]
     return product
 
+async def _resolve_position(
+    x: Optional[float], y: Optional[float], cart_id: Optional[str], uwb_locations_collection: AsyncCollection
+):
+    """Returns (x, y, position document or None): the given point, or the cart's latest recent UWB fix."""
+    if cart_id is not None:
+        since = datetime.utcnow() - timedelta(seconds=settings.NEARBY_CART_POSITION_MAX_AGE_SECONDS)
+        position = await uwb_locations_collection.find_one(
+            timeseries_filter({"cart_id": cart_id, "timestamp": {"$gte": since}}),
+            {"x": 1, "y": 1, "timestamp": 1, "_id": 0},
+            sort=[("timestamp", DESCENDING)],
+        )
+        if not position:
+            raise HTTPException(status_code=404, detail="No recent position for this cart")
+        return position["x"], position["y"], position
+    if x is None or y is None:
+        raise HTTPException(status_code=400, detail="Provide x and y, or cart_id")
+    return x, y, None
+
+@router.get("/nearby")
+async def get_nearby_products(
+    x: Optional[float] = Query(None, description="Map x coordinate"),
+    y: Optional[float] = Query(None, description="Map y coordinate"),
+    cart_id: Optional[str] = Query(None, description="Use this cart's latest UWB position instead of x/y"),
+    radius: float = Query(300.0, gt=0, le=5000, description="Search radius in map units"),
+    limit: int = Query(20, ge=1, le=100, description="Maximum number of products"),
+    products_collection: AsyncCollection = Depends(get_products_collection),
+    uwb_locations_collection: AsyncCollection = Depends(get_uwb_locations_collection),
+):
+    """
+    Return products shelved within `radius` of a point, nearest first. With
+    cart_id the point is the cart's latest UWB position from the last
+    NEARBY_CART_POSITION_MAX_AGE_SECONDS.
+    """
+    x, y, position = await _resolve_position(x, y, cart_id, uwb_locations_collection)
+    try:
+        if product_search.ready:
+            products = product_search.nearby(x, y, radius, limit)
+        else:
+            # Index not loaded yet: grid the products inside the bounding box only
+            box = {"x": {"$gte": x - radius, "$lte": x + radius}, "y": {"$gte": y - radius, "$lte": y + radius}}
+            projection = {field: 1 for field in LOCATION_FIELDS}
+            projection.update({"id": 1, "_id": 0})
+            candidates = {
+                product["id"]: product
+                for product in await products_collection.find({"location": {"$elemMatch": box}}, projection).to_list()
+                if product.get("name")
+            }
+            shelves = GridIndex(settings.NEARBY_GRID_CELL_SIZE)
+            for product_id, product in candidates.items():
+                shelves.set(product_id, location_points(product.get("location")))
+            products = [
+                {
+                    "id": product_id,
+                    **{field: candidates[product_id][field] for field in LOCATION_FIELDS if field in candidates[product_id]},
+                    "distance": round(distance, 1),
+                    "nearest": {"x": px, "y": py},
+                }
+                for distance, product_id, (px, py) in shelves.query(x, y, radius, limit)
+            ]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to find nearby products: {str(e)}")
+    return {
+        "x": x,
+        "y": y,
+        "radius": radius,
+        "cart_id": cart_id,
+        "position_timestamp": position["timestamp"] if position else None,
+        "products": products,
+    }
+
+@router.get("/route")
+async def get_route(
+    product_id: Optional[int] = Query(None, description="Route to the nearest shelf of this product"),
+    to_x: Optional[float] = Query(None, description="Route to an arbitrary map x coordinate instead"),
+    to_y: Optional[float] = Query(None, description="Route to an arbitrary map y coordinate instead"),
+    x: Optional[float] = Query(None, description="Start x coordinate"),
+    y: Optional[float] = Query(None, description="Start y coordinate"),
+    cart_id: Optional[str] = Query(None, description="Start from this cart's latest UWB position instead of x/y"),
+    uwb_locations_collection: AsyncCollection = Depends(get_uwb_locations_collection),
+):
+    """
+    Return a walking route across the store map, as a polyline in map units.
+    Product routes follow precomputed distance fields; arbitrary targets, and
+    products whose fields are not computed yet, are routed with A*.
+    """
+    if product_id is None and (to_x is None or to_y is None):
+        raise HTTPException(status_code=400, detail="Provide product_id, or to_x and to_y")
+    if not navigator.ready:
+        raise HTTPException(status_code=503, detail="Navigation grid is not ready yet")
+    x, y, position = await _resolve_position(x, y, cart_id, uwb_locations_collection)
+
+    try:
+        if product_id is not None:
+            route = navigator.route_to_product(x, y, product_id)
+            if route is None and product_id not in navigator.targets:
+                shelves = product_search.shelves.points(product_id)
+                if not shelves:
+                    raise HTTPException(status_code=404, detail="Product or location not found")
+                shelf = min(shelves, key=lambda point: (point[0] - x) ** 2 + (point[1] - y) ** 2)
+                route = navigator.route_to_point(x, y, *shelf)
+        else:
+            route = navigator.route_to_point(x, y, to_x, to_y)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to compute route: {str(e)}")
+    if route is None:
+        raise HTTPException(status_code=404, detail="No walkable route to the target")
+    route.update({
+        "product_id": product_id,
+        "cart_id": cart_id,
+        "start": {"x": x, "y": y},
+        "position_timestamp": position["timestamp"] if position else None,
+    })
+    return route
+
+@router.post("/pick-route")
+async def get_pick_route(
+    request: PickRouteRequest,
+    products_collection: AsyncCollection = Depends(get_products_collection),
+    uwb_locations_collection: AsyncCollection = Depends(get_uwb_locations_collection),
+):
+    """
+    Order a shopping list into a short walk through the store. The cart screen
+    re-plans with the remaining items as they are scanned. Products whose
+    shelves cannot be reached (or have no location) are listed in
+    `unreachable`; unknown barcodes in `unknown_barcodes`.
+    """
+    if not request.product_ids and not request.barcodes:
+        raise HTTPException(status_code=400, detail="Provide product_ids or barcodes")
+    if len(request.product_ids) + len(request.barcodes) > settings.PICK_ROUTE_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {settings.PICK_ROUTE_MAX_ITEMS} items per route")
+    if (request.end_x is None) != (request.end_y is None):
+        raise HTTPException(status_code=400, detail="Provide both end_x and end_y, or neither")
+    if not navigator.ready:
+        raise HTTPException(status_code=503, detail="Navigation grid is not ready yet")
+    x, y, position = await _resolve_position(request.x, request.y, request.cart_id, uwb_locations_collection)
+
+    try:
+        product_ids = list(request.product_ids)
+        unknown_barcodes = []
+        for barcode in request.barcodes:
+            product = await product_cache.get_by_barcode(barcode, products_collection)
+            if product is None:
+                unknown_barcodes.append(barcode)
+            else:
+                product_ids.append(product["id"])
+        end = (request.end_x, request.end_y) if request.end_x is not None else None
+        route = pick_route.plan(navigator, (x, y), product_ids, end)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to plan pick route: {str(e)}")
+    route.update({
+        "cart_id": request.cart_id,
+        "start": {"x": x, "y": y},
+        "position_timestamp": position["timestamp"] if position else None,
+        "unknown_barcodes": unknown_barcodes,
+    })
+    return route
+
 @router.get("/map_image")
-async def get_map_image(map_collection=Depends(get_map_collection)):
-    """Return the shopping mall map image from MongoDB."""
-    map_doc = map_collection.find_one({"name": "mall_map"})
-    if not map_doc or "image" not in map_doc:
+async def get_map_image(request: Request):
+    """
+    Return the shopping mall map image. It is served from the local map cache
+    with its content hash as ETag, so unchanged maps revalidate with a 304;
+    Range requests are supported.
+    """
+    try:
+        manifest = await map_tiles.ensure_ready()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load map image: {str(e)}")
+    if manifest is None:
         raise HTTPException(status_code=404, detail="Map image not found")
-    image_bytes = map_doc["image"]
-    return StreamingResponse(BytesIO(image_bytes), media_type="image/png")
+    etag = f'"{manifest["version"]}"'
+    headers = {"ETag": etag, "Cache-Control": "public, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(map_tiles.original_path(manifest), media_type=manifest["media_type"], headers=headers)
+
+@router.put("/map_image")
+async def upload_map_image(
+    image: UploadFile = File(..., description="New map image (PNG or WebP)"),
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+):
+    """Replace the map image. Its tile set is built before the new version goes live. Admin only."""
+    image_bytes = await image.read()
+    try:
+        with Image.open(BytesIO(image_bytes)) as uploaded:
+            uploaded.verify()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid image")
+    try:
+        manifest = await map_tiles.upload(image_bytes)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to store map image: {str(e)}")
+    return {"success": True, **_tile_manifest(manifest)}
+
+def _tile_manifest(manifest: dict) -> dict:
+    manifest = dict(manifest)
+    manifest.pop("original", None)
+    manifest["url_template"] = f"/api/map/tiles/{manifest['version']}/{{z}}/{{x}}/{{y}}.{{format}}"
+    return manifest
+
+@router.get("/tiles")
+async def get_map_tiles():
+    """
+    Return the current map version and its tile pyramid: size, zoom levels
+    (max_zoom is full resolution, each level below halves it), tile size,
+    formats and the tile URL template. Tile URLs include the version, so
+    tiles are cached forever and a new map uses new URLs.
+    """
+    try:
+        manifest = await map_tiles.ensure_ready()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load map tiles: {str(e)}")
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="Map image not found")
+    return _tile_manifest(manifest)
+
+@router.get("/tiles/{version}/{zoom}/{x}/{y}.{tile_format}")
+async def get_map_tile(version: str, zoom: int, x: int, y: int, tile_format: Literal["webp", "png"], request: Request):
+    """Return one map tile. Tiles of a version never change."""
+    path = map_tiles.tile_path(version, zoom, x, y, tile_format)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Tile not found")
+    etag = f'"{version[:16]}-{zoom}-{x}-{y}-{tile_format}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=TILE_FORMATS[tile_format][1], headers=headers)
+
+@router.get("/heatmap")
+async def get_heatmap(
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+    hours: int = Query(24, ge=1, le=24 * 90, description="Hours of UWB history to include"),
+    until: Optional[datetime] = Query(None, description="End of the window (UTC); defaults to now"),
+    normalize: bool = Query(False, description="Scale cells to 0..1 density instead of raw counts"),
+    uwb_heatmap_collection: AsyncCollection = Depends(get_uwb_heatmap_collection),
+):
+    """
+    Return the store-wide cart occupancy grid built from UWB history.
+    cells[row][col] covers x in [col*cell_size, (col+1)*cell_size) and y in
+    [row*cell_size, (row+1)*cell_size), in the coordinate space of the map image.
+    """
+    try:
+        start, end, is_open = heatmap.window(hours, until)
+        grid = await heatmap.get_grid(start, end, is_open, uwb_heatmap_collection)
+        total = int(grid.sum())
+        peak = int(grid.max()) if grid.size else 0
+        cells = (grid / peak).round(4).tolist() if normalize and peak else grid.tolist()
+        return {
+            "start": start,
+            "end": end,
+            "cell_size": settings.HEATMAP_CELL_SIZE,
+            "width_units": settings.MAP_WIDTH_UNITS,
+            "height_units": settings.MAP_HEIGHT_UNITS,
+            "rows": grid.shape[0],
+            "cols": grid.shape[1],
+            "total": total,
+            "max": peak,
+            "cells": cells,
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to build heatmap: {str(e)}")
+
+@router.get("/heatmap.png")
+async def get_heatmap_overlay(
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+    hours: int = Query(24, ge=1, le=24 * 90, description="Hours of UWB history to include"),
+    until: Optional[datetime] = Query(None, description="End of the window (UTC); defaults to now"),
+    opacity: float = Query(0.6, gt=0, le=1, description="Overlay opacity"),
+    blur: float = Query(8.0, ge=0, le=100, description="Gaussian blur radius in pixels"),
+    scale: Literal["linear", "log"] = Query("linear", description="Intensity scale"),
+    uwb_heatmap_collection: AsyncCollection = Depends(get_uwb_heatmap_collection),
+):
+    """
+    Return the occupancy heatmap as a transparent PNG with the same pixel size
+    as /api/map/map_image, so it can be drawn directly on top of the map.
+    """
+    try:
+        start, end, is_open = heatmap.window(hours, until)
+        png = await heatmap.get_overlay(start, end, is_open, uwb_heatmap_collection, opacity, blur, scale)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to render heatmap: {str(e)}")
+    max_age = settings.HEATMAP_CACHE_TTL_SECONDS if is_open else 3600
+    return Response(content=png, media_type="image/png", headers={"Cache-Control": f"private, max-age={max_age}"})
+
+@router.post("/heatmap/rebuild")
+async def rebuild_heatmap(
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+    hours: int = Query(168, ge=1, le=24 * 90, description="Hours of UWB history to recompute"),
+    uwb_heatmap_collection: AsyncCollection = Depends(get_uwb_heatmap_collection),
+    uwb_locations_collection: AsyncCollection = Depends(get_uwb_locations_collection),
+):
+    """Recompute hourly heatmap grids from raw UWB locations. Admin only."""
+    try:
+        start, end, _ = heatmap.window(hours)
+        written = await heatmap.rebuild(start, end, uwb_heatmap_collection, uwb_locations_collection)
+        return {"success": True, "period_hours": hours, "hours_written": written}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to rebuild heatmap: {str(e)}")
@@ -44,11 +44,20 @@ class ProductBase(BaseModel):
     )
 
 
+# A shelf position of a product, in map units.
+class ShelfLocation(BaseModel):
+    x: float
+    y: float
+
+
 # Model for creating a new product. 'quantity' is the initial stock.
 class ProductCreate(ProductBase):
     quantity: int = Field(
         default=1, ge=0, description="The initial stock quantity of the product."
     )
+    location: Optional[List[ShelfLocation]] = Field(
+        default=None, description="Shelf positions of the product on the store map."
+    )
 
 
 # Model for what is stored in/retrieved from the DB and used in the cart.
@@ -69,6 +78,7 @@ class ProductUpdate(BaseModel):
     unit: Optional[str] = None
     product_img_url: Optional[str] = None
     barcode: Optional[str] = None
+    location: Optional[List[ShelfLocation]] = None
 
 
 # --- User and Auth Models ---
@@ -101,6 +111,7 @@ class CardLogin(BaseModel):
 class OrderStatus(str, Enum):
     PENDING = "pending"
     PAID = "paid"
+    PROCESSING = "processing"  # Claimed by an inventory task (servers without transactions)
     FAILED = "failed"
     COMPLETED = "completed"  # After inventory processing
 
@@ -210,6 +221,17 @@ class CartOpResponse(BaseModel):
     cart_total_items: int = Field(..., ge=0, description="Total items in cart after operation")
     session_id: Optional[str] = None
 
+# --- Map Models ---
+class PickRouteRequest(BaseModel):
+    """Request model for ordering a shopping list into a walking route."""
+    product_ids: List[int] = Field(default_factory=list, description="Products to pick up")
+    barcodes: List[str] = Field(default_factory=list, description="Products to pick up, by barcode")
+    x: Optional[float] = Field(None, description="Start x coordinate")
+    y: Optional[float] = Field(None, description="Start y coordinate")
+    cart_id: Optional[str] = Field(None, description="Start from this cart's latest UWB position instead of x/y")
+    end_x: Optional[float] = Field(None, description="Finish at this x coordinate, e.g. the checkout")
+    end_y: Optional[float] = Field(None, description="Finish at this y coordinate")
+
 # --- Logging Models ---
 class CartLogEntry(BaseModel):
     """Model for logging cart operations."""
@@ -275,3 +297,4 @@ class UWBLocationLogEntry(BaseModel):
     raw_distances: Optional[List[int]] = Field(None, description="Raw distance measurements to anchors")
     filtered: bool = Field(default=True, description="Whether position was filtered/smoothed")
     tracking_mode: bool = Field(default=True, description="Whether tracking mode was active")
+    position_source: Optional[str] = Field(None, description="'device' if x/y came from the cart, 'server' if solved by the backend")
@@ -1,10 +1,34 @@
 # backend/motion/routes.py
-from fastapi import APIRouter, HTTPException, status, Depends, Query, Body
-from pymongo import DESCENDING, collection
-from typing import List, Optional
-from datetime import datetime, timedelta
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Body, Request
+from pydantic import BaseModel, ValidationError
+from pymongo import DESCENDING
+from pymongo.errors import BulkWriteError
+from pymongo.asynchronous.collection import AsyncCollection
+from bson import ObjectId
+from typing import List, Literal, Optional, Type, Union
+from datetime import datetime, timedelta, timezone
+import json
+import numpy as np
 from ..models import MotionLogEntry, MotionEventLogEntry, UWBLocationLogEntry, Role
-from ..database import get_motion_logs_collection, get_motion_events_collection, get_uwb_locations_collection
+from ..database import (
+    get_motion_logs_collection,
+    get_motion_events_collection,
+    get_uwb_locations_collection,
+    get_motion_rollups_collection,
+    get_motion_rollup_watermarks_collection,
+    get_uwb_heatmap_collection,
+    TIMESERIES_COLLECTIONS,
+    to_timeseries_document,
+    from_timeseries_document,
+    timeseries_filter,
+)
+from ..services.log_sink import log_sink
+from ..services import motion_rollups as rollups
+from ..services import trajectory
+from ..services.heatmap import heatmap_accumulator, prune as prune_heatmap
+from ..services.weight_events import weight_event_detector, detector_from_settings, PROCESSED_BY
+from ..services.uwb_positioning import positioning_engine, engine_from_settings
+from ..config import settings
 from .. import auth
 
 router = APIRouter(
@@ -13,25 +37,69 @@ router = APIRouter(
 )
 
 
+# Raw collections that feed the /stats rollups
+ROLLUP_SOURCE_BY_COLLECTION = {"motion_logs": "logs", "motion_events": "events"}
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+async def _enqueue_log(collection_name: str, document: dict) -> str:
+    """
+    Hands a telemetry document to the buffered log sink and returns its id.
+    The id is assigned here so clients get it back without waiting for the write.
+    """
+    document["_id"] = ObjectId()
+    if collection_name == "uwb_locations" and settings.UWB_SERVER_POSITIONING:
+        positioning_engine.apply([document])
+    flat_document = document
+    if collection_name in TIMESERIES_COLLECTIONS:
+        document = to_timeseries_document(document)
+    if not await log_sink.emit(collection_name, document):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Log queue for {collection_name} is full, retry later"
+        )
+    if collection_name in ROLLUP_SOURCE_BY_COLLECTION:
+        rollups.motion_rollups.record(ROLLUP_SOURCE_BY_COLLECTION[collection_name], [flat_document])
+    elif collection_name == "uwb_locations":
+        heatmap_accumulator.record([flat_document])
+    if collection_name == "motion_logs" and settings.MOTION_EVENT_DETECTION:
+        await _emit_detected_events([flat_document])
+    return str(document["_id"])
+
+
+async def _emit_detected_events(readings: List[dict]):
+    """
+    Runs weight readings through the live event detector and queues the
+    detected add/remove events. The readings are already accepted, so an event
+    that cannot be queued is only counted as dropped by the sink.
+    """
+    events = weight_event_detector.process(readings)
+    for event in events:
+        event["_id"] = ObjectId()
+        if await log_sink.emit("motion_events", event):
+            rollups.motion_rollups.record("events", [event])
+
+
 @router.post('/log', status_code=status.HTTP_201_CREATED)
 async def log_motion_data(
     motion_data: MotionLogEntry,
-    motion_logs_collection: collection.Collection = Depends(get_motion_logs_collection)
 ):
     """
     Log raw motion sensor data from smart cart.
     This endpoint receives real-time motion sensor readings.
     """
     try:
-        # Convert to dict and insert
-        log_doc = motion_data.model_dump()
-        result = motion_logs_collection.insert_one(log_doc)
+        # Convert to dict and queue for a batched insert
+        log_id = await _enqueue_log("motion_logs", motion_data.model_dump())
         
         return {
             "success": True,
             "message": "Motion data logged successfully",
-            "log_id": str(result.inserted_id)
+            "log_id": log_id
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -42,22 +110,22 @@ async def log_motion_data(
 @router.post('/event', status_code=status.HTTP_201_CREATED)
 async def log_motion_event(
     event_data: MotionEventLogEntry,
-    motion_events_collection: collection.Collection = Depends(get_motion_events_collection)
 ):
     """
     Log processed motion events (add/remove operations).
     This endpoint receives processed events when items are added or removed.
     """
     try:
-        # Convert to dict and insert
-        event_doc = event_data.model_dump()
-        result = motion_events_collection.insert_one(event_doc)
+        # Convert to dict and queue for a batched insert
+        event_id = await _enqueue_log("motion_events", event_data.model_dump())
         
         return {
             "success": True,
             "message": "Motion event logged successfully",
-            "event_id": str(result.inserted_id)
+            "event_id": event_id
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -68,53 +136,48 @@ async def log_motion_event(
 @router.post('/uwb-log', status_code=status.HTTP_201_CREATED)
 async def log_uwb_location(
     location_data: UWBLocationLogEntry,
-    uwb_locations_collection: collection.Collection = Depends(get_uwb_locations_collection)
 ):
     """
     Log UWB location tracking data from smart cart.
     This endpoint receives real-time location coordinates from UWB positioning system.
     """
     try:
-        # Convert to dict and insert
-        location_doc = location_data.model_dump()
-        result = uwb_locations_collection.insert_one(location_doc)
+        # Convert to dict and queue for a batched insert
+        location_id = await _enqueue_log("uwb_locations", location_data.model_dump())
         
         return {
             "success": True,
             "message": "UWB location logged successfully",
-            "location_id": str(result.inserted_id)
+            "location_id": location_id
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to log UWB location: {str(e)}"
         )
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to log motion event: {str(e)}"
-        )
 
 
 @router.post('/uwb-location', status_code=status.HTTP_201_CREATED)
-async def log_uwb_location(
+async def log_uwb_location_position(
     location_data: UWBLocationLogEntry,
-    uwb_locations_collection: collection.Collection = Depends(get_uwb_locations_collection)
 ):
     """
     Log UWB location tracking data from smart cart.
     This endpoint receives real-time position data from UWB sensors.
     """
     try:
-        # Convert to dict and insert
-        location_doc = location_data.model_dump()
-        result = uwb_locations_collection.insert_one(location_doc)
+        # Convert to dict and queue for a batched insert
+        location_id = await _enqueue_log("uwb_locations", location_data.model_dump())
         
         return {
             "success": True,
             "message": "UWB location logged successfully",
-            "location_id": str(result.inserted_id)
+            "location_id": location_id
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -122,10 +185,164 @@ async def log_uwb_location(
         )
 
 
+def _parse_batch_body(body: bytes, content_type: str) -> list:
+    """Parses a JSON array or an NDJSON body into a list of raw records."""
+    text = body.decode("utf-8").strip()
+    if not text:
+        return []
+    if "ndjson" not in content_type and text.startswith("["):
+        records = json.loads(text)
+        if not isinstance(records, list):
+            raise ValueError("Expected a JSON array of records")
+        return records
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+async def _ingest_batch(
+    request: Request,
+    model: Type[BaseModel],
+    target_collection: AsyncCollection,
+) -> dict:
+    """
+    Validates every record of a batch body against the given model and inserts
+    the valid ones with a single unordered insert_many.
+    """
+    try:
+        records = _parse_batch_body(await request.body(), request.headers.get("content-type", ""))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Body must be a JSON array or NDJSON: {str(e)}"
+        )
+    
+    if len(records) > settings.MOTION_BATCH_MAX_RECORDS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch too large: {len(records)} records, limit is {settings.MOTION_BATCH_MAX_RECORDS}"
+        )
+    
+    is_timeseries = target_collection.name in TIMESERIES_COLLECTIONS
+    rollup_source = ROLLUP_SOURCE_BY_COLLECTION.get(target_collection.name)
+    flat_documents = []
+    errors = []
+    for index, record in enumerate(records):
+        try:
+            flat_documents.append(model.model_validate(record).model_dump())
+        except ValidationError as e:
+            errors.append({"index": index, "errors": e.errors(include_url=False, include_context=False)})
+    
+    # Solve the whole batch at once before the documents are reshaped for storage
+    if model is UWBLocationLogEntry and settings.UWB_SERVER_POSITIONING:
+        positioning_engine.apply(flat_documents)
+    documents = [to_timeseries_document(doc) if is_timeseries else doc for doc in flat_documents]
+    
+    if records and not documents:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail={"received": len(records), "accepted": 0, "inserted": 0, "rejected": len(errors), "errors": errors}
+        )
+    
+    inserted = 0
+    if documents:
+        try:
+            result = await target_collection.insert_many(documents, ordered=False)
+            inserted = len(result.inserted_ids)
+            if rollup_source:
+                rollups.motion_rollups.record(rollup_source, flat_documents)
+            elif target_collection.name == "uwb_locations":
+                heatmap_accumulator.record(flat_documents)
+            if target_collection.name == "motion_logs" and settings.MOTION_EVENT_DETECTION:
+                await _emit_detected_events(flat_documents)
+        except BulkWriteError as e:
+            inserted = e.details.get("nInserted", 0)
+            for write_error in e.details.get("writeErrors", []):
+                errors.append({"index": None, "errors": [{"msg": write_error.get("errmsg")}]})
+    
+    return {
+        "success": inserted == len(records),
+        "received": len(records),
+        "accepted": len(documents),
+        "inserted": inserted,
+        "rejected": len(records) - len(documents),
+        "errors": errors
+    }
+
+
+@router.post('/log/batch', status_code=status.HTTP_201_CREATED)
+async def log_motion_data_batch(
+    request: Request,
+    motion_logs_collection: AsyncCollection = Depends(get_motion_logs_collection)
+):
+    """
+    Log a batch of raw motion sensor readings.
+    Accepts a JSON array or an NDJSON body of MotionLogEntry records.
+    """
+    try:
+        return await _ingest_batch(request, MotionLogEntry, motion_logs_collection)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to log motion data batch: {str(e)}"
+        )
+
+
+@router.post('/event/batch', status_code=status.HTTP_201_CREATED)
+async def log_motion_event_batch(
+    request: Request,
+    motion_events_collection: AsyncCollection = Depends(get_motion_events_collection)
+):
+    """
+    Log a batch of processed motion events.
+    Accepts a JSON array or an NDJSON body of MotionEventLogEntry records.
+    """
+    try:
+        return await _ingest_batch(request, MotionEventLogEntry, motion_events_collection)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to log motion event batch: {str(e)}"
+        )
+
+
+@router.post('/uwb-log/batch', status_code=status.HTTP_201_CREATED)
+@router.post('/uwb-location/batch', status_code=status.HTTP_201_CREATED)
+async def log_uwb_location_batch(
+    request: Request,
+    uwb_locations_collection: AsyncCollection = Depends(get_uwb_locations_collection)
+):
+    """
+    Log a batch of UWB location samples.
+    Accepts a JSON array or an NDJSON body of UWBLocationLogEntry records.
+    """
+    try:
+        return await _ingest_batch(request, UWBLocationLogEntry, uwb_locations_collection)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to log UWB location batch: {str(e)}"
+        )
+
+
+@router.get('/log-sink/stats')
+async def get_log_sink_stats(
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+):
+    """
+    Report buffered log writer counters (queue depth, written, dropped) per collection. Admin only.
+    """
+    return log_sink.stats()
+
+
 @router.get('/logs', response_model=List[MotionLogEntry])
 async def get_motion_logs(
     current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN, Role.SHOP_CLIENT])),
-    motion_logs_collection: collection.Collection = Depends(get_motion_logs_collection),
+    motion_logs_collection: AsyncCollection = Depends(get_motion_logs_collection),
     cart_id: Optional[str] = Query(None, description="Filter by cart ID"),
     session_id: Optional[str] = Query(None, description="Filter by session ID"),
     state: Optional[int] = Query(None, ge=0, le=2, description="Filter by motion state (0=idle, 1=adding, 2=removing)"),
@@ -156,12 +373,12 @@ async def get_motion_logs(
             filter_query["state"] = state
         
         # Query logs
-        logs = list(motion_logs_collection.find(
-            filter_query,
+        logs = await motion_logs_collection.find(
+            timeseries_filter(filter_query),
             {'_id': 0}
-        ).sort("timestamp", DESCENDING).limit(limit))
+        ).sort("timestamp", DESCENDING).limit(limit).to_list()
         
-        return logs
+        return [from_timeseries_document(log) for log in logs]
         
     except Exception as e:
         raise HTTPException(
@@ -173,7 +390,7 @@ async def get_motion_logs(
 @router.get('/events', response_model=List[MotionEventLogEntry])
 async def get_motion_events(
     current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN, Role.SHOP_CLIENT])),
-    motion_events_collection: collection.Collection = Depends(get_motion_events_collection),
+    motion_events_collection: AsyncCollection = Depends(get_motion_events_collection),
     cart_id: Optional[str] = Query(None, description="Filter by cart ID"),
     session_id: Optional[str] = Query(None, description="Filter by session ID"),
     event_type: Optional[str] = Query(None, description="Filter by event type (add/remove)"),
@@ -204,10 +421,10 @@ async def get_motion_events(
             filter_query["event_type"] = event_type.lower()
         
         # Query events
-        events = list(motion_events_collection.find(
+        events = await motion_events_collection.find(
             filter_query,
             {'_id': 0}
-        ).sort("timestamp", DESCENDING).limit(limit))
+        ).sort("timestamp", DESCENDING).limit(limit).to_list()
         
         return events
         
@@ -218,53 +435,120 @@ async def get_motion_events(
         )
 
 
+@router.post('/events/reprocess')
+async def reprocess_motion_events(
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+    motion_logs_collection: AsyncCollection = Depends(get_motion_logs_collection),
+    motion_events_collection: AsyncCollection = Depends(get_motion_events_collection),
+    motion_rollups_collection: AsyncCollection = Depends(get_motion_rollups_collection),
+    motion_rollup_watermarks_collection: AsyncCollection = Depends(get_motion_rollup_watermarks_collection),
+    cart_id: Optional[str] = Query(None, description="Filter by cart ID"),
+    session_id: Optional[str] = Query(None, description="Filter by session ID"),
+    hours: int = Query(24, ge=1, le=168, description="Hours of weight readings to reprocess"),
+    limit: int = Query(200000, ge=1, le=1000000, description="Maximum number of readings to read"),
+    filter_type: Optional[Literal["median", "ema"]] = Query(None, description="Override MOTION_FILTER"),
+    filter_window: Optional[int] = Query(None, ge=1, le=101, description="Override MOTION_MEDIAN_WINDOW"),
+    ema_alpha: Optional[float] = Query(None, gt=0, le=1, description="Override MOTION_EMA_ALPHA"),
+    stable_samples: Optional[int] = Query(None, ge=2, le=200, description="Override MOTION_STABLE_SAMPLES"),
+    stable_tolerance: Optional[float] = Query(None, gt=0, description="Override MOTION_STABLE_TOLERANCE_GRAMS"),
+    min_step: Optional[float] = Query(None, gt=0, description="Override MOTION_MIN_STEP_GRAMS"),
+    store: bool = Query(False, description="Replace stored server-detected events in the window with the result")
+):
+    """
+    Re-detect add/remove events from stored weight readings. Admin only.
+    By default this is a dry run; with store=true the server-detected events
+    in the window are replaced and the motion rollups are recomputed.
+    """
+    try:
+        since = datetime.utcnow() - timedelta(hours=hours)
+        filter_query = {"timestamp": {"$gte": since}}
+        if cart_id:
+            filter_query["cart_id"] = cart_id
+        if session_id:
+            filter_query["session_id"] = session_id
+        
+        logs = await motion_logs_collection.find(
+            timeseries_filter(filter_query),
+            {'_id': 0}
+        ).sort("timestamp", DESCENDING).limit(limit).to_list()
+        readings = [from_timeseries_document(log) for log in logs]
+        
+        detector = detector_from_settings(
+            filter_type=filter_type, filter_window=filter_window, ema_alpha=ema_alpha,
+            stable_samples=stable_samples, stable_tolerance=stable_tolerance, min_step=min_step
+        )
+        events = detector.detect_batch(readings)
+        
+        replaced = 0
+        if store:
+            delete_query = {**filter_query, "processed_by": PROCESSED_BY}
+            removed = await motion_events_collection.find(delete_query, {'_id': 0}).to_list()
+            replaced = (await motion_events_collection.delete_many(delete_query)).deleted_count
+            if events:
+                await motion_events_collection.insert_many([dict(event) for event in events], ordered=False)
+            # Hours the rebuild leaves open keep their rollups, so adjust them by the difference
+            rollups.motion_rollups.record("events", removed, sign=-1)
+            rollups.motion_rollups.record("events", events)
+            await rollups.rebuild(
+                since, datetime.utcnow(), motion_rollups_collection,
+                {"logs": motion_logs_collection, "events": motion_events_collection},
+                motion_rollup_watermarks_collection,
+            )
+        
+        return {
+            "success": True,
+            "readings": len(readings),
+            "detected": len(events),
+            "stored": store,
+            "replaced": replaced,
+            "events": events
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to reprocess motion events: {str(e)}"
+        )
+
+
 @router.get('/stats')
 async def get_motion_stats(
     current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
-    motion_logs_collection: collection.Collection = Depends(get_motion_logs_collection),
-    motion_events_collection: collection.Collection = Depends(get_motion_events_collection),
+    motion_logs_collection: AsyncCollection = Depends(get_motion_logs_collection),
+    motion_events_collection: AsyncCollection = Depends(get_motion_events_collection),
+    motion_rollups_collection: AsyncCollection = Depends(get_motion_rollups_collection),
+    watermarks_collection: AsyncCollection = Depends(get_motion_rollup_watermarks_collection),
     cart_id: Optional[str] = Query(None, description="Filter by cart ID"),
     hours: int = Query(24, ge=1, le=168, description="Hours to look back")
 ):
     """
     Get motion statistics for admin dashboard.
+    Served from per-minute/per-hour rollups; minutes not yet flushed by every worker are read from raw data.
     """
     try:
-        # Time filter
-        since = datetime.utcnow() - timedelta(hours=hours)
-        time_filter = {"timestamp": {"$gte": since}}
-        
-        # Add cart filter if specified
-        if cart_id:
-            time_filter["cart_id"] = cart_id
+        now = datetime.utcnow()
+        since = now - timedelta(hours=hours)
         
         # Count logs by state
-        state_pipeline = [
-            {"$match": time_filter},
-            {"$group": {
-                "_id": "$state",
-                "count": {"$sum": 1},
-                "avg_weight": {"$avg": "$weight"}
-            }}
+        state_rows = await rollups.get_distribution(
+            "logs", since, now, motion_rollups_collection, motion_logs_collection, watermarks_collection, cart_id
+        )
+        state_stats = [
+            {"_id": row["_id"], "count": row["count"], "avg_weight": row["value_sum"] / row["count"]}
+            for row in state_rows if row["count"]
         ]
         
-        state_stats = list(motion_logs_collection.aggregate(state_pipeline))
-        
         # Count events by type
-        event_pipeline = [
-            {"$match": time_filter},
-            {"$group": {
-                "_id": "$event_type",
-                "count": {"$sum": 1},
-                "avg_weight_change": {"$avg": "$weight_difference"}
-            }}
+        event_rows = await rollups.get_distribution(
+            "events", since, now, motion_rollups_collection, motion_events_collection, watermarks_collection, cart_id
+        )
+        event_stats = [
+            {"_id": row["_id"], "count": row["count"], "avg_weight_change": row["value_sum"] / row["count"]}
+            for row in event_rows if row["count"]
         ]
         
-        event_stats = list(motion_events_collection.aggregate(event_pipeline))
-        
         # Total counts
-        total_logs = motion_logs_collection.count_documents(time_filter)
-        total_events = motion_events_collection.count_documents(time_filter)
+        total_logs = sum(row["count"] for row in state_rows)
+        total_events = sum(row["count"] for row in event_rows)
         
         return {
             "period_hours": hours,
@@ -282,17 +566,134 @@ async def get_motion_stats(
         )
 
 
-@router.get('/uwb-locations', response_model=List[UWBLocationLogEntry])
+@router.get('/stats/timeseries')
+async def get_motion_stats_timeseries(
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+    motion_rollups_collection: AsyncCollection = Depends(get_motion_rollups_collection),
+    source: Literal["logs", "events"] = Query("logs", description="logs = counts per motion state, events = counts per event type"),
+    granularity: Literal["minute", "hour"] = Query("hour", description="Bucket size"),
+    cart_id: Optional[str] = Query(None, description="Filter by cart ID"),
+    hours: int = Query(24, ge=1, le=168, description="Hours to look back")
+):
+    """
+    Get bucketed motion counts for charting. Each point carries the bucket start,
+    the state or event type, the count and the average weight (change).
+    """
+    try:
+        since = datetime.utcnow() - timedelta(hours=hours)
+        points = await rollups.get_timeseries(source, granularity, since, motion_rollups_collection, cart_id)
+        return {
+            "source": source,
+            "granularity": granularity,
+            "period_hours": hours,
+            "cart_id": cart_id,
+            "points": points
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to retrieve motion time series: {str(e)}"
+        )
+
+
+@router.post('/stats/rebuild')
+async def rebuild_motion_stats(
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+    motion_logs_collection: AsyncCollection = Depends(get_motion_logs_collection),
+    motion_events_collection: AsyncCollection = Depends(get_motion_events_collection),
+    motion_rollups_collection: AsyncCollection = Depends(get_motion_rollups_collection),
+    motion_rollup_watermarks_collection: AsyncCollection = Depends(get_motion_rollup_watermarks_collection),
+    hours: int = Query(168, ge=1, le=24 * 90, description="Hours of raw data to recompute rollups for")
+):
+    """
+    Recompute motion rollups from raw logs and events. Admin only.
+    Use it to backfill history ingested before rollups existed.
+    """
+    try:
+        now = datetime.utcnow()
+        written = await rollups.rebuild(
+            now - timedelta(hours=hours), now, motion_rollups_collection,
+            {"logs": motion_logs_collection, "events": motion_events_collection},
+            motion_rollup_watermarks_collection,
+        )
+        return {
+            "success": True,
+            "period_hours": hours,
+            "rollups_written": written
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to rebuild motion statistics: {str(e)}"
+        )
+
+
+def _timestamp_seconds(timestamp: datetime) -> float:
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - _EPOCH).total_seconds()
+
+
+def _simplify_locations(
+    locations: List[dict],
+    resolution: str,
+    tolerance: float,
+    bucket_seconds: float,
+    stop_radius: float,
+    stop_seconds: float,
+) -> List[dict]:
+    """
+    Splits locations (any order) into one trajectory per cart and session and
+    simplifies each. Returns [{"cart_id", "session_id", "x", "y", "t", "stop", "source"}]
+    with parallel numpy arrays; "source" indexes into the trajectory's samples.
+    """
+    trajectories = {}
+    for location in locations:
+        if location.get("x") is None or location.get("y") is None or not isinstance(location.get("timestamp"), datetime):
+            continue
+        trajectories.setdefault((location.get("cart_id"), location.get("session_id")), []).append(location)
+    
+    results = []
+    for (cart_id, session_id), samples in trajectories.items():
+        samples.sort(key=lambda sample: _timestamp_seconds(sample["timestamp"]))
+        xy = np.array([[sample["x"], sample["y"]] for sample in samples], dtype=float)
+        t = np.array([_timestamp_seconds(sample["timestamp"]) for sample in samples])
+        if resolution == "full":
+            indices = np.arange(len(samples))
+            out_xy, out_t, stop = xy, t, np.zeros(len(samples), dtype=bool)
+        else:
+            out_xy, out_t, indices, stop = trajectory.simplify(
+                xy, t, resolution, tolerance, bucket_seconds, stop_radius, stop_seconds
+            )
+        results.append({
+            "cart_id": cart_id, "session_id": session_id, "samples": samples,
+            "x": out_xy[:, 0], "y": out_xy[:, 1], "t": out_t, "stop": stop, "source": indices,
+        })
+    return results
+
+
+@router.get('/uwb-locations', response_model=None)
 async def get_uwb_locations(
     current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN, Role.SHOP_CLIENT])),
-    uwb_locations_collection: collection.Collection = Depends(get_uwb_locations_collection),
+    uwb_locations_collection: AsyncCollection = Depends(get_uwb_locations_collection),
     cart_id: Optional[str] = Query(None, description="Filter by cart ID"),
     session_id: Optional[str] = Query(None, description="Filter by session ID"),
     limit: int = Query(100, ge=1, le=10000, description="Number of location logs to return"),
-    hours: int = Query(24, ge=1, le=168, description="Hours to look back")
-):
+    hours: int = Query(24, ge=1, le=168, description="Hours to look back"),
+    resolution: Literal["full", "rdp", "bucket"] = Query("full", description="Return raw samples or simplify each trajectory server-side"),
+    tolerance: float = Query(50.0, gt=0, description="RDP distance tolerance in map units"),
+    bucket_seconds: float = Query(2.0, gt=0, description="Time bucket width for bucket averaging"),
+    stop_radius: float = Query(100.0, ge=0, description="Points within this radius of each other form a stop"),
+    stop_seconds: float = Query(5.0, gt=0, description="Minimum duration of a stop; stop start and end are always kept"),
+    format: Literal["records", "columnar"] = Query("records", description="List of records or parallel x/y/t arrays per trajectory")
+) -> Union[List[UWBLocationLogEntry], dict]:
     """
     Retrieve UWB location tracking logs.
+    
+    With resolution=rdp or resolution=bucket each cart/session trajectory is
+    simplified (Ramer-Douglas-Peucker or time-bucket averaging) while stop points
+    are kept. format=columnar returns parallel x, y and t (epoch ms) arrays per
+    trajectory instead of full records, which is much smaller for drawing paths.
     """
     try:
         # Build filter query
@@ -310,27 +711,134 @@ async def get_uwb_locations(
         if session_id:
             filter_query["session_id"] = session_id
         
+        # Columnar output only needs positions, so skip the rest of each document
+        projection = {'_id': 0}
+        if format == "columnar":
+            projection = {'_id': 0, 'x': 1, 'y': 1, 'timestamp': 1, 'meta': 1}
+        
         # Query locations
-        locations = list(uwb_locations_collection.find(
-            filter_query,
+        locations = await uwb_locations_collection.find(
+            timeseries_filter(filter_query),
+            projection
+        ).sort("timestamp", DESCENDING).limit(limit).to_list()
+        locations = [from_timeseries_document(location) for location in locations]
+        
+        if resolution == "full" and format == "records":
+            return [UWBLocationLogEntry.model_validate(location) for location in locations]
+        
+        trajectories = _simplify_locations(locations, resolution, tolerance, bucket_seconds, stop_radius, stop_seconds)
+        
+        if format == "columnar":
+            return {
+                "resolution": resolution,
+                "source_count": len(locations),
+                "count": sum(len(item["t"]) for item in trajectories),
+                "trajectories": [
+                    {
+                        "cart_id": item["cart_id"],
+                        "session_id": item["session_id"],
+                        "x": np.round(item["x"], 1).tolist(),
+                        "y": np.round(item["y"], 1).tolist(),
+                        "t": np.round(item["t"] * 1000).astype(np.int64).tolist(),
+                        "stops": np.flatnonzero(item["stop"]).tolist(),
+                    }
+                    for item in trajectories
+                ]
+            }
+        
+        # Simplified records: newest first like the raw listing
+        records = []
+        for item in trajectories:
+            for x, y, t, source in zip(item["x"], item["y"], item["t"], item["source"]):
+                sample = item["samples"][source]
+                records.append({
+                    **sample,
+                    "x": round(float(x), 1),
+                    "y": round(float(y), 1),
+                    "timestamp": _EPOCH + timedelta(seconds=float(t)),
+                    # Averaged points no longer correspond to one set of ranges
+                    "raw_distances": sample.get("raw_distances") if resolution == "rdp" else None,
+                })
+        records.sort(key=lambda record: record["timestamp"], reverse=True)
+        return [UWBLocationLogEntry.model_validate(record) for record in records]
+        
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to retrieve UWB location logs: {str(e)}"
+        )
+
+
+@router.post('/uwb-locations/replay')
+async def replay_uwb_locations(
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+    uwb_locations_collection: AsyncCollection = Depends(get_uwb_locations_collection),
+    cart_id: Optional[str] = Query(None, description="Filter by cart ID"),
+    session_id: Optional[str] = Query(None, description="Filter by session ID"),
+    limit: int = Query(5000, ge=1, le=50000, description="Number of location logs to reprocess"),
+    hours: int = Query(24, ge=1, le=168, description="Hours to look back"),
+    smoother: Optional[Literal["none", "alpha_beta", "kalman"]] = Query(None, description="Override UWB_SMOOTHER"),
+    alpha: Optional[float] = Query(None, gt=0, le=1, description="Override UWB_ALPHA"),
+    beta: Optional[float] = Query(None, gt=0, le=1, description="Override UWB_BETA"),
+    gate: Optional[float] = Query(None, gt=0, description="Override UWB_GATE_DISTANCE"),
+    residual_threshold: Optional[float] = Query(None, gt=0, description="Override UWB_RESIDUAL_THRESHOLD")
+):
+    """
+    Recompute positions of stored UWB samples from their raw distances. Admin only.
+    Nothing is written; the response pairs stored and recomputed positions so
+    positioning parameters can be tuned against recorded sessions.
+    """
+    try:
+        filter_query = {"timestamp": {"$gte": datetime.utcnow() - timedelta(hours=hours)}}
+        if cart_id:
+            filter_query["cart_id"] = cart_id
+        if session_id:
+            filter_query["session_id"] = session_id
+        
+        locations = await uwb_locations_collection.find(
+            timeseries_filter(filter_query),
             {'_id': 0}
-        ).sort("timestamp", DESCENDING).limit(limit))
+        ).sort("timestamp", DESCENDING).limit(limit).to_list()
+        samples = [from_timeseries_document(location) for location in reversed(locations)]
         
-        return locations
+        engine = engine_from_settings(
+            smoother=smoother, alpha=alpha, beta=beta, gate=gate, residual_threshold=residual_threshold
+        )
+        positions = engine.replay(samples)
+        
+        results = []
+        for sample, (x, y) in zip(samples, positions):
+            solved = bool(x == x and y == y)  # NaN where too few usable ranges
+            results.append({
+                "timestamp": sample.get("timestamp"),
+                "cart_id": sample.get("cart_id"),
+                "session_id": sample.get("session_id"),
+                "stored": {"x": sample.get("x"), "y": sample.get("y")},
+                "replayed": {"x": round(float(x), 1), "y": round(float(y), 1)} if solved else None,
+            })
         
+        return {
+            "success": True,
+            "count": len(results),
+            "solved": sum(1 for result in results if result["replayed"] is not None),
+            "smoother": engine.smoother,
+            "locations": results
+        }
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to retrieve UWB location logs: {str(e)}"
+            detail=f"Failed to replay UWB locations: {str(e)}"
         )
 
 
 @router.delete('/logs', status_code=status.HTTP_204_NO_CONTENT)
 async def clear_motion_logs(
     current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
-    motion_logs_collection: collection.Collection = Depends(get_motion_logs_collection),
-    motion_events_collection: collection.Collection = Depends(get_motion_events_collection),
-    uwb_locations_collection: collection.Collection = Depends(get_uwb_locations_collection),
+    motion_logs_collection: AsyncCollection = Depends(get_motion_logs_collection),
+    motion_events_collection: AsyncCollection = Depends(get_motion_events_collection),
+    uwb_locations_collection: AsyncCollection = Depends(get_uwb_locations_collection),
+    motion_rollups_collection: AsyncCollection = Depends(get_motion_rollups_collection),
+    uwb_heatmap_collection: AsyncCollection = Depends(get_uwb_heatmap_collection),
     older_than_hours: int = Query(168, ge=1, description="Delete logs older than this many hours")
 ):
     """
@@ -341,9 +849,15 @@ async def clear_motion_logs(
         filter_query = {"timestamp": {"$lt": cutoff_time}}
         
         # Delete old logs
-        logs_result = motion_logs_collection.delete_many(filter_query)
-        events_result = motion_events_collection.delete_many(filter_query)
-        locations_result = uwb_locations_collection.delete_many(filter_query)
+        logs_result = await motion_logs_collection.delete_many(filter_query)
+        events_result = await motion_events_collection.delete_many(filter_query)
+        locations_result = await uwb_locations_collection.delete_many(filter_query)
+        # Drop rollup buckets that lie entirely before the cutoff
+        await motion_rollups_collection.delete_many({"$or": [
+            {"granularity": "minute", "bucket": {"$lt": rollups.floor_bucket(cutoff_time, "minute")}},
+            {"granularity": "hour", "bucket": {"$lt": rollups.floor_bucket(cutoff_time, "hour")}},
+        ]})
+        await prune_heatmap(uwb_heatmap_collection, cutoff_time)
         
         return {
             "success": True,
@@ -363,7 +877,8 @@ async def clear_motion_logs(
 @router.delete('/uwb-locations', status_code=status.HTTP_200_OK)
 async def clear_uwb_locations(
     current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
-    uwb_locations_collection: collection.Collection = Depends(get_uwb_locations_collection),
+    uwb_locations_collection: AsyncCollection = Depends(get_uwb_locations_collection),
+    uwb_heatmap_collection: AsyncCollection = Depends(get_uwb_heatmap_collection),
     older_than_hours: Optional[int] = Query(None, ge=1, description="Delete UWB locations older than this many hours"),
     all_data: bool = Query(False, description="Delete all UWB location data"),
     session_id: Optional[str] = Query(None, description="Delete UWB locations for specific session ID"),
@@ -402,7 +917,10 @@ async def clear_uwb_locations(
             filter_query["cart_id"] = cart_id
         
         # Delete UWB locations
-        result = uwb_locations_collection.delete_many(filter_query)
+        result = await uwb_locations_collection.delete_many(timeseries_filter(filter_query))
+        # The heatmap is store-wide, so only time-based deletes can be mirrored there
+        if not session_id and not cart_id:
+            await prune_heatmap(uwb_heatmap_collection, None if all_data else cutoff_time)
         
         # Prepare response message
         operation_description = []
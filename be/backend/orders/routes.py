@@ -1,12 +1,11 @@
 # backend/orders/routes.py
 from fastapi import APIRouter, HTTPException, status, Depends, Body
-from pymongo import DESCENDING, collection
+from pymongo import DESCENDING
+from pymongo.asynchronous.collection import AsyncCollection
+import asyncio
 import uuid
 from datetime import datetime
 from typing import List, Optional
-import io
-import qrcode
-import qrcode.image.svg
 import httpx
 
 import hmac
@@ -18,11 +17,13 @@ from ..models import (
     VietQRWebhookPayload,
     VietQRGenerateRequest,
     VietQRTransactionState,
-    VietQRGenerateResponse,
     OrderStatusResponse,
     PurchaseLogEntry,
 )
-from ..database import get_orders_collection, get_purchase_logs_collection
+from ..database import get_orders_collection
+from ..services.log_sink import log_sink
+from ..services.order_commits import order_commit_batcher
+from ..services import vietqr
 from .tasks import process_order
 from ..models import Role
 from .. import auth, config
@@ -31,13 +32,41 @@ router = APIRouter(
     prefix="/api/orders",
     tags=["Orders"]
 )
+
+
+async def generate_remote_qr(order_id: str, amount: int, add_info: str) -> str:
+    """Asks the VietQR generate API for the QR payload (fallback for the local builder)."""
+    vietqr_request_data = VietQRGenerateRequest(
+        acqId=int(config.settings.VIETQR_BANK_BIN),
+        accountNo=config.settings.VIETQR_ACCOUNT_NO,
+        accountName=config.settings.VIETQR_ACCOUNT_NAME,
+        amount=amount,
+        addInfo=add_info,
+        template="compact2"
+    )
+    try:
+        api_response = await vietqr.vietqr_client.generate(vietqr_request_data)
+    except httpx.HTTPError as e:
+        print(f"--- [API] HTTP request to VietQR API failed for order {order_id}: {e} ---")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Could not connect to the payment QR service."
+        )
+    if api_response.code != "00" or not api_response.data:
+        print(f"--- [API] VietQR API error for order {order_id}: {api_response.desc} ---")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Failed to generate QR code: {api_response.desc}"
+        )
+    return api_response.data.qrCode
+
 @router.post('/checkout')
 async def initiate_checkout_and_generate_qr(
     cart_data: CheckoutPayload,
     current_user: auth.TokenData = Depends(auth.role_required([Role.SHOP_CLIENT, Role.GUEST])),
-    orders_collection: collection.Collection = Depends(get_orders_collection),
+    orders_collection: AsyncCollection = Depends(get_orders_collection),
 ):
-    """API endpoint to handle checkout and generate QR code via VietQR API."""
+    """API endpoint to handle checkout and generate the VietQR payment QR code."""
     if not cart_data.items:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cannot checkout with an empty cart")
 
@@ -57,51 +86,29 @@ async def initiate_checkout_and_generate_qr(
         created_at=datetime.utcnow(),
         status=OrderStatus.PENDING
     )
-    orders_collection.insert_one(pending_order.model_dump())
+    await orders_collection.insert_one(pending_order.model_dump())
 
-    # --- Generate VietQR code via external API ---
-    vietqr_request_data = VietQRGenerateRequest(
-        acqId=int(config.settings.VIETQR_BANK_BIN),
-        accountNo=config.settings.VIETQR_ACCOUNT_NO,
-        accountName=config.settings.VIETQR_ACCOUNT_NAME,
-        amount=int(pending_order.total_cost),
-        addInfo=f"Thanh toan don hang {order_id}",
-        template="compact2"
-    )
-
-    qr_svg_string = None
+    # --- Build the VietQR payload locally; the generate API is an optional fallback ---
+    add_info = f"Thanh toan don hang {order_id}"
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.vietqr.io/v2/generate",
-                json=vietqr_request_data.model_dump(),
-                timeout=10.0 # It's good practice to set a timeout
+        qr_code_data = vietqr.build_payload(
+            config.settings.VIETQR_BANK_BIN,
+            config.settings.VIETQR_ACCOUNT_NO,
+            amount=int(pending_order.total_cost),
+            add_info=add_info,
+        )
+    except ValueError as e:
+        if not config.settings.VIETQR_REMOTE_FALLBACK:
+            print(f"--- [API] Could not build VietQR payload for order {order_id}: {e} ---")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"Failed to generate QR code: {e}"
             )
-            response.raise_for_status()
-            api_response = VietQRGenerateResponse.model_validate(response.json())
+        print(f"--- [API] Local VietQR payload failed for order {order_id} ({e}); using the VietQR API ---")
+        qr_code_data = await generate_remote_qr(order_id, int(pending_order.total_cost), add_info)
 
-            if api_response.code != "00" or not api_response.data:
-                print(f"--- [API] VietQR API error for order {order_id}: {api_response.desc} ---")
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=f"Failed to generate QR code: {api_response.desc}"
-                )
-            
-            # The VietQR API gives us the raw data for the QR code.
-            # We can use this to generate our own SVG image.
-            qr_code_data = api_response.data.qrCode
-            
-            # Generate SVG image in memory
-            img = qrcode.make(qr_code_data, image_factory=qrcode.image.svg.SvgPathImage)
-            stream = io.BytesIO()
-            img.save(stream)
-            qr_svg_string = stream.getvalue().decode('utf-8')
-    except httpx.RequestError as e:
-        print(f"--- [API] HTTP request to VietQR API failed for order {order_id}: {e} ---")
-        raise HTTPException(
-            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Could not connect to the payment QR service."
-        )
+    # Rendering is CPU-bound: keep it off the event loop
+    qr_svg_string = await asyncio.to_thread(vietqr.render_svg, qr_code_data)
 
     return {
         "message": "Order created. Please scan the QR code to pay.",
@@ -110,32 +117,32 @@ async def initiate_checkout_and_generate_qr(
     }
 
 @router.get('/history', response_model=List[OrderHistoryItem])
-def get_order_history(
+async def get_order_history(
     current_user: auth.TokenData = Depends(auth.role_required([Role.SHOP_CLIENT, Role.GUEST])),
-    orders_collection: collection.Collection = Depends(get_orders_collection),
+    orders_collection: AsyncCollection = Depends(get_orders_collection),
 ):
     """Retrieves the order history for the currently logged-in user."""
     user_identity = current_user.identity
     try:
-        history = list(orders_collection.find(
+        history = await orders_collection.find(
             {"user_identity": user_identity, "status": {"$ne": OrderStatus.PENDING}},
             {'_id': 0}
-        ).sort("created_at", DESCENDING))
+        ).sort("created_at", DESCENDING).to_list()
         return history
     except Exception as e:
         print(f"Error fetching order history for {user_identity}: {e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred while fetching order history.")
 
 @router.get('/{order_id}/status', response_model=OrderStatusResponse)
-def get_order_status(
+async def get_order_status(
     order_id: str,
-    orders_collection: collection.Collection = Depends(get_orders_collection),
+    orders_collection: AsyncCollection = Depends(get_orders_collection),
 ):
     """
     Allows a client to poll for the payment status of an order without authentication.
     This is a public endpoint.
     """
-    order = orders_collection.find_one(
+    order = await orders_collection.find_one(
         {"order_id": order_id},
         {"_id": 0, "order_id": 1, "status": 1}
     )
@@ -149,8 +156,7 @@ def get_order_status(
 @router.post('/webhook/payment_confirmation')
 async def receive_payment_webhook(
     webhook_payload: VietQRWebhookPayload,
-    orders_collection: collection.Collection = Depends(get_orders_collection),
-    purchase_logs_collection: collection.Collection = Depends(get_purchase_logs_collection),
+    orders_collection: AsyncCollection = Depends(get_orders_collection),
 ):
     """
     Webhook endpoint to receive payment confirmations from VietQR.
@@ -187,10 +193,10 @@ async def receive_payment_webhook(
                 )
                 raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Amount mismatch")
             
-            # Mark order as paid
+            # Mark order as paid; paid_at lets the commit batcher find orders whose hand-off was lost
             await orders_collection.update_one(
                 {"order_id": order_id},
-                {"$set": {"status": OrderStatus.PAID}}
+                {"$set": {"status": OrderStatus.PAID, "paid_at": datetime.utcnow()}}
             )
             
             # Log the purchase
@@ -206,13 +212,18 @@ async def receive_payment_webhook(
                     payment_status="PAID",
                     session_id=getattr(order_obj, 'session_id', None)  # Use session_id from order
                 )
-                await purchase_logs_collection.insert_one(purchase_log_entry.model_dump())
-                print(f"--- [WEBHOOK] Purchase logged for order {order_id} by user {order_obj.user_identity} ---")
+                if await log_sink.emit("purchase_logs", purchase_log_entry.model_dump()):
+                    print(f"--- [WEBHOOK] Purchase logged for order {order_id} by user {order_obj.user_identity} ---")
+                else:
+                    print(f"--- [WEBHOOK] Purchase log dropped for order {order_id}: log sink queue is full ---")
             except Exception as log_error:
                 print(f"Failed to log purchase for order {order_id}: {log_error}")
             
-            # Trigger inventory processing
-            process_order.delay(order_id)
+            # Trigger inventory processing, coalesced with other paid orders when batching is on
+            if order_commit_batcher.enabled:
+                order_commit_batcher.add(order_id)
+            else:
+                process_order.delay(order_id)
             print(f"--- [WEBHOOK] Payment confirmed for order {order_id}. Processing inventory... ---")
             
         elif webhook_payload.state == VietQRTransactionState.FAILED:
@@ -1,27 +1,403 @@
 # backend/orders/tasks.py
 from celery import shared_task
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateMany
+from pymongo.database import Database
+from pymongo.server_type import SERVER_TYPE
 import redis
+import uuid
 from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
 
 from .. import config
 from ..models import OrderHistoryItem, OrderStatus, PurchaseLogEntry
+from ..services.product_cache import bump_catalog_version_sync
+from ..services import catalog_sync as catalog
+from ..services import stock_shards
+from ..database import get_sync_db
 
-# --- Helper function to get a database client within the worker ---
-def get_db_client():
-    return MongoClient(config.MONGO_URI)
+# --- Worker resources ---
+# Tasks share the worker process's pooled MongoDB client (see database.get_sync_db)
+# and one Redis client; both are closed by the worker_process_shutdown signal.
+_redis_client: Optional[redis.Redis] = None
+
+def get_redis_client() -> redis.Redis:
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(config.settings.REDIS_URI)
+    return _redis_client
+
+def close_redis_client():
+    global _redis_client
+    if _redis_client is not None:
+        _redis_client.close()
+        _redis_client = None
+
+def notify_catalog_changed():
+    """Bumps the shared catalog version so API processes drop cached products."""
+    bump_catalog_version_sync(get_redis_client())
+
+# (product id, quantity, name) for one product of an order
+StockLine = Tuple[int, int, str]
+
+class InsufficientStock(Exception):
+    """Aborts an inventory commit; carries the name of the product that was short."""
+
+class OrderNotPaid(Exception):
+    """The order left the 'paid' state before its inventory was committed (e.g. another worker did it)."""
+
+def stock_lines(order: OrderHistoryItem) -> List[StockLine]:
+    """One line per product; repeated cart lines of a product are combined."""
+    lines: Dict[int, list] = {}
+    for item in order.items:
+        line = lines.setdefault(item.id, [item.id, 0, item.name])
+        line[1] += item.quantity
+    return [tuple(line) for line in lines.values()]
+
+def supports_transactions(client: MongoClient) -> bool:
+    """Multi-document transactions need a replica set member or mongos. Call after the client has connected."""
+    return any(
+        server.server_type in (SERVER_TYPE.RSPrimary, SERVER_TYPE.Mongos)
+        for server in client.topology_description.known_servers
+    )
+
+def claim_orders(db: Database, order_ids: List[str]) -> Tuple[str, Set[str]]:
+    """
+    Without transactions nothing else stops two tasks given the same order
+    (a re-dispatch by the batcher's sweep, a redelivery) from both taking its
+    stock, so the fallback paths first move their paid orders to 'processing'
+    under a fresh claim token. The update is atomic per order, so only one
+    task gets each order. Returns the token and the ids this call claimed.
+    A worker that dies after claiming leaves the order 'processing'; it is
+    not re-dispatched, since part of its stock may already be taken.
+    """
+    claim = uuid.uuid4().hex
+    db["order_history"].update_many(
+        {"order_id": {"$in": list(order_ids)}, "status": OrderStatus.PAID},
+        {"$set": {"status": OrderStatus.PROCESSING, "claim": claim}}
+    )
+    claimed = {doc["order_id"] for doc in db["order_history"].find(
+        {"order_id": {"$in": list(order_ids)}, "claim": claim}, {"order_id": 1}
+    )}
+    return claim, claimed
+
+def _held(claim: Optional[str]) -> dict:
+    """Filter matching orders still waiting for this commit: claimed by it, or still paid on the transactional paths."""
+    return {"status": OrderStatus.PROCESSING, "claim": claim} if claim else {"status": OrderStatus.PAID}
+
+def _decrement_in_session(db: Database, decrements: List[Tuple[int, int, int]], session) -> bool:
+    """
+    Guarded decrements of (product id, quantity, version) inside a transaction:
+    one ordered bulk write for plain products, sub-counters for sharded ones
+    (see services.stock_shards). Returns False as soon as one is short.
+    """
+    sharded = stock_shards.shard_counts_sync(db, [product_id for product_id, _, _ in decrements], session=session)
+    plain = [stock_shards.unsharded_decrement(product_id, quantity, version)
+             for product_id, quantity, version in decrements if product_id not in sharded]
+    if plain and db["products"].bulk_write(plain, ordered=True, session=session).matched_count < len(plain):
+        return False
+    return all(
+        stock_shards.take_sync(db, product_id, quantity, version, sharded[product_id], session=session)
+        for product_id, quantity, version in decrements if product_id in sharded
+    )
+
+def commit_inventory_in_transaction(db: Database, order_id: str, lines: List[StockLine], first_version: int):
+    """
+    Completes the order, decrements every product's stock and journals the
+    changes in one transaction: either all of it commits or none of it does,
+    and other orders never see partly reserved stock. Orders competing for a
+    product conflict and are retried by with_transaction.
+    Raises InsufficientStock or OrderNotPaid after aborting.
+    """
+    def commit(session):
+        claimed = db["order_history"].update_one(
+            {"order_id": order_id, "status": OrderStatus.PAID},
+            {"$set": {"status": OrderStatus.COMPLETED}},
+            session=session
+        )
+        if claimed.matched_count == 0:
+            raise OrderNotPaid(order_id)
+        if not _decrement_in_session(
+            db, [(product_id, quantity, first_version + index) for index, (product_id, quantity, _) in enumerate(lines)], session
+        ):
+            raise InsufficientStock()
+        catalog.record_changes_sync(
+            db["catalog_changes"],
+            [(first_version + index, product_id, catalog.OP_UPSERT) for index, (product_id, _, _) in enumerate(lines)],
+            session=session
+        )
+
+    try:
+        with db.client.start_session() as session:
+            session.with_transaction(commit)
+    except InsufficientStock:
+        # Aborted, so this reads stock without this order's decrements
+        stock = stock_shards.stock_on_hand_sync(db, [line[0] for line in lines])
+        raise InsufficientStock(next(
+            (name for product_id, quantity, name in lines if stock.get(product_id, 0) < quantity), lines[0][2]
+        ))
+
+def commit_inventory_item_by_item(db: Database, order_id: str, lines: List[StockLine], first_version: int):
+    """
+    Fallback for servers without transactions: claims the order, then guarded
+    decrements one product at a time; if one is short, the ones already made
+    are given back. Raises OrderNotPaid if another task has the order, and
+    InsufficientStock after rolling back and failing the order.
+    """
+    claim, claimed = claim_orders(db, [order_id])
+    if not claimed:
+        raise OrderNotPaid(order_id)
+    changes_collection = db["catalog_changes"]
+    sharded = stock_shards.shard_counts_sync(db, [line[0] for line in lines])
+    for index, (product_id, quantity, name) in enumerate(lines):
+        if not stock_shards.take_sync(db, product_id, quantity, first_version + index, sharded.get(product_id, 0)):
+            reserved = lines[:index]
+            changes = [(first_version + position, line[0], catalog.OP_UPSERT) for position, line in enumerate(reserved)]
+            # Versions reserved for products that were not changed
+            changes += [(first_version + unused, lines[unused][0], catalog.OP_NOOP) for unused in range(index, len(lines))]
+            if reserved:
+                rollback_version = catalog.reserve_versions_sync(db["counters"], len(reserved))
+                for offset, line in enumerate(reserved):
+                    stock_shards.give_back_sync(db, line[0], line[1], rollback_version + offset, sharded.get(line[0], 0))
+                changes += [(rollback_version + offset, line[0], catalog.OP_UPSERT) for offset, line in enumerate(reserved)]
+            catalog.record_changes_sync(changes_collection, changes)
+            if reserved:
+                notify_catalog_changed()
+            db["order_history"].update_one({"order_id": order_id, **_held(claim)}, {"$set": {"status": OrderStatus.FAILED}})
+            raise InsufficientStock(name)
+        print(f"--- [CELERY WORKER] Reserved {quantity} of '{name}' (ID: {product_id}).")
+
+    db["order_history"].update_one({"order_id": order_id, **_held(claim)}, {"$set": {"status": OrderStatus.COMPLETED}})
+    catalog.record_changes_sync(
+        changes_collection,
+        [(first_version + index, product_id, catalog.OP_UPSERT) for index, (product_id, _, _) in enumerate(lines)]
+    )
+
+def commit_inventory(db: Database, order: OrderHistoryItem) -> Optional[str]:
+    """
+    Decrements stock for a paid order and marks it completed. Returns None on
+    success or the name of the product that was short, in which case no stock
+    changed and the order is marked failed.
+    """
+    lines = stock_lines(order)
+    # One catalog version per product; carts pick the changes up through /api/products/sync
+    first_version = catalog.reserve_versions_sync(db["counters"], len(lines))
+    transactional = config.settings.ORDER_INVENTORY_TRANSACTIONS and supports_transactions(db.client)
+    try:
+        if transactional:
+            commit_inventory_in_transaction(db, order.order_id, lines, first_version)
+        else:
+            commit_inventory_item_by_item(db, order.order_id, lines, first_version)
+    except InsufficientStock as short:
+        if transactional:
+            # The aborted transaction left the order paid and journaled nothing
+            db["order_history"].update_one(
+                {"order_id": order.order_id, "status": OrderStatus.PAID}, {"$set": {"status": OrderStatus.FAILED}}
+            )
+            catalog.record_changes_sync(
+                db["catalog_changes"],
+                [(first_version + index, line[0], catalog.OP_NOOP) for index, line in enumerate(lines)]
+            )
+        return str(short)
+    except OrderNotPaid:
+        catalog.record_changes_sync(
+            db["catalog_changes"],
+            [(first_version + index, line[0], catalog.OP_NOOP) for index, line in enumerate(lines)]
+        )
+        raise
+    # Stock changed: cached products in the API processes are now stale
+    notify_catalog_changed()
+    return None
+
+def allocate(orders: List[OrderHistoryItem], stock: Dict[int, int]) -> Tuple[List[OrderHistoryItem], Dict[str, str]]:
+    """
+    Fills orders first come, first served from `stock` (product id -> quantity
+    on hand). An order gets all of its items or none, so an order only fails
+    when its own items can't be filled from what the earlier ones left.
+    Returns the filled orders and, per failed order id, the short product's name.
+    """
+    remaining = dict(stock)
+    filled, failed = [], {}
+    for order in orders:
+        lines = stock_lines(order)
+        short = next((name for product_id, quantity, name in lines if remaining.get(product_id, 0) < quantity), None)
+        if short is not None:
+            failed[order.order_id] = short
+            continue
+        for product_id, quantity, _ in lines:
+            remaining[product_id] -= quantity
+        filled.append(order)
+    return filled, failed
+
+def batch_totals(orders: List[OrderHistoryItem]) -> Dict[int, int]:
+    """Quantity per product over all the orders."""
+    totals: Dict[int, int] = {}
+    for order in orders:
+        for product_id, quantity, _ in stock_lines(order):
+            totals[product_id] = totals.get(product_id, 0) + quantity
+    return totals
+
+def _settle_orders(
+    db: Database, completed: List[OrderHistoryItem], failed: Dict[str, str], session=None, claim: Optional[str] = None
+):
+    """Completes and fails the batch's orders in one bulk write; only orders still held for this commit change."""
+    operations = []
+    if completed:
+        operations.append(UpdateMany(
+            {"order_id": {"$in": [order.order_id for order in completed]}, **_held(claim)},
+            {"$set": {"status": OrderStatus.COMPLETED}}
+        ))
+    if failed:
+        operations.append(UpdateMany(
+            {"order_id": {"$in": list(failed)}, **_held(claim)},
+            {"$set": {"status": OrderStatus.FAILED}}
+        ))
+    if operations:
+        db["order_history"].bulk_write(operations, ordered=False, session=session)
+
+def commit_batch_in_transaction(
+    db: Database, orders: List[OrderHistoryItem], versions: Dict[int, int]
+) -> Tuple[List[OrderHistoryItem], Dict[str, str]]:
+    """
+    Allocates stock to the orders that are still paid, applies one guarded
+    decrement per product for the whole batch, settles every order and
+    journals the changed products in one transaction. Reading the orders and
+    stock inside the transaction means a conflicting writer aborts and
+    with_transaction retries with fresh data. Returns (completed, failed).
+    """
+    outcome = {}
+
+    def commit(session):
+        still_paid = {doc["order_id"] for doc in db["order_history"].find(
+            {"order_id": {"$in": [order.order_id for order in orders]}, "status": OrderStatus.PAID},
+            {"order_id": 1}, session=session
+        )}
+        paid = [order for order in orders if order.order_id in still_paid]
+        filled, failed = allocate(paid, stock_shards.stock_on_hand_sync(db, versions, session=session))
+        totals = batch_totals(filled)
+        # The stock was read in this transaction, so every guard holds; if one did not, abort and leave the orders paid
+        if totals and not _decrement_in_session(
+            db, [(product_id, quantity, versions[product_id]) for product_id, quantity in totals.items()], session
+        ):
+            raise InsufficientStock("stock changed during the batch commit")
+        _settle_orders(db, filled, failed, session=session)
+        if totals:
+            catalog.record_changes_sync(
+                db["catalog_changes"],
+                [(versions[product_id], product_id, catalog.OP_UPSERT) for product_id in totals],
+                session=session
+            )
+        outcome["result"] = (filled, failed)
+
+    with db.client.start_session() as session:
+        session.with_transaction(commit)
+    return outcome["result"]
+
+def commit_batch_product_by_product(
+    db: Database, orders: List[OrderHistoryItem], versions: Dict[int, int]
+) -> Tuple[List[OrderHistoryItem], Dict[str, str], List[OrderHistoryItem]]:
+    """
+    Fallback for servers without transactions: claims the orders (see
+    claim_orders), allocates from a stock read, then one guarded decrement
+    per product for the orders it claimed. If another writer took stock in
+    between and a product's decrement no longer fits, the filled orders that
+    need that product give back what they took of the other products, are
+    released to 'paid' again and are returned separately, to be committed one
+    by one. Returns (completed, failed, retry).
+    """
+    claim, claimed = claim_orders(db, [order.order_id for order in orders])
+    orders = [order for order in orders if order.order_id in claimed]
+    filled, failed = allocate(orders, stock_shards.stock_on_hand_sync(db, versions))
+    totals = batch_totals(filled)
+    sharded = stock_shards.shard_counts_sync(db, totals)
+    raced = {
+        product_id for product_id, quantity in totals.items()
+        if not stock_shards.take_sync(db, product_id, quantity, versions[product_id], sharded.get(product_id, 0))
+    }
+    retry = [order for order in filled if any(line[0] in raced for line in stock_lines(order))]
+    completed = [order for order in filled if order not in retry]
+
+    changes = [
+        (version, product_id, catalog.OP_UPSERT if product_id in totals and product_id not in raced else catalog.OP_NOOP)
+        for product_id, version in versions.items()
+    ]
+    returned = {product_id: quantity for product_id, quantity in batch_totals(retry).items() if product_id not in raced}
+    if returned:
+        rollback_version = catalog.reserve_versions_sync(db["counters"], len(returned))
+        for offset, (product_id, quantity) in enumerate(returned.items()):
+            stock_shards.give_back_sync(db, product_id, quantity, rollback_version + offset, sharded.get(product_id, 0))
+        changes += [(rollback_version + offset, product_id, catalog.OP_UPSERT) for offset, product_id in enumerate(returned)]
+    _settle_orders(db, completed, failed, claim=claim)
+    if retry:
+        db["order_history"].update_many(
+            {"order_id": {"$in": [order.order_id for order in retry]}, **_held(claim)},
+            {"$set": {"status": OrderStatus.PAID}}
+        )
+    catalog.record_changes_sync(db["catalog_changes"], changes)
+    return completed, failed, retry
+
+def commit_inventory_batch(db: Database, orders: List[OrderHistoryItem]) -> Tuple[List[OrderHistoryItem], Dict[str, str]]:
+    """
+    Commits the inventory of several paid orders together, in the given order
+    of priority: each product is written once for the whole batch instead of
+    once per order, and an order fails only when its own items can't be
+    filled. Returns the completed orders and, per failed order id, the name of
+    the product that was short. Orders no longer paid are left out of both.
+    """
+    product_ids = sorted(batch_totals(orders))
+    first_version = catalog.reserve_versions_sync(db["counters"], len(product_ids))
+    versions = {product_id: first_version + index for index, product_id in enumerate(product_ids)}
+    retry: List[OrderHistoryItem] = []
+    if config.settings.ORDER_INVENTORY_TRANSACTIONS and supports_transactions(db.client):
+        try:
+            completed, failed = commit_batch_in_transaction(db, orders, versions)
+        except Exception:
+            catalog.record_changes_sync(
+                db["catalog_changes"], [(version, product_id, catalog.OP_NOOP) for product_id, version in versions.items()]
+            )
+            raise
+        changed = batch_totals(completed)
+        unused = [(version, product_id, catalog.OP_NOOP) for product_id, version in versions.items() if product_id not in changed]
+        if unused:
+            catalog.record_changes_sync(db["catalog_changes"], unused)
+    else:
+        completed, failed, retry = commit_batch_product_by_product(db, orders, versions)
+    if completed or retry:
+        notify_catalog_changed()
+
+    for order in retry:
+        try:
+            short = commit_inventory(db, order)
+        except OrderNotPaid:
+            continue
+        if short is None:
+            completed.append(order)
+        else:
+            failed[order.order_id] = short
+    return completed, failed
+
+def completion_log_entry(order: OrderHistoryItem) -> PurchaseLogEntry:
+    return PurchaseLogEntry(
+        user_identity=order.user_identity,
+        order_id=order.order_id,
+        items=order.items,
+        subtotal=order.subtotal,
+        shipping_cost=order.shipping_cost,
+        total_cost=order.total_cost,
+        timestamp=datetime.utcnow(),
+        payment_status="COMPLETED",
+        session_id=None
+    )
 
 @shared_task(bind=True)
 def process_order(self, order_id: str):
     """
     Processes a paid order by decrementing stock quantities in the database.
-    This task is designed to be transactional and safe for concurrency.
+    Stock and order status are committed together (see commit_inventory), so
+    concurrent orders never oversell and a short item leaves stock untouched.
     """
     print(f"\n--- [CELERY WORKER] PROCESSING INVENTORY FOR ORDER {order_id} ---")
     
-    client = get_db_client()
-    db = client["shopping_cart_db"]
-    products_collection = db["products"]
+    db = get_sync_db()
     order_history_collection = db["order_history"]
     purchase_logs_collection = db["purchase_logs"]
     
@@ -32,47 +408,61 @@ def process_order(self, order_id: str):
 
     order = OrderHistoryItem.model_validate(order_data)
 
-    updates_to_perform = []
-    for item in order.items:
-        result = products_collection.update_one(
-            {"id": item.id, "quantity": {"$gte": item.quantity}},
-            {"$inc": {"quantity": -item.quantity}}
-        )
-        
-        if result.matched_count == 0:
-            print(f"--- [CELERY WORKER] FAILED: Insufficient stock for product ID {item.id}. Rolling back and marking order as failed. ---")
-            order_history_collection.update_one({"order_id": order_id}, {"$set": {"status": OrderStatus.FAILED}})
-            for u_item in updates_to_perform:
-                products_collection.update_one(
-                    {"id": u_item.id},
-                    {"$inc": {"quantity": u_item.quantity}}
-                )
-            return {"status": "failure", "message": f"Insufficient stock for {item.name}."}
-        
-        updates_to_perform.append(item)
-        print(f"--- [CELERY WORKER] Reserved {item.quantity} of '{item.name}' (ID: {item.id}).")
-
-    # If all items are reserved, mark the order as completed
-    order_history_collection.update_one({"order_id": order_id}, {"$set": {"status": OrderStatus.COMPLETED}})
+    try:
+        short = commit_inventory(db, order)
+    except OrderNotPaid:
+        print(f"--- [CELERY WORKER] Order {order_id} is no longer 'paid'; already processed. ---")
+        return {"status": "failure", "message": "Order not found or not paid."}
+    if short is not None:
+        print(f"--- [CELERY WORKER] FAILED: Insufficient stock for '{short}'. Order {order_id} marked as failed, no stock changed. ---")
+        return {"status": "failure", "message": f"Insufficient stock for {short}."}
 
     # Log the completion status update
     try:
-        purchase_log_entry = PurchaseLogEntry(
-            user_identity=order.user_identity,
-            order_id=order_id,
-            items=order.items,
-            subtotal=order.subtotal,
-            shipping_cost=order.shipping_cost,
-            total_cost=order.total_cost,
-            timestamp=datetime.utcnow(),
-            payment_status="COMPLETED",
-            session_id=None
-        )
-        purchase_logs_collection.insert_one(purchase_log_entry.model_dump())
+        purchase_logs_collection.insert_one(completion_log_entry(order).model_dump())
         print(f"--- [CELERY WORKER] Order completion logged for order {order_id} ---")
     except Exception as log_error:
         print(f"Failed to log order completion for {order_id}: {log_error}")
 
-    client.close()
     print(f"--- [CELERY WORKER] INVENTORY FOR ORDER {order_id} PROCESSED SUCCESSFULLY ---\n")
-    return {"status": "success", "message": "Inventory updated and order completed."}
\ No newline at end of file
+    return {"status": "success", "message": "Inventory updated and order completed."}
+
+
+@shared_task(bind=True)
+def process_order_batch(self, order_ids: List[str]):
+    """
+    Processes several paid orders at once, collected by the API's
+    OrderCommitBatcher: stock is decremented once per product for the whole
+    batch (see commit_inventory_batch) and each order completes or fails on
+    its own. Earlier orders in the list are served first.
+    """
+    print(f"\n--- [CELERY WORKER] PROCESSING INVENTORY FOR {len(order_ids)} ORDERS ---")
+
+    db = get_sync_db()
+    position = {order_id: index for index, order_id in reversed(list(enumerate(order_ids)))}
+    orders = sorted(
+        (OrderHistoryItem.model_validate(order_data) for order_data in db["order_history"].find(
+            {"order_id": {"$in": list(position)}, "status": OrderStatus.PAID}
+        )),
+        key=lambda order: position[order.order_id]
+    )
+    if not orders:
+        print("--- [CELERY WORKER] No order of the batch is in 'paid' state. Aborting. ---")
+        return {"status": "failure", "message": "No order of the batch is paid."}
+
+    completed, failed = commit_inventory_batch(db, orders)
+    for order_id, short in failed.items():
+        print(f"--- [CELERY WORKER] FAILED: Insufficient stock for '{short}'. Order {order_id} marked as failed. ---")
+
+    if completed:
+        try:
+            db["purchase_logs"].insert_many([completion_log_entry(order).model_dump() for order in completed])
+        except Exception as log_error:
+            print(f"Failed to log order completion for {len(completed)} orders: {log_error}")
+
+    print(f"--- [CELERY WORKER] BATCH PROCESSED: {len(completed)} completed, {len(failed)} failed ---\n")
+    return {
+        "status": "success",
+        "completed": [order.order_id for order in completed],
+        "failed": failed,
+    }
@@ -1,12 +1,21 @@
 # backend/products/routes.py
-from fastapi import APIRouter, HTTPException, status, Depends
-from pymongo import DESCENDING, collection
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request
+from fastapi.responses import Response
+from pymongo import DESCENDING
+from pymongo.asynchronous.collection import AsyncCollection
 from typing import List
 from fastapi_cache.decorator import cache
 
-from ..database import get_products_collection
+from ..database import get_products_collection, get_counters_collection, get_catalog_changes_collection, product_name_key
 from ..models import Product, ProductCreate, ProductUpdate
 from ..models import Role
+from ..services.product_cache import product_cache
+from ..services.cache_tags import CATALOG_TAG, tagged_key_builder
+from ..services import catalog_sync as catalog
+from ..services.catalog_sync import catalog_sync
+from ..services.product_search import product_search
+from ..services import stock_shards
+from ..config import settings
 from .. import auth
 
 router = APIRouter(
@@ -14,51 +23,122 @@ router = APIRouter(
     tags=["Products"]
 )
 
-def get_next_product_id(products_collection: collection.Collection):
+async def get_next_product_id(products_collection: AsyncCollection):
     """
     Finds the highest product 'id' and returns the next integer.
     NOTE: In a highly concurrent production environment, a more robust solution like
     a dedicated 'counters' collection with atomic increments should be used.
     """
-    last_product = products_collection.find_one(sort=[("id", DESCENDING)])
+    last_product = await products_collection.find_one(sort=[("id", DESCENDING)])
     if last_product and 'id' in last_product:
         return last_product['id'] + 1
     return 1 # Start from 1 if collection is empty
 
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in tags)
+
 @router.get('', response_model=List[Product])
-@cache(expire=60)
+@cache(expire=settings.PRODUCT_LIST_CACHE_TTL_SECONDS, key_builder=tagged_key_builder(CATALOG_TAG))
 async def get_products(
-    products_collection: collection.Collection = Depends(get_products_collection),
+    products_collection: AsyncCollection = Depends(get_products_collection),
 ):
     """API endpoint to get all available products."""
     print("--- [DATABASE HIT] Fetching products from MongoDB ---")
-    return list(products_collection.find({}, {'_id': 0}))
+    products = await products_collection.find({}, {'_id': 0}).to_list()
+    await stock_shards.sum_into(products, products_collection)
+    return products
 
 @router.post('', status_code=status.HTTP_201_CREATED, response_model=Product)
 async def create_product(
     product_to_create: ProductCreate,
     current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
-    products_collection: collection.Collection = Depends(get_products_collection),
+    products_collection: AsyncCollection = Depends(get_products_collection),
+    counters_collection: AsyncCollection = Depends(get_counters_collection),
+    changes_collection: AsyncCollection = Depends(get_catalog_changes_collection),
 ):
     """Creates a new product in the database."""
     new_product_doc = product_to_create.model_dump()
-    new_product_doc['id'] = get_next_product_id(products_collection)
+    location = new_product_doc.pop('location')
+    new_product_doc['id'] = await get_next_product_id(products_collection)
     new_product = Product.model_validate(new_product_doc)
-    products_collection.insert_one(new_product.model_dump())
-    
-    # In FastAPI, cache invalidation is often handled differently,
-    # e.g., via a separate endpoint or event system. For simplicity, we'll skip explicit clearing.
-    # await FastAPICache.clear(namespace="fastapi-cache") # This would clear everything
-    print("--- Product created. Cache will expire naturally. ---")
+    stored_doc = new_product.model_dump()
+    if location is not None:
+        stored_doc['location'] = location
+    version = await catalog.reserve_versions(counters_collection)
+    await products_collection.insert_one({
+        **stored_doc,
+        "name_key": product_name_key(new_product.name),
+        "catalog_version": version,
+    })
+    await catalog.record_changes(changes_collection, [(version, new_product.id, catalog.OP_UPSERT)])
+    await product_cache.bump_version()
+    product_search.upsert(stored_doc)
+    print("--- Product created. Catalog cache invalidated. ---")
     return new_product
 
+@router.get('/cache/stats')
+async def get_product_cache_stats(
+    current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
+):
+    """Hit/miss counters of the in-process product lookup cache. Admin only."""
+    return product_cache.stats()
+
+@router.get('/sync')
+async def sync_products(
+    since: int = Query(0, ge=0, description="Catalog version the cart already has; 0 for a full copy."),
+    products_collection: AsyncCollection = Depends(get_products_collection),
+    changes_collection: AsyncCollection = Depends(get_catalog_changes_collection),
+):
+    """
+    Delta sync for carts keeping a local catalog: returns the products changed
+    and the ids deleted after `since`, plus the version to ask from next time.
+    """
+    try:
+        return await catalog_sync.changes_since(since, products_collection, changes_collection)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to sync catalog: {str(e)}")
+
+@router.get('/snapshot')
+async def get_catalog_snapshot(
+    request: Request,
+    products_collection: AsyncCollection = Depends(get_products_collection),
+    changes_collection: AsyncCollection = Depends(get_catalog_changes_collection),
+):
+    """
+    The full catalog as gzip-compressed JSON, tagged with the catalog version.
+    Carts send If-None-Match and get an empty 304 while nothing changed.
+    """
+    try:
+        snapshot = await catalog_sync.snapshot(products_collection, changes_collection)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to build catalog snapshot: {str(e)}")
+
+    headers = {
+        "ETag": snapshot["etag"],
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+        "X-Catalog-Version": str(snapshot["version"]),
+    }
+    if etag_matches(request.headers.get("if-none-match"), snapshot["etag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=snapshot["gzip_body"], media_type="application/json", headers=headers)
+    return Response(content=snapshot["body"], media_type="application/json", headers=headers)
+
 @router.get('/{product_id}', response_model=Product)
 async def get_product(
     product_id: int,
-    products_collection: collection.Collection = Depends(get_products_collection),
+    products_collection: AsyncCollection = Depends(get_products_collection),
 ):
     """Retrieves a single product by its ID."""
-    product = products_collection.find_one({"id": product_id}, {'_id': 0})
+    product = await product_cache.get_by_id(product_id, products_collection)
     if product:
         return product
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
@@ -66,10 +146,10 @@ async def get_product(
 @router.get('/barcode/{barcode}', response_model=Product)
 async def get_product_by_barcode(
     barcode: str,
-    products_collection: collection.Collection = Depends(get_products_collection),
+    products_collection: AsyncCollection = Depends(get_products_collection),
 ):
     """Retrieves a single product by its barcode."""
-    product = products_collection.find_one({"barcode": barcode}, {'_id': 0})
+    product = await product_cache.get_by_barcode(barcode, products_collection)
     if product:
         return product
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found by barcode")
@@ -79,7 +159,9 @@ async def update_product(
     product_id: int,
     update_data: ProductUpdate,
     current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
-    products_collection: collection.Collection = Depends(get_products_collection),
+    products_collection: AsyncCollection = Depends(get_products_collection),
+    counters_collection: AsyncCollection = Depends(get_counters_collection),
+    changes_collection: AsyncCollection = Depends(get_catalog_changes_collection),
 ):
     """Updates an existing product."""
     update_fields = update_data.model_dump(exclude_unset=True)
@@ -87,25 +169,53 @@ async def update_product(
     if not update_fields:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No update fields provided")
         
-    result = products_collection.update_one({"id": product_id}, {"$set": update_fields})
+    if "name" in update_fields:
+        update_fields["name_key"] = product_name_key(update_fields["name"])
+    if "quantity" in update_fields:
+        # A sharded product keeps its stock in sub-counters
+        sharded = await products_collection.find_one(
+            {"id": product_id, stock_shards.SHARD_COUNT_FIELD: {"$gt": 0}}, {stock_shards.SHARD_COUNT_FIELD: 1}
+        )
+        if sharded:
+            await stock_shards.set_quantity(
+                products_collection, product_id, sharded[stock_shards.SHARD_COUNT_FIELD], update_fields["quantity"]
+            )
+            update_fields["quantity"] = 0
+    version = await catalog.reserve_versions(counters_collection)
+    result = await products_collection.update_one(
+        {"id": product_id}, {"$set": {**update_fields, "catalog_version": version}}
+    )
+    op = catalog.OP_UPSERT if result.matched_count else catalog.OP_NOOP
+    await catalog.record_changes(changes_collection, [(version, product_id, op)])
     
     if result.matched_count == 0:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    await product_cache.bump_version()
         
-    print("--- Product updated. Cache will expire naturally. ---")
-    updated_product = products_collection.find_one({"id": product_id}, {'_id': 0})
+    print("--- Product updated. Catalog cache invalidated. ---")
+    updated_product = await products_collection.find_one({"id": product_id}, {'_id': 0})
+    if updated_product:
+        await stock_shards.sum_into([updated_product], products_collection)
+        product_search.upsert(updated_product)
     return updated_product
 
 @router.delete('/{product_id}', status_code=status.HTTP_204_NO_CONTENT)
 async def delete_product(
     product_id: int,
     current_user: auth.TokenData = Depends(auth.role_required([Role.ADMIN])),
-    products_collection: collection.Collection = Depends(get_products_collection),
+    products_collection: AsyncCollection = Depends(get_products_collection),
+    counters_collection: AsyncCollection = Depends(get_counters_collection),
+    changes_collection: AsyncCollection = Depends(get_catalog_changes_collection),
 ):
     """Deletes a product from the database."""
-    result = products_collection.delete_one({"id": product_id})
+    version = await catalog.reserve_versions(counters_collection)
+    result = await products_collection.delete_one({"id": product_id})
+    op = catalog.OP_DELETE if result.deleted_count else catalog.OP_NOOP
+    await catalog.record_changes(changes_collection, [(version, product_id, op)])
     if result.deleted_count == 0:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    await product_cache.bump_version()
+    product_search.remove(product_id)
     
-    print("--- Product deleted. Cache will expire naturally. ---")
+    print("--- Product deleted. Catalog cache invalidated. ---")
     return
\ No newline at end of file
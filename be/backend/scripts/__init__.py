@@ -0,0 +1 @@
+# backend/scripts/__init__.py
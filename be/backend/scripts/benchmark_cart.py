@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Stress test for cart operations: the old read-modify-write flow (read the
+cart, scan items in Python, update, read again to sum) against the single
+atomic find_one_and_update used by /api/cart/op.
+
+Usage:
+    python -m backend.scripts.benchmark_cart [--carts 20] [--scans 200] [--concurrency 64] [--keep]
+
+Every cart receives the same burst of concurrent scans spread over a few
+barcodes (the same item is scanned at once on purpose). The report shows
+latency percentiles and how many items were lost or duplicated compared
+with what was scanned.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from pymongo import AsyncMongoClient
+
+from ..config import settings
+from ..cart.routes import add_to_cart
+
+CARTS = "bench_carts"
+BARCODES = ["8930000000011", "8930000000028", "8930000000035", "8930000000042"]
+
+
+async def legacy_add(carts, user_identity: str, product: dict, quantity: int) -> int:
+    """The previous /api/cart/op add path."""
+    user_cart = await carts.find_one({"user_identity": user_identity}) or {"items": []}
+    cart_item = next((item for item in user_cart.get("items", []) if item.get("barcode") == product["barcode"]), None)
+    if cart_item:
+        await carts.update_one(
+            {"user_identity": user_identity, "items.barcode": product["barcode"]},
+            {"$inc": {"items.$.quantity": quantity}},
+        )
+    else:
+        new_item = {"barcode": product["barcode"], "name": product["name"], "price": product["price"], "quantity": quantity}
+        await carts.update_one({"user_identity": user_identity}, {"$push": {"items": new_item}}, upsert=True)
+    updated_cart = await carts.find_one({"user_identity": user_identity})
+    return sum(item.get("quantity", 0) for item in updated_cart.get("items", []))
+
+
+async def atomic_add(carts, user_identity: str, product: dict, quantity: int) -> int:
+    return (await add_to_cart(carts, user_identity, product, quantity))["total_items"]
+
+
+async def run(label: str, add, carts, scans, concurrency: int) -> None:
+    await carts.delete_many({})
+    semaphore = asyncio.Semaphore(concurrency)
+    samples, errors = [], []
+
+    async def scan(user_identity, product):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await add(carts, user_identity, product, 1)
+            except Exception as e:
+                errors.append(e)
+            samples.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(scan(user_identity, product) for user_identity, product in scans))
+    elapsed = time.perf_counter() - started
+
+    expected = {}
+    for user_identity, product in scans:
+        expected[(user_identity, product["barcode"])] = expected.get((user_identity, product["barcode"]), 0) + 1
+    stored, lines, documents = {}, 0, 0
+    async for cart in carts.find({}):
+        documents += 1
+        for item in cart.get("items", []):
+            lines += 1
+            key = (cart["user_identity"], item["barcode"])
+            stored[key] = stored.get(key, 0) + item["quantity"]
+    lost = sum(max(0, count - stored.get(key, 0)) for key, count in expected.items())
+    extra = sum(max(0, count - expected.get(key, 0)) for key, count in stored.items())
+
+    samples.sort()
+    print(
+        f"  {label:<7} {len(scans) / elapsed:7.0f} ops/s  p50={statistics.median(samples):.2f}ms "
+        f"p99={samples[min(len(samples) - 1, int(len(samples) * 0.99))]:.2f}ms | "
+        f"errors={len(errors)} lost={lost} duplicated={extra} cart docs={documents} (expected {len({u for u, _ in scans})}) "
+        f"lines={lines} (expected {len(expected)})"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Stress test legacy vs atomic cart operations.")
+    parser.add_argument("--carts", type=int, default=20)
+    parser.add_argument("--scans", type=int, default=200, help="Scans per cart")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark collection afterwards")
+    args = parser.parse_args()
+
+    random.seed(42)
+    products = [{"barcode": barcode, "name": f"Product {i}", "price": 10000 * (i + 1)} for i, barcode in enumerate(BARCODES)]
+    scans = [(f"bench-user-{cart}", random.choice(products)) for cart in range(args.carts) for _ in range(args.scans)]
+    random.shuffle(scans)
+
+    client = AsyncMongoClient(settings.MONGO_URI)
+    db = client[settings.MONGO_DB_NAME]
+    try:
+        await db.drop_collection(CARTS)
+        carts = db[CARTS]
+        await carts.create_index("user_identity", unique=True)
+        print(f"{len(scans)} scans over {args.carts} carts, {args.concurrency} at a time")
+        await run("legacy", legacy_add, carts, scans, args.concurrency)
+        await run("atomic", atomic_add, carts, scans, args.concurrency)
+    finally:
+        if not args.keep:
+            await db.drop_collection(CARTS)
+        await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Compares /api/map/search served by MongoDB ($text with a $regex fallback, the
+old path) against the in-memory product search index.
+
+Usage:
+    python -m backend.scripts.benchmark_search [--products 5000] [--repeat 20] [--keep]
+
+Both paths get the same synthetic Vietnamese catalog. Queries cover full
+names, autocomplete prefixes, accent-free input and typos; the report shows
+latency and how often the intended product is among the 20 suggestions.
+"""
+import argparse
+import random
+import statistics
+import time
+
+from pymongo import MongoClient
+
+from ..config import settings
+from ..services.product_search import ProductSearchIndex, fold
+
+PRODUCTS = "bench_search_products"
+
+KINDS = ["Sữa tươi", "Sữa đậu nành", "Nước mắm", "Bánh mì", "Cà phê", "Trà xanh", "Gạo thơm", "Mì gói",
+         "Dầu ăn", "Nước ngọt", "Bột giặt", "Kem đánh răng", "Xúc xích", "Đường cát", "Bánh quy", "Phô mai"]
+BRANDS = ["Vinamilk", "TH True", "Nam Ngư", "Trung Nguyên", "Hảo Hảo", "Neptune", "Omo", "Đức Việt",
+          "Cosy", "Ông Thọ", "Lavie", "Highlands", "Acecook", "Meizan", "Chinsu", "Dalat Milk"]
+VARIANTS = ["ít đường", "không đường", "hương dâu", "vị cay", "đặc biệt", "gia đình", "cao cấp", "hữu cơ"]
+SIZES = ["180ml", "500ml", "1L", "250g", "500g", "1kg", "5kg", "gói 75g"]
+
+
+def generate_names(count: int):
+    names = set()
+    while len(names) < count:
+        names.add(f"{random.choice(KINDS)} {random.choice(BRANDS)} {random.choice(VARIANTS)} {random.choice(SIZES)}")
+    return sorted(names)
+
+
+def make_queries(names, count: int):
+    """Returns (label, query, intended name) triples; each query identifies one product."""
+    queries = []
+    for name in random.sample(names, count):
+        typo = list(name)
+        i = random.randrange(1, len(typo) - 2)
+        typo[i], typo[i + 1] = typo[i + 1], typo[i]
+        queries += [
+            ("full name", name, name),
+            ("prefix", name[:-2], name),
+            ("no accents", fold(name), name),
+            ("typo", "".join(typo), name),
+        ]
+    return queries
+
+
+def mongo_search(coll, q: str):
+    names = [doc["name"] for doc in coll.find({"$text": {"$search": q}}, {"name": 1, "_id": 0})]
+    if not names:
+        names = [doc["name"] for doc in coll.find({"name": {"$regex": q, "$options": "i"}}, {"name": 1, "_id": 0})]
+    return names[:20]
+
+
+def timed(fn, queries, repeat: int) -> dict:
+    samples, found = [], {}
+    for _ in range(repeat):
+        for label, q, intended in queries:
+            started = time.perf_counter()
+            names = fn(q)
+            samples.append((time.perf_counter() - started) * 1000)
+            found.setdefault(label, []).append(intended in names)
+    samples.sort()
+    return {
+        "p50_ms": statistics.median(samples),
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "found": {label: sum(hits) / len(hits) for label, hits in found.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MongoDB vs in-memory product search.")
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark collection afterwards")
+    args = parser.parse_args()
+
+    random.seed(42)
+    names = generate_names(args.products)
+    queries = make_queries(names, args.queries)
+    products = [{"id": i + 1, "name": name} for i, name in enumerate(names)]
+
+    client = MongoClient(settings.MONGO_URI)
+    db = client[settings.MONGO_DB_NAME]
+    try:
+        print(f"Loading {len(products)} products...")
+        db.drop_collection(PRODUCTS)
+        coll = db[PRODUCTS]
+        coll.insert_many([dict(p) for p in products])
+        coll.create_index([("name", "text")])
+
+        started = time.perf_counter()
+        index = ProductSearchIndex(
+            min_similarity=settings.PRODUCT_SEARCH_MIN_SIMILARITY,
+            refresh_interval_seconds=settings.PRODUCT_SEARCH_REFRESH_SECONDS,
+        )
+        index.load(products)
+        print(f"Index built in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+        print(f"\n{len(queries)} queries x {args.repeat} runs")
+        for label, fn in (("mongo", lambda q: mongo_search(coll, q)), ("memory", lambda q: index.search(q, 20))):
+            result = timed(fn, queries, args.repeat)
+            found = " ".join(f"{kind}={share:.0%}" for kind, share in result["found"].items())
+            print(f"  {label:<7} p50={result['p50_ms']:.3f}ms p95={result['p95_ms']:.3f}ms | found: {found}")
+    finally:
+        if not args.keep:
+            db.drop_collection(PRODUCTS)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Compares storage size and query latency of the telemetry data as a plain
+collection (the old layout) and as a time-series collection.
+
+Usage:
+    python -m backend.scripts.benchmark_timeseries [--points 200000] [--carts 50] [--repeat 50] [--keep]
+
+Both layouts get the same synthetic UWB samples. The queries mirror
+/api/motion/uwb-locations, /api/motion/logs and /api/motion/stats.
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient, ASCENDING, DESCENDING
+
+from ..config import settings
+from ..database import timeseries_options, to_timeseries_document, timeseries_filter
+
+PLAIN = "bench_uwb_plain"
+TIMESERIES = "bench_uwb_timeseries"
+
+
+def generate_samples(points: int, carts: int, days: int = 7):
+    """Yields random-walk UWB samples for several carts, spread over the last few days."""
+    start = datetime.utcnow() - timedelta(days=days)
+    step = timedelta(seconds=days * 86400 * carts / points)
+    per_cart = points // carts
+    for cart in range(carts):
+        x, y = random.uniform(500, 6500), random.uniform(200, 3000)
+        session = 0
+        for i in range(per_cart):
+            if i % 600 == 0:
+                session += 1
+            x = max(500, min(6500, x + random.uniform(-50, 50)))
+            y = max(200, min(3000, y + random.uniform(-30, 30)))
+            yield {
+                "x": round(x, 1),
+                "y": round(y, 1),
+                "timestamp": start + step * i,
+                "cart_id": f"cart_{cart:03d}",
+                "session_id": f"cart_{cart:03d}_s{session}",
+                "raw_distances": [random.randint(100, 8000) for _ in range(4)],
+                "filtered": True,
+                "tracking_mode": True,
+            }
+
+
+def load(db, points: int, carts: int):
+    db.drop_collection(PLAIN)
+    db.drop_collection(TIMESERIES)
+    db.create_collection(TIMESERIES, **timeseries_options())
+
+    plain, ts = db[PLAIN], db[TIMESERIES]
+    plain.create_index([("timestamp", ASCENDING)])
+    plain.create_index([("cart_id", ASCENDING)])
+    plain.create_index([("session_id", ASCENDING)])
+    ts.create_index([("meta.cart_id", ASCENDING), ("timestamp", ASCENDING)])
+    ts.create_index([("meta.session_id", ASCENDING), ("timestamp", ASCENDING)])
+
+    batch = []
+    for sample in generate_samples(points, carts):
+        batch.append(sample)
+        if len(batch) == 10000:
+            plain.insert_many([dict(doc) for doc in batch], ordered=False)
+            ts.insert_many([to_timeseries_document(doc) for doc in batch], ordered=False)
+            batch = []
+    if batch:
+        plain.insert_many([dict(doc) for doc in batch], ordered=False)
+        ts.insert_many([to_timeseries_document(doc) for doc in batch], ordered=False)
+
+
+def storage(db, name: str) -> dict:
+    stats = next(db[name].aggregate([{"$collStats": {"storageStats": {}}}]))["storageStats"]
+    return {
+        "documents": stats.get("count") or db[name].estimated_document_count(),
+        "data_mb": stats.get("size", 0) / 1e6,
+        "storage_mb": stats.get("storageSize", 0) / 1e6,
+        "index_mb": stats.get("totalIndexSize", 0) / 1e6,
+    }
+
+
+def timed(fn, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": statistics.median(samples),
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    }
+
+
+def run_queries(db, carts: int, repeat: int) -> dict:
+    since = datetime.utcnow() - timedelta(hours=24)
+    results = {}
+    for label, name, to_filter in (
+        ("plain", PLAIN, lambda f: f),
+        ("timeseries", TIMESERIES, timeseries_filter),
+    ):
+        coll = db[name]
+
+        def cart_filter():
+            return to_filter({"timestamp": {"$gte": since}, "cart_id": f"cart_{random.randrange(carts):03d}"})
+
+        results[label] = {
+            "latest_100_for_cart": timed(
+                lambda: list(coll.find(cart_filter(), {"_id": 0}).sort("timestamp", DESCENDING).limit(100)), repeat),
+            "path_10000_for_cart": timed(
+                lambda: list(coll.find(cart_filter(), {"_id": 0}).sort("timestamp", DESCENDING).limit(10000)), repeat),
+            "count_for_cart": timed(lambda: coll.count_documents(cart_filter()), repeat),
+            "stats_group_24h": timed(lambda: list(coll.aggregate([
+                {"$match": {"timestamp": {"$gte": since}}},
+                {"$group": {"_id": "$filtered", "count": {"$sum": 1}, "avg_x": {"$avg": "$x"}}},
+            ])), repeat),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plain vs time-series telemetry storage.")
+    parser.add_argument("--points", type=int, default=200000)
+    parser.add_argument("--carts", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark collections afterwards")
+    args = parser.parse_args()
+
+    random.seed(42)
+    client = MongoClient(settings.MONGO_URI)
+    db = client[settings.MONGO_DB_NAME]
+    try:
+        print(f"Loading {args.points} samples for {args.carts} carts...")
+        load(db, args.points, args.carts)
+
+        print("\nStorage")
+        for label, name in (("plain", PLAIN), ("timeseries", TIMESERIES)):
+            s = storage(db, name)
+            print(f"  {label:<11} data={s['data_mb']:.1f}MB storage={s['storage_mb']:.1f}MB indexes={s['index_mb']:.1f}MB")
+
+        print(f"\nQuery latency ({args.repeat} runs each)")
+        results = run_queries(db, args.carts, args.repeat)
+        for query in results["plain"]:
+            plain, ts = results["plain"][query], results["timeseries"][query]
+            print(f"  {query:<22} plain p50={plain['p50_ms']:.2f}ms p95={plain['p95_ms']:.2f}ms | "
+                  f"timeseries p50={ts['p50_ms']:.2f}ms p95={ts['p95_ms']:.2f}ms")
+    finally:
+        if not args.keep:
+            db.drop_collection(PLAIN)
+            db.drop_collection(TIMESERIES)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
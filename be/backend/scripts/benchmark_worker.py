@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Celery task throughput with a MongoClient per task (the old get_db_client())
+against the worker's shared pooled client (database.get_sync_db()).
+
+Usage:
+    python -m backend.scripts.benchmark_worker [--tasks 300] [--keep]
+
+Each simulated task does the database work of process_order for a one-item
+order: read the order, reserve a catalog version, decrement stock, complete
+the order and log the purchase. Tasks run back to back, as in one prefork
+worker process.
+"""
+import argparse
+import statistics
+import time
+
+from pymongo import MongoClient
+
+from ..config import settings
+from ..database import get_sync_db, close_mongo_connection_sync
+
+PREFIX = "bench_worker_"
+
+
+def task_body(db, n: int):
+    db[PREFIX + "orders"].find_one({"order_id": f"order-{n}"})
+    db[PREFIX + "counters"].find_one_and_update({"_id": "catalog_version"}, {"$inc": {"seq": 1}}, upsert=True)
+    db[PREFIX + "products"].update_one({"id": 1, "quantity": {"$gte": 1}}, {"$inc": {"quantity": -1}})
+    db[PREFIX + "orders"].update_one({"order_id": f"order-{n}"}, {"$set": {"status": "completed"}})
+    db[PREFIX + "purchase_logs"].insert_one({"order_id": f"order-{n}"})
+
+
+def per_task_client(n: int):
+    client = MongoClient(settings.MONGO_URI)
+    try:
+        task_body(client[settings.MONGO_DB_NAME], n)
+    finally:
+        client.close()
+
+
+def shared_client(n: int):
+    task_body(get_sync_db(), n)
+
+
+def reset(db, tasks: int):
+    for name in ("orders", "counters", "products", "purchase_logs"):
+        db.drop_collection(PREFIX + name)
+    db[PREFIX + "products"].insert_one({"id": 1, "quantity": tasks * 4})
+    db[PREFIX + "orders"].insert_many([{"order_id": f"order-{n}", "status": "paid"} for n in range(tasks)])
+    db[PREFIX + "orders"].create_index("order_id")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-task vs shared MongoDB clients in Celery tasks.")
+    parser.add_argument("--tasks", type=int, default=300)
+    parser.add_argument("--keep", action="store_true", help="Keep the benchmark collections afterwards")
+    args = parser.parse_args()
+
+    db = get_sync_db()
+    try:
+        print(f"{args.tasks} tasks, one after another")
+        for label, run in (("per-task client", per_task_client), ("shared client", shared_client)):
+            reset(db, args.tasks)
+            samples = []
+            started = time.perf_counter()
+            for n in range(args.tasks):
+                task_started = time.perf_counter()
+                run(n)
+                samples.append((time.perf_counter() - task_started) * 1000)
+            elapsed = time.perf_counter() - started
+            samples.sort()
+            print(
+                f"  {label:<16} {args.tasks / elapsed:7.1f} tasks/s  p50={statistics.median(samples):.2f}ms "
+                f"p99={samples[min(len(samples) - 1, int(len(samples) * 0.99))]:.2f}ms"
+            )
+    finally:
+        if not args.keep:
+            for name in ("orders", "counters", "products", "purchase_logs"):
+                db.drop_collection(PREFIX + name)
+        close_mongo_connection_sync()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+One-shot migration of motion_logs and uwb_locations into time-series collections.
+
+Usage:
+    python -m backend.scripts.migrate_timeseries [--batch-size 5000] [--drop-legacy]
+
+For each collection that is still a plain collection:
+1. Rename it to <name>_legacy.
+2. Create <name> as a time-series collection, so new writes land there right away.
+3. Copy documents from <name>_legacy in _id order, one batch at a time.
+
+Progress is recorded after every batch, so an interrupted run can simply be
+started again. The legacy collection is kept as a backup unless --drop-legacy
+is given.
+"""
+import argparse
+from datetime import datetime
+
+from pymongo import MongoClient, ASCENDING
+from pymongo.errors import BulkWriteError
+
+from ..config import settings
+from ..database import TIMESERIES_COLLECTIONS, timeseries_options, to_timeseries_document
+
+MIGRATIONS_COLLECTION = "migrations"
+
+
+def collection_type(db, name: str):
+    info = next(db.list_collections(filter={"name": name}), None)
+    return info.get("type", "collection") if info else None
+
+
+def migrate_collection(db, name: str, batch_size: int, drop_legacy: bool):
+    legacy_name = f"{name}_legacy"
+    progress_id = f"timeseries:{name}"
+    current_type = collection_type(db, name)
+
+    if current_type == "timeseries" and collection_type(db, legacy_name) is None:
+        print(f"'{name}' is already a time-series collection - nothing to do.")
+        return
+
+    if current_type == "collection":
+        db[name].rename(legacy_name)
+        print(f"Renamed '{name}' to '{legacy_name}'.")
+        current_type = None
+    if current_type is None:
+        db.create_collection(name, **timeseries_options())
+        print(f"Created time-series collection '{name}'.")
+
+    target = db[name]
+    target.create_index([("meta.cart_id", ASCENDING), ("timestamp", ASCENDING)])
+    target.create_index([("meta.session_id", ASCENDING), ("timestamp", ASCENDING)])
+
+    legacy = db[legacy_name]
+    progress = db[MIGRATIONS_COLLECTION].find_one({"_id": progress_id}) or {}
+    last_id = progress.get("last_id")
+    copied = progress.get("copied", 0)
+    skipped = progress.get("skipped", 0)
+    total = legacy.estimated_document_count()
+
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = list(legacy.find(query).sort("_id", ASCENDING).limit(batch_size))
+        if not batch:
+            break
+
+        # Time-series collections reject documents without a date in the time field
+        documents = [to_timeseries_document(doc) for doc in batch if isinstance(doc.get("timestamp"), datetime)]
+        skipped += len(batch) - len(documents)
+        if documents:
+            try:
+                target.insert_many(documents, ordered=False)
+                copied += len(documents)
+            except BulkWriteError as e:
+                copied += e.details.get("nInserted", 0)
+                skipped += len(e.details.get("writeErrors", []))
+
+        last_id = batch[-1]["_id"]
+        db[MIGRATIONS_COLLECTION].update_one(
+            {"_id": progress_id},
+            {"$set": {"last_id": last_id, "copied": copied, "skipped": skipped, "updated_at": datetime.utcnow()}},
+            upsert=True,
+        )
+        print(f"  {name}: copied {copied}/{total} (skipped {skipped})")
+
+    print(f"Finished '{name}': {copied} documents copied, {skipped} skipped.")
+    if drop_legacy:
+        legacy.drop()
+        db[MIGRATIONS_COLLECTION].delete_one({"_id": progress_id})
+        print(f"Dropped '{legacy_name}'.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate telemetry collections to MongoDB time-series collections.")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Documents copied per batch")
+    parser.add_argument("--drop-legacy", action="store_true", help="Drop the <name>_legacy backups after copying")
+    parser.add_argument("--collection", choices=TIMESERIES_COLLECTIONS, action="append",
+                        help="Only migrate this collection (repeatable)")
+    args = parser.parse_args()
+
+    client = MongoClient(settings.MONGO_URI)
+    try:
+        db = client[settings.MONGO_DB_NAME]
+        for name in args.collection or TIMESERIES_COLLECTIONS:
+            migrate_collection(db, name, args.batch_size, args.drop_legacy)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
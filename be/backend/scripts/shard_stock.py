@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Moves the stock of hot products into sharded counters, or back.
+
+Usage:
+    python -m backend.scripts.shard_stock --products 12,57 [--shards 8]
+    python -m backend.scripts.shard_stock --products 12,57 --unshard
+
+Sharding flags the product with `stock_shards: N` and moves its quantity
+into N documents of the stock_shards collection; orders then decrement a
+random one of them instead of the product document, and reads sum them
+(see services/stock_shards.py). --unshard folds the sub-counters back into
+the product's quantity and removes the flag.
+
+Both directions are safe to run while orders are processed: on a replica
+set each product moves in one transaction; on a standalone server the
+steps are ordered so no decrement is lost, though an order may briefly be
+refused as short while its product moves.
+"""
+import argparse
+
+from pymongo import MongoClient
+
+from ..config import settings
+from ..orders.tasks import supports_transactions, notify_catalog_changed, close_redis_client
+from ..services import stock_shards
+
+
+def migrate(client: MongoClient, product_id: int, shard_count: int, unshard: bool):
+    db = client[settings.MONGO_DB_NAME]
+
+    def move(session=None):
+        if unshard:
+            return stock_shards.unshard_product_sync(db, product_id, session=session)
+        return stock_shards.shard_product_sync(db, product_id, shard_count, session=session)
+
+    if supports_transactions(client):
+        with client.start_session() as session:
+            return session.with_transaction(move)
+    return move()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shard or unshard the stock counters of hot products.")
+    parser.add_argument("--products", required=True, help="Comma-separated product ids")
+    parser.add_argument("--shards", type=int, default=settings.STOCK_SHARD_COUNT)
+    parser.add_argument("--unshard", action="store_true", help="Fold the sub-counters back into the products")
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+
+    product_ids = [int(product_id) for product_id in args.products.split(",") if product_id.strip()]
+    client = MongoClient(settings.MONGO_URI)
+    try:
+        client.admin.command("ping")
+        if not args.unshard:
+            client[settings.MONGO_DB_NAME][stock_shards.SHARDS_COLLECTION].create_index(
+                [("product_id", 1), ("shard", 1)], unique=True
+            )
+        for product_id in product_ids:
+            moved = migrate(client, product_id, args.shards, args.unshard)
+            if moved is None:
+                state = "not sharded" if args.unshard else "missing or already sharded"
+                print(f"Product {product_id}: {state} - nothing to do.")
+            elif args.unshard:
+                print(f"Product {product_id}: folded {moved} units back into the product.")
+            else:
+                print(f"Product {product_id}: moved {moved} units into {args.shards} shards.")
+        # Cached products in the API processes still carry the old layout
+        notify_catalog_changed()
+    finally:
+        close_redis_client()
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
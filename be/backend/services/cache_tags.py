@@ -0,0 +1,67 @@
+# backend/services/cache_tags.py
+from typing import Optional
+
+from fastapi_cache import FastAPICache
+from fastapi_cache.key_builder import default_key_builder
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Tag of everything derived from the product catalog as a whole
+CATALOG_TAG = "catalog"
+
+
+def tag_version_key(tag: str) -> str:
+    return f"{tag}:version"
+
+
+def tagged_key_builder(*tags: str):
+    """
+    Key builder for @cache that ties the cached response to one or more tags.
+
+    Every tag has a version counter in Redis, and the current versions are part
+    of the cache key. Invalidating a tag increments its counter, so every key
+    built with the old version is never read again and simply expires. A
+    request that raced with the invalidation can only write under the old
+    version, so no stale entry survives.
+    """
+
+    async def key_builder(
+        func,
+        namespace: str = "",
+        *,
+        request: Optional[Request] = None,
+        response: Optional[Response] = None,
+        args=(),
+        kwargs=None,
+    ) -> str:
+        kwargs = kwargs or {}
+        cache_key = default_key_builder(func, namespace, request=request, response=response, args=args, kwargs=kwargs)
+        try:
+            versions = await FastAPICache.get_backend().redis.mget([tag_version_key(tag) for tag in tags])
+        except Exception as e:
+            print(f"Cache tag version lookup failed: {e}")
+            versions = [None] * len(tags)
+        suffix = ",".join(f"{tag}={int(version or 0)}" for tag, version in zip(tags, versions))
+        return f"{cache_key}:{suffix}"
+
+    return key_builder
+
+
+async def invalidate_tags(redis_client, *tags: str):
+    """Invalidates every cached response carrying one of the tags."""
+    if not tags:
+        return
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for tag in tags:
+            pipe.incr(tag_version_key(tag))
+        return await pipe.execute()
+
+
+def invalidate_tags_sync(redis_client, *tags: str):
+    """invalidate_tags() for synchronous code such as Celery tasks."""
+    if not tags:
+        return
+    with redis_client.pipeline(transaction=False) as pipe:
+        for tag in tags:
+            pipe.incr(tag_version_key(tag))
+        return pipe.execute()
@@ -0,0 +1,220 @@
+# backend/services/catalog_sync.py
+import asyncio
+import gzip
+import json
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+from ..config import settings
+from .stock_shards import sum_into
+
+# Counter document in the "counters" collection holding the last reserved catalog version
+CATALOG_VERSION_COUNTER = "catalog_version"
+
+OP_UPSERT = "upsert"
+OP_DELETE = "delete"
+# A reserved version whose write matched nothing; journaled so the sequence has no gap
+OP_NOOP = "noop"
+
+Change = Tuple[int, object, str]  # (version, product_id, op)
+# Duplicate key: the sync already journaled a late entry on the writer's behalf
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _only_duplicates(error: BulkWriteError) -> bool:
+    write_errors = error.details.get("writeErrors", [])
+    return bool(write_errors) and all(e.get("code") == DUPLICATE_KEY_ERROR for e in write_errors)
+
+
+def journal_entries(changes: Iterable[Change]) -> List[dict]:
+    now = datetime.utcnow()
+    return [
+        {"version": version, "product_id": product_id, "op": op, "timestamp": now}
+        for version, product_id, op in changes
+    ]
+
+
+async def reserve_versions(counters_collection: AsyncCollection, count: int = 1) -> int:
+    """Reserves `count` consecutive catalog versions and returns the first one."""
+    counter = await counters_collection.find_one_and_update(
+        {"_id": CATALOG_VERSION_COUNTER},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return counter["seq"] - count + 1
+
+
+async def record_changes(changes_collection: AsyncCollection, changes: Iterable[Change]):
+    """Appends to the change journal. Call it after the product write carrying the version."""
+    entries = journal_entries(changes)
+    if entries:
+        try:
+            await changes_collection.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            if not _only_duplicates(e):
+                raise
+
+
+def reserve_versions_sync(counters_collection: Collection, count: int = 1) -> int:
+    """reserve_versions() for synchronous code such as Celery tasks."""
+    counter = counters_collection.find_one_and_update(
+        {"_id": CATALOG_VERSION_COUNTER},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return counter["seq"] - count + 1
+
+
+def record_changes_sync(changes_collection: Collection, changes: Iterable[Change], session=None):
+    """record_changes() for synchronous code such as Celery tasks; pass `session` to write inside a transaction."""
+    entries = journal_entries(changes)
+    if entries:
+        try:
+            changes_collection.insert_many(entries, ordered=False, session=session)
+        except BulkWriteError as e:
+            if not _only_duplicates(e):
+                raise
+
+
+class CatalogSync:
+    """
+    Serves catalog deltas and compressed snapshots to carts.
+
+    Every product write reserves a version from a shared counter, stamps it on
+    the product as `catalog_version` and then appends a journal entry. Writers
+    finish out of order, so the version a cart may resume from is the
+    watermark: the highest version up to which every journal entry exists.
+    A missing version holds the watermark back until the entry after it is
+    older than the gap grace period. Before the gap is skipped, products that
+    still carry a missing version are looked up by `catalog_version` and
+    journaled on the slow writer's behalf, so late upserts still reach carts.
+    Versions no product carries are noops, deletes or overwritten writes;
+    a delete journaled after the grace period is only seen by a full resync.
+
+    The watermark only moves forward and is advanced incrementally from the
+    journal, so a request that finds nothing new costs one indexed query.
+    """
+
+    def __init__(self, gap_grace_seconds: float):
+        self.gap_grace_seconds = gap_grace_seconds
+        self.watermark = 0
+        self._snapshot: Optional[dict] = None
+        self._snapshot_lock = asyncio.Lock()
+
+    def reset(self):
+        self.watermark = 0
+        self._snapshot = None
+
+    async def advance(self, products_collection: AsyncCollection, changes_collection: AsyncCollection) -> int:
+        """Moves the watermark over newly journaled versions and returns it."""
+        watermark = self.watermark
+        if watermark == 0:
+            # Start from the oldest retained entry; older versions were pruned from the journal
+            oldest = await changes_collection.find_one({}, {"version": 1}, sort=[("version", ASCENDING)])
+            if oldest is None:
+                return watermark
+            watermark = oldest["version"] - 1
+
+        now = datetime.utcnow()
+        async for entry in changes_collection.find(
+            {"version": {"$gt": watermark}}, {"version": 1, "timestamp": 1}
+        ).sort("version", ASCENDING):
+            if entry["version"] != watermark + 1:
+                if (now - entry["timestamp"]).total_seconds() < self.gap_grace_seconds:
+                    break
+                await self._journal_late_writes(watermark, entry["version"], products_collection, changes_collection)
+            watermark = entry["version"]
+        self.watermark = max(self.watermark, watermark)
+        return self.watermark
+
+    async def _journal_late_writes(
+        self,
+        after: int,
+        before: int,
+        products_collection: AsyncCollection,
+        changes_collection: AsyncCollection,
+    ):
+        """Journals the products stamped with a version in the gap (after, before) that has no entry."""
+        products = await products_collection.find(
+            {"catalog_version": {"$gt": after, "$lt": before}}, {"id": 1, "catalog_version": 1, "_id": 0}
+        ).to_list()
+        if products:
+            await record_changes(
+                changes_collection, [(product["catalog_version"], product["id"], OP_UPSERT) for product in products]
+            )
+            print(f"--- [CATALOG SYNC] Journaled {len(products)} late product writes between versions {after} and {before} ---")
+
+    async def changes_since(
+        self,
+        since: int,
+        products_collection: AsyncCollection,
+        changes_collection: AsyncCollection,
+    ) -> dict:
+        """
+        Returns the products changed and the product ids deleted after
+        version `since`. Carts that are new (since=0) or further behind than
+        the journal retention get the whole catalog with full=True.
+        """
+        watermark = await self.advance(products_collection, changes_collection)
+        if since > 0 and since >= watermark:
+            return {"version": max(since, watermark), "full": False, "products": [], "deleted": []}
+
+        oldest = await changes_collection.find_one({}, {"version": 1}, sort=[("version", ASCENDING)])
+        if since <= 0 or oldest is None or since < oldest["version"] - 1:
+            products = await products_collection.find({}, {'_id': 0}).sort("id", ASCENDING).to_list()
+            await sum_into(products, products_collection)
+            return {"version": watermark, "full": True, "products": products, "deleted": []}
+
+        # The last operation on each product wins
+        last_op = {}
+        async for entry in changes_collection.find(
+            {"version": {"$gt": since, "$lte": watermark}}, {"product_id": 1, "op": 1}
+        ).sort("version", ASCENDING):
+            if entry["op"] != OP_NOOP:
+                last_op[entry["product_id"]] = entry["op"]
+
+        changed_ids = [product_id for product_id, op in last_op.items() if op == OP_UPSERT]
+        products = await products_collection.find(
+            {"id": {"$in": changed_ids}}, {'_id': 0}
+        ).sort("id", ASCENDING).to_list() if changed_ids else []
+        await sum_into(products, products_collection)
+        found = {product["id"] for product in products}
+        # A product deleted after the watermark is already gone; report it as deleted
+        deleted = sorted(product_id for product_id in last_op if product_id not in found)
+        return {"version": watermark, "full": False, "products": products, "deleted": deleted}
+
+    async def snapshot(self, products_collection: AsyncCollection, changes_collection: AsyncCollection) -> dict:
+        """
+        Returns the full catalog at the current watermark as
+        {"version", "etag", "body", "gzip_body"}. The encoded snapshot is kept
+        until the watermark moves, so carts polling an unchanged catalog cost
+        no product reads.
+        """
+        watermark = await self.advance(products_collection, changes_collection)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot["version"] == watermark:
+            return snapshot
+        async with self._snapshot_lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot["version"] >= watermark:
+                return snapshot
+            # Products are read after the watermark, so they include every change up to it
+            products = await products_collection.find({}, {'_id': 0}).sort("id", ASCENDING).to_list()
+            await sum_into(products, products_collection)
+            body = json.dumps(
+                {"version": watermark, "products": products}, separators=(",", ":"), default=str
+            ).encode()
+            gzip_body = await asyncio.to_thread(gzip.compress, body, 6)
+            snapshot = {"version": watermark, "etag": f'"catalog-{watermark}"', "body": body, "gzip_body": gzip_body}
+            self._snapshot = snapshot
+            return snapshot
+
+
+catalog_sync = CatalogSync(gap_grace_seconds=settings.CATALOG_SYNC_GAP_GRACE_SECONDS)
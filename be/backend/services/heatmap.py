@@ -0,0 +1,370 @@
+# backend/services/heatmap.py
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageFilter
+from pymongo import UpdateOne
+from pymongo.asynchronous.collection import AsyncCollection
+
+from ..config import settings
+from ..database import get_collection
+from .map_tiles import map_tiles
+
+# Same gradient as the admin dashboard: blue -> cyan -> yellow -> red
+_GRADIENT = np.array([[0, 0, 255], [0, 255, 255], [255, 255, 0], [255, 0, 0]], dtype=float)
+
+
+def grid_shape(cell_size: float) -> Tuple[int, int]:
+    """(rows, columns) of a grid covering the map; rows follow y, columns follow x."""
+    return (
+        math.ceil(settings.MAP_HEIGHT_UNITS / cell_size),
+        math.ceil(settings.MAP_WIDTH_UNITS / cell_size),
+    )
+
+
+def histogram(xs: np.ndarray, ys: np.ndarray, cell_size: float) -> np.ndarray:
+    """Counts points per grid cell. Points outside the map are ignored."""
+    rows, cols = grid_shape(cell_size)
+    counts, _, _ = np.histogram2d(
+        ys, xs,
+        bins=(rows, cols),
+        range=((0, rows * cell_size), (0, cols * cell_size)),
+    )
+    return counts.astype(np.int64)
+
+
+def floor_hour(ts: datetime) -> datetime:
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def _cells_update(grid: np.ndarray) -> dict:
+    rows, cols = np.nonzero(grid)
+    return {f"cells.{r}_{c}": int(grid[r, c]) for r, c in zip(rows, cols)}
+
+
+class HeatmapAccumulator:
+    """
+    Bins ingested UWB positions into per-hour occupancy grids and flushes them
+    to the uwb_heatmap collection. Each hour is one document with sparse
+    "cells.<row>_<col>" counters, so a flush only $inc's the cells that changed.
+    """
+
+    def __init__(
+        self,
+        cell_size: float,
+        flush_interval_seconds: float,
+        collection_resolver: Callable[[str], Awaitable[AsyncCollection]] = get_collection,
+    ):
+        self.cell_size = cell_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.collection_resolver = collection_resolver
+        self._pending: Dict[datetime, np.ndarray] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, documents: Iterable[dict]):
+        """Adds flat (API-shaped) UWB documents to the pending grids."""
+        points: Dict[datetime, list] = {}
+        for doc in documents:
+            x, y, timestamp = doc.get("x"), doc.get("y"), doc.get("timestamp")
+            if x is None or y is None or not isinstance(timestamp, datetime):
+                continue
+            points.setdefault(floor_hour(timestamp), []).append((x, y))
+        for hour, xy in points.items():
+            xy = np.asarray(xy, dtype=float)
+            grid = histogram(xy[:, 0], xy[:, 1], self.cell_size)
+            if hour in self._pending:
+                self._pending[hour] += grid
+            else:
+                self._pending[hour] = grid
+
+    def clear(self):
+        """Drops unflushed increments (tests)."""
+        self._pending.clear()
+
+    async def flush(self) -> int:
+        """Writes pending cell increments. Returns the number of hour documents touched."""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        operations = []
+        for hour, grid in pending.items():
+            increments = _cells_update(grid)
+            if not increments:
+                continue
+            increments["total"] = int(grid.sum())
+            operations.append(UpdateOne(
+                {"cell_size": self.cell_size, "bucket": hour},
+                {"$inc": increments},
+                upsert=True,
+            ))
+        if not operations:
+            return 0
+        try:
+            heatmap_collection = await self.collection_resolver("uwb_heatmap")
+            await heatmap_collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            print(f"Failed to flush UWB heatmap: {e}")
+            for hour, grid in pending.items():
+                if hour in self._pending:
+                    self._pending[hour] += grid
+                else:
+                    self._pending[hour] = grid
+            return 0
+        heatmap_cache.invalidate_open()
+        return len(operations)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_seconds)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+class HeatmapCache:
+    """
+    In-process LRU cache of computed grids and rendered overlays, keyed by
+    time window. Windows that reach into the current hour still change, so
+    they expire after a short TTL; fully closed windows stay until evicted
+    or until a rebuild clears the cache.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, Tuple[Optional[float], object]]" = OrderedDict()
+
+    def get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: tuple, value, is_open: bool):
+        expires_at = time.monotonic() + self.ttl_seconds if is_open else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate_open(self):
+        """Drops entries for windows that are still open, e.g. after new data was flushed."""
+        for key in [key for key, (expires_at, _) in self._entries.items() if expires_at is not None]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+heatmap_accumulator = HeatmapAccumulator(
+    cell_size=settings.HEATMAP_CELL_SIZE,
+    flush_interval_seconds=settings.HEATMAP_FLUSH_INTERVAL_SECONDS,
+)
+heatmap_cache = HeatmapCache(
+    ttl_seconds=settings.HEATMAP_CACHE_TTL_SECONDS,
+    max_entries=settings.HEATMAP_CACHE_MAX_ENTRIES,
+)
+
+
+def window(hours: int, until: Optional[datetime] = None) -> Tuple[datetime, datetime, bool]:
+    """
+    Hour-aligned [start, end) window of `hours` hours ending with the hour that
+    contains `until` (default: now), and whether it still includes the current hour.
+    """
+    current_hour = floor_hour(datetime.utcnow())
+    end = floor_hour(until or datetime.utcnow()) + timedelta(hours=1)
+    return end - timedelta(hours=hours), end, end > current_hour
+
+
+async def get_grid(start: datetime, end: datetime, is_open: bool, heatmap_collection: AsyncCollection) -> np.ndarray:
+    """Sums the hourly grids in [start, end) into one (rows, cols) count grid."""
+    key = ("grid", settings.HEATMAP_CELL_SIZE, start, end)
+    cached = heatmap_cache.get(key)
+    if cached is not None:
+        return cached
+
+    grid = np.zeros(grid_shape(settings.HEATMAP_CELL_SIZE), dtype=np.int64)
+    cursor = heatmap_collection.find(
+        {"cell_size": settings.HEATMAP_CELL_SIZE, "bucket": {"$gte": start, "$lt": end}},
+        {"cells": 1, "_id": 0},
+    )
+    async for doc in cursor:
+        cells = doc.get("cells") or {}
+        if not cells:
+            continue
+        positions = np.array([key.split("_") for key in cells], dtype=np.int64)
+        inside = (positions[:, 0] < grid.shape[0]) & (positions[:, 1] < grid.shape[1])
+        np.add.at(grid, (positions[inside, 0], positions[inside, 1]), np.fromiter(cells.values(), dtype=np.int64)[inside])
+
+    heatmap_cache.set(key, grid, is_open)
+    return grid
+
+
+async def get_map_image_size() -> Tuple[int, int]:
+    """(width, height) in pixels of the map image served by /api/map/map_image."""
+    manifest = await map_tiles.ensure_ready()
+    if manifest is None:
+        return int(settings.MAP_WIDTH_UNITS), int(settings.MAP_HEIGHT_UNITS)
+    return manifest["width"], manifest["height"]
+
+
+def _color_table(opacity: float) -> np.ndarray:
+    """(256, 4) RGBA lookup table for 8-bit intensities, matching the dashboard's colouring."""
+    values = np.arange(256) / 255.0
+    position = values * (len(_GRADIENT) - 1)
+    lower = np.minimum(position.astype(np.int64), len(_GRADIENT) - 2)
+    fraction = (position - lower)[:, None]
+    rgb = _GRADIENT[lower] + (_GRADIENT[lower + 1] - _GRADIENT[lower]) * fraction
+    # Faint cells stay fully transparent so the map remains readable
+    alpha = np.where(values > 0.02, np.minimum(255.0, values * opacity * 255.0 * 1.5), 0.0)
+    return np.column_stack([rgb, alpha]).round().astype(np.uint8)
+
+
+def render_overlay(
+    grid: np.ndarray,
+    width: int,
+    height: int,
+    opacity: float = 0.6,
+    blur_radius: float = 0.0,
+    scale: str = "linear",
+) -> bytes:
+    """
+    Renders a count grid as a transparent RGBA PNG of the given pixel size,
+    aligned so it can be drawn straight on top of the map image.
+    """
+    cell_size = settings.HEATMAP_CELL_SIZE
+    intensity = grid.astype(np.float32)
+    if scale == "log":
+        intensity = np.log1p(intensity)
+    peak = float(intensity.max())
+    if peak > 0:
+        intensity /= peak
+
+    # The grid extends past the map edge up to a whole cell; scale it in map
+    # units and crop, so cell boundaries land on the right pixels
+    scale_x = width / settings.MAP_WIDTH_UNITS
+    scale_y = height / settings.MAP_HEIGHT_UNITS
+    full_size = (
+        max(1, round(grid.shape[1] * cell_size * scale_x)),
+        max(1, round(grid.shape[0] * cell_size * scale_y)),
+    )
+    layer = Image.fromarray((intensity * 255).round().astype(np.uint8), mode="L")
+    layer = layer.resize(full_size, Image.BILINEAR).crop((0, 0, width, height))
+    if blur_radius > 0:
+        layer = layer.filter(ImageFilter.GaussianBlur(blur_radius))
+    rgba = _color_table(opacity)[np.asarray(layer)]
+
+    output = BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(output, format="PNG", compress_level=6)
+    return output.getvalue()
+
+
+async def get_overlay(
+    start: datetime,
+    end: datetime,
+    is_open: bool,
+    heatmap_collection: AsyncCollection,
+    opacity: float,
+    blur_radius: float,
+    scale: str,
+) -> bytes:
+    """Returns the PNG overlay for a window at the size of the current map image."""
+    width, height = await get_map_image_size()
+    key = ("png", settings.HEATMAP_CELL_SIZE, start, end, width, height, opacity, blur_radius, scale)
+    cached = heatmap_cache.get(key)
+    if cached is not None:
+        return cached
+    grid = await get_grid(start, end, is_open, heatmap_collection)
+    png = await asyncio.to_thread(render_overlay, grid, width, height, opacity, blur_radius, scale)
+    heatmap_cache.set(key, png, is_open)
+    return png
+
+
+async def rebuild(
+    since: datetime,
+    until: datetime,
+    heatmap_collection: AsyncCollection,
+    uwb_locations_collection: AsyncCollection,
+    batch_size: int = 10000,
+) -> int:
+    """
+    Recomputes the hourly grids for [since, until) from raw uwb_locations,
+    e.g. to backfill history that was ingested before the heatmap existed.
+    Returns the number of hour documents written.
+    """
+    await heatmap_accumulator.flush()
+    start = floor_hour(since)
+    end = floor_hour(until) + timedelta(hours=1)
+    cell_size = settings.HEATMAP_CELL_SIZE
+
+    cursor = uwb_locations_collection.find(
+        {"timestamp": {"$gte": start, "$lt": end}, "x": {"$ne": None}, "y": {"$ne": None}},
+        {"x": 1, "y": 1, "timestamp": 1, "_id": 0},
+        batch_size=batch_size,
+    )
+    grids: Dict[datetime, np.ndarray] = {}
+    chunk = []
+
+    def add_chunk():
+        xs = np.array([doc["x"] for doc in chunk], dtype=float)
+        ys = np.array([doc["y"] for doc in chunk], dtype=float)
+        hours = np.array([floor_hour(doc["timestamp"]) for doc in chunk])
+        for hour in set(hours.tolist()):
+            selected = hours == hour
+            grid = histogram(xs[selected], ys[selected], cell_size)
+            grids[hour] = grids[hour] + grid if hour in grids else grid
+
+    async for doc in cursor:
+        chunk.append(doc)
+        if len(chunk) >= batch_size:
+            add_chunk()
+            chunk = []
+    if chunk:
+        add_chunk()
+
+    await heatmap_collection.delete_many({"cell_size": cell_size, "bucket": {"$gte": start, "$lt": end}})
+    documents = []
+    for hour, grid in sorted(grids.items()):
+        rows, cols = np.nonzero(grid)
+        documents.append({
+            "cell_size": cell_size,
+            "bucket": hour,
+            "cells": {f"{r}_{c}": int(grid[r, c]) for r, c in zip(rows, cols)},
+            "total": int(grid.sum()),
+        })
+    if documents:
+        await heatmap_collection.insert_many(documents, ordered=False)
+    heatmap_cache.clear()
+    return len(documents)
+
+
+async def prune(heatmap_collection: AsyncCollection, before: Optional[datetime] = None):
+    """Deletes hourly grids that lie entirely before `before`, or all of them."""
+    query = {} if before is None else {"bucket": {"$lt": floor_hour(before)}}
+    await heatmap_collection.delete_many(query)
+    heatmap_cache.clear()
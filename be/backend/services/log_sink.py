@@ -0,0 +1,169 @@
+# backend/services/log_sink.py
+import asyncio
+from typing import Awaitable, Callable, Dict, Iterable, List
+
+from pymongo.asynchronous.collection import AsyncCollection
+
+from ..config import settings
+from ..database import get_collection
+
+
+class LogSink:
+    """
+    Asynchronous, buffered writer for append-only log collections.
+
+    Each collection gets a bounded in-memory queue and a worker task that flushes
+    with insert_many(ordered=False) when a batch fills up or the flush interval
+    elapses. When a queue is full, emit() waits up to the enqueue timeout
+    (backpressure) before dropping the entry.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int,
+        batch_size: int,
+        flush_interval_seconds: float,
+        enqueue_timeout_seconds: float,
+        drain_timeout_seconds: float,
+        collection_resolver: Callable[[str], Awaitable[AsyncCollection]] = get_collection,
+    ):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.enqueue_timeout_seconds = enqueue_timeout_seconds
+        self.drain_timeout_seconds = drain_timeout_seconds
+        self.collection_resolver = collection_resolver
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._closing = False
+
+    def _counters_for(self, collection_name: str) -> Dict[str, int]:
+        return self._counters.setdefault(
+            collection_name,
+            {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0},
+        )
+
+    def _ensure_worker(self, collection_name: str) -> asyncio.Queue:
+        queue = self._queues.get(collection_name)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._queues[collection_name] = queue
+            self._counters_for(collection_name)
+            self._workers[collection_name] = asyncio.create_task(self._run(collection_name, queue))
+        return queue
+
+    async def emit(self, collection_name: str, document: dict) -> bool:
+        """
+        Queues a document for insertion. Returns False if it was dropped because
+        the queue stayed full for the enqueue timeout or the sink is shutting down.
+        """
+        counters = self._counters_for(collection_name)
+        if self._closing:
+            counters["dropped"] += 1
+            return False
+        queue = self._ensure_worker(collection_name)
+        try:
+            queue.put_nowait(document)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(queue.put(document), timeout=self.enqueue_timeout_seconds)
+            except asyncio.TimeoutError:
+                counters["dropped"] += 1
+                return False
+        counters["enqueued"] += 1
+        return True
+
+    async def _next_batch(self, queue: asyncio.Queue) -> List[dict]:
+        batch = [await queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval_seconds
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write(self, collection_name: str, batch: List[dict]):
+        counters = self._counters[collection_name]
+        try:
+            collection = await self.collection_resolver(collection_name)
+            await collection.insert_many(batch, ordered=False)
+            counters["written"] += len(batch)
+        except Exception as e:
+            # With ordered=False the valid documents are still written
+            write_errors = getattr(e, "details", {}) or {}
+            failed = len(write_errors.get("writeErrors", [])) or len(batch)
+            counters["written"] += len(batch) - failed
+            counters["failed"] += failed
+            print(f"--- [LOG SINK] Failed to write {failed} entries to {collection_name}: {e} ---")
+        counters["batches"] += 1
+
+    async def _run(self, collection_name: str, queue: asyncio.Queue):
+        while True:
+            batch = await self._next_batch(queue)
+            try:
+                await self._write(collection_name, batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Returns per-collection counters including the current queue depth."""
+        stats = {}
+        for name, counters in self._counters.items():
+            queue = self._queues.get(name)
+            stats[name] = {
+                **counters,
+                "queue_depth": queue.qsize() if queue is not None else 0,
+                "queue_capacity": self.max_queue_size,
+            }
+        return stats
+
+    async def join(self, collection_names: Iterable[str]):
+        """Waits, up to the drain timeout, until the entries queued for the given collections are written."""
+        queues = [self._queues[name] for name in collection_names if name in self._queues]
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in queues)),
+                timeout=self.drain_timeout_seconds,
+            )
+        except asyncio.TimeoutError:
+            print("--- [LOG SINK] Timed out waiting for queued entries to be written ---")
+
+    async def stop(self):
+        """Stops accepting entries, drains every queue and stops the workers."""
+        self._closing = True
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues.values())),
+                timeout=self.drain_timeout_seconds,
+            )
+        except asyncio.TimeoutError:
+            print("--- [LOG SINK] Drain timed out; remaining entries are discarded ---")
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        for name, queue in self._queues.items():
+            self._counters[name]["dropped"] += queue.qsize()
+        self._queues.clear()
+        self._workers.clear()
+        self._closing = False
+
+
+log_sink = LogSink(
+    max_queue_size=settings.LOG_SINK_MAX_QUEUE_SIZE,
+    batch_size=settings.LOG_SINK_BATCH_SIZE,
+    flush_interval_seconds=settings.LOG_SINK_FLUSH_INTERVAL_SECONDS,
+    enqueue_timeout_seconds=settings.LOG_SINK_ENQUEUE_TIMEOUT_SECONDS,
+    drain_timeout_seconds=settings.LOG_SINK_DRAIN_TIMEOUT_SECONDS,
+)
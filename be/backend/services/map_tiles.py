@@ -0,0 +1,231 @@
+# backend/services/map_tiles.py
+import asyncio
+import hashlib
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from io import BytesIO
+from typing import List, Optional
+
+from bson.binary import Binary
+from PIL import Image
+
+from ..config import settings
+from ..database import get_map_collection
+
+# Pillow format name and media type per tile extension
+TILE_FORMATS = {"png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp")}
+MANIFEST = "manifest.json"
+
+
+def content_hash(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def build_tiles(image_bytes: bytes, directory: str, tile_size: int, formats: List[str], webp_quality: int) -> dict:
+    """
+    Writes the original image and a tile pyramid into `directory` and returns
+    the manifest. Zoom `max_zoom` is full resolution and every level below
+    halves it, down to zoom 0 where the whole map fits in one tile. Tiles are
+    `<zoom>/<x>_<y>.<format>`; edge tiles are cropped, not padded.
+    """
+    with Image.open(BytesIO(image_bytes)) as image:
+        image.load()
+        source_format = (image.format or "PNG").lower()
+        width, height = image.size
+        max_zoom = max(0, math.ceil(math.log2(max(width, height) / tile_size)))
+        levels = []
+        for zoom in range(max_zoom, -1, -1):
+            scale = 2 ** (zoom - max_zoom)
+            level = image if scale == 1 else image.resize(
+                (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))), Image.LANCZOS
+            )
+            columns, rows = math.ceil(level.width / tile_size), math.ceil(level.height / tile_size)
+            os.makedirs(os.path.join(directory, str(zoom)))
+            for x in range(columns):
+                for y in range(rows):
+                    tile = level.crop((x * tile_size, y * tile_size,
+                                       min(level.width, (x + 1) * tile_size), min(level.height, (y + 1) * tile_size)))
+                    for extension in formats:
+                        options = {"quality": webp_quality, "method": 4} if extension == "webp" else {"optimize": True}
+                        tile.save(os.path.join(directory, str(zoom), f"{x}_{y}.{extension}"),
+                                  format=TILE_FORMATS[extension][0], **options)
+            levels.append({"zoom": zoom, "width": level.width, "height": level.height, "columns": columns, "rows": rows})
+
+    original = f"map.{source_format}"
+    with open(os.path.join(directory, original), "wb") as f:
+        f.write(image_bytes)
+    manifest = {
+        "version": content_hash(image_bytes),
+        "width": width,
+        "height": height,
+        "original": original,
+        "media_type": Image.MIME.get(source_format.upper(), "image/png"),
+        "tile_size": tile_size,
+        "max_zoom": max_zoom,
+        "formats": list(formats),
+        "levels": sorted(levels, key=lambda level: level["zoom"]),
+    }
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+class MapTileStore:
+    """
+    Serves the store map from disk instead of MongoDB. Each map version lives
+    in a directory named after the SHA-256 of the image: the original plus a
+    WebP/PNG tile pyramid. A version is built in a temporary directory and
+    renamed into place, and only then becomes current, so readers always see
+    a complete tile set of one version. The map document records the hash,
+    so checking for a new map transfers a few bytes rather than the image;
+    other workers pick up an upload on their next refresh.
+
+    Workers sharing the cache directory touch their current version on every
+    refresh, and only versions nobody touched for two refresh intervals are
+    pruned, so an upload doesn't delete what other workers still serve.
+    """
+
+    def __init__(self, cache_dir: str, refresh_interval_seconds: float, tile_size: int, formats: List[str], webp_quality: int):
+        self.cache_dir = cache_dir
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.tile_size = tile_size
+        self.formats = [extension for extension in formats if extension in TILE_FORMATS]
+        self.webp_quality = webp_quality
+        self.current: Optional[dict] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def directory(self, version: str) -> str:
+        return os.path.join(self.cache_dir, version)
+
+    def original_path(self, manifest: dict) -> str:
+        return os.path.join(self.directory(manifest["version"]), manifest["original"])
+
+    def tile_path(self, version: str, zoom: int, x: int, y: int, extension: str) -> Optional[str]:
+        """Path of a tile of the current or previous version, or None if there is no such tile."""
+        if len(version) != 64 or any(ch not in "0123456789abcdef" for ch in version) or extension not in self.formats:
+            return None
+        path = os.path.join(self.directory(version), str(zoom), f"{x}_{y}.{extension}")
+        return path if os.path.isfile(path) else None
+
+    def _mark_in_use(self, version: str):
+        try:
+            os.utime(self.directory(version))
+        except OSError:
+            pass
+
+    def install(self, image_bytes: bytes) -> dict:
+        """Builds (or reuses) the tile set of an image, makes it current and prunes unused versions."""
+        version = content_hash(image_bytes)
+        final = self.directory(version)
+        manifest_path = os.path.join(final, MANIFEST)
+        if not os.path.exists(manifest_path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            staging = tempfile.mkdtemp(prefix=f".{version[:12]}-", dir=self.cache_dir)
+            try:
+                build_tiles(image_bytes, staging, self.tile_size, self.formats, self.webp_quality)
+                try:
+                    os.rename(staging, final)
+                except OSError:
+                    # Another worker installed the same version first
+                    if not os.path.exists(manifest_path):
+                        raise
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        previous = self.current["version"] if self.current else None
+        self.current = manifest
+        self._mark_in_use(version)
+        # Keep the previous version so clients halfway through loading tiles can finish
+        unused_before = time.time() - 2 * self.refresh_interval_seconds
+        for name in os.listdir(self.cache_dir):
+            if name in (version, previous) or name.startswith("."):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                if os.path.getmtime(path) < unused_before:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+        return manifest
+
+    async def refresh(self):
+        """Installs the map stored in MongoDB if it differs from the current one."""
+        map_collection = await get_map_collection()
+        doc = await map_collection.find_one({"name": "mall_map"}, {"sha256": 1})
+        if doc is None or (self.current and doc.get("sha256") == self.current["version"]):
+            if self.current:
+                self._mark_in_use(self.current["version"])
+            return
+        async with self._lock:
+            doc = await map_collection.find_one({"name": "mall_map"}, {"image": 1, "sha256": 1})
+            if not doc or not doc.get("image"):
+                return
+            image_bytes = bytes(doc["image"])
+            manifest = await asyncio.to_thread(self.install, image_bytes)
+            if doc.get("sha256") != manifest["version"]:
+                # Maps stored before hashes were recorded
+                await map_collection.update_one({"_id": doc["_id"]}, {"$set": {"sha256": manifest["version"]}})
+            print(f"--- Map version {manifest['version'][:12]} ready ({manifest['width']}x{manifest['height']}, zoom 0-{manifest['max_zoom']}) ---")
+
+    async def ensure_ready(self) -> Optional[dict]:
+        """The current manifest; rebuilds the tile set if it went missing from disk (e.g. a cleared cache)."""
+        if self.current is not None and not os.path.isfile(self.original_path(self.current)):
+            self.current = None
+        if self.current is None:
+            await self.refresh()
+        return self.current
+
+    async def upload(self, image_bytes: bytes) -> dict:
+        """Stores a new map: the tile set is complete on disk before MongoDB points at it."""
+        async with self._lock:
+            manifest = await asyncio.to_thread(self.install, image_bytes)
+            map_collection = await get_map_collection()
+            await map_collection.update_one(
+                {"name": "mall_map"},
+                {"$set": {
+                    "image": Binary(image_bytes),
+                    "content_type": manifest["media_type"],
+                    "sha256": manifest["version"],
+                    "updated_at": datetime.utcnow(),
+                }},
+                upsert=True,
+            )
+        return manifest
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Failed to refresh map tiles: {e}")
+            await asyncio.sleep(self.refresh_interval_seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+map_tiles = MapTileStore(
+    cache_dir=settings.MAP_CACHE_DIR or os.path.join(tempfile.gettempdir(), "nova_map_cache"),
+    refresh_interval_seconds=settings.MAP_REFRESH_SECONDS,
+    tile_size=settings.MAP_TILE_SIZE,
+    formats=settings.MAP_TILE_FORMATS,
+    webp_quality=settings.MAP_TILE_WEBP_QUALITY,
+)
@@ -0,0 +1,348 @@
+# backend/services/motion_rollups.py
+import asyncio
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+from pymongo.asynchronous.collection import AsyncCollection
+
+from ..config import settings
+from ..database import get_collection, timeseries_filter
+from .log_sink import log_sink
+
+# Rollup sources: the raw collection, the field used as rollup key and the
+# numeric field whose sum is kept so averages can be derived.
+ROLLUP_SOURCES = {
+    "logs": {"key_field": "state", "value_field": "weight"},
+    "events": {"key_field": "event_type", "value_field": "weight_difference"},
+}
+GRANULARITIES = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1)}
+ROLLUPS_COLLECTION = "motion_rollups"
+WATERMARKS_COLLECTION = "motion_rollup_watermarks"
+# A worker whose watermark has not moved for this many flush intervals is gone
+WATERMARK_STALE_INTERVALS = 3
+
+RollupKey = Tuple[str, str, Optional[str], object, datetime]
+
+
+def _utc_naive(ts: datetime) -> datetime:
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def floor_bucket(ts: datetime, granularity: str) -> datetime:
+    ts = _utc_naive(ts)
+    if granularity == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(second=0, microsecond=0)
+
+
+def ceil_bucket(ts: datetime, granularity: str) -> datetime:
+    floored = floor_bucket(ts, granularity)
+    return floored if floored == _utc_naive(ts) else floored + GRANULARITIES[granularity]
+
+
+class MotionRollupAccumulator:
+    """
+    Accumulates per-minute and per-hour counters for ingested motion logs and
+    events, and flushes them as $inc upserts into motion_rollups. Increments are
+    additive, so several workers can flush into the same rollup documents.
+
+    Every flush also stores, per source, this worker's watermark: the time up to
+    which its increments are written. Readers take raw data after the oldest
+    live watermark, so samples still pending in any worker are not lost.
+    """
+
+    def __init__(
+        self,
+        flush_interval_seconds: float,
+        collection_resolver: Callable[[str], Awaitable[AsyncCollection]] = get_collection,
+    ):
+        self.flush_interval_seconds = flush_interval_seconds
+        self.collection_resolver = collection_resolver
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._pending: Dict[RollupKey, List[float]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, source: str, documents: Iterable[dict], sign: int = 1):
+        """
+        Adds flat (API-shaped) documents from the given source to the pending
+        rollups, or takes them back out with sign=-1 after they were deleted.
+        """
+        key_field = ROLLUP_SOURCES[source]["key_field"]
+        value_field = ROLLUP_SOURCES[source]["value_field"]
+        for doc in documents:
+            timestamp = doc.get("timestamp")
+            if not isinstance(timestamp, datetime):
+                continue
+            value = doc.get(value_field) or 0.0
+            for granularity in GRANULARITIES:
+                key = (granularity, source, doc.get("cart_id"), doc.get(key_field), floor_bucket(timestamp, granularity))
+                totals = self._pending.setdefault(key, [0, 0.0])
+                totals[0] += sign
+                totals[1] += sign * value
+
+    def pending_since(self, source: str) -> Optional[datetime]:
+        """Oldest minute bucket of this worker's unflushed increments for a source."""
+        buckets = [
+            bucket for (granularity, pending_source, _, _, bucket) in self._pending
+            if granularity == "minute" and pending_source == source
+        ]
+        return min(buckets) if buckets else None
+
+    def clear(self):
+        """Drops unflushed increments (tests)."""
+        self._pending.clear()
+
+    async def flush(self) -> int:
+        """Writes pending increments and the watermarks. Returns the number of rollup documents touched."""
+        flushed_through = datetime.utcnow()
+        pending, self._pending = self._pending, {}
+        operations = [
+            UpdateOne(
+                {"granularity": granularity, "source": source, "cart_id": cart_id, "key": key, "bucket": bucket},
+                {"$inc": {"count": count, "value_sum": value_sum}},
+                upsert=True,
+            )
+            for (granularity, source, cart_id, key, bucket), (count, value_sum) in pending.items()
+            if count
+        ]
+        if operations:
+            try:
+                rollups_collection = await self.collection_resolver(ROLLUPS_COLLECTION)
+                await rollups_collection.bulk_write(operations, ordered=False)
+            except Exception as e:
+                print(f"Failed to flush motion rollups: {e}")
+                for rollup_key, (count, value_sum) in pending.items():
+                    totals = self._pending.setdefault(rollup_key, [0, 0.0])
+                    totals[0] += count
+                    totals[1] += value_sum
+                return 0
+        try:
+            watermarks_collection = await self.collection_resolver(WATERMARKS_COLLECTION)
+            await watermarks_collection.bulk_write([
+                UpdateOne(
+                    {"_id": f"{source}:{self.worker_id}"},
+                    {"$set": {"source": source, "worker": self.worker_id, "flushed_through": flushed_through}},
+                    upsert=True,
+                )
+                for source in ROLLUP_SOURCES
+            ], ordered=False)
+        except Exception as e:
+            # Readers drop the stale watermark and fall back to this process's pending buckets
+            print(f"Failed to store motion rollup watermarks: {e}")
+        return len(operations)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_seconds)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        try:
+            watermarks_collection = await self.collection_resolver(WATERMARKS_COLLECTION)
+            await watermarks_collection.delete_many({"worker": self.worker_id})
+        except Exception as e:
+            print(f"Failed to remove motion rollup watermarks: {e}")
+
+
+motion_rollups = MotionRollupAccumulator(flush_interval_seconds=settings.MOTION_ROLLUP_FLUSH_INTERVAL_SECONDS)
+
+
+def _raw_filter(source: str, filter_query: dict) -> dict:
+    # motion_logs is a time-series collection with cart_id under 'meta'
+    return timeseries_filter(filter_query) if source == "logs" else filter_query
+
+
+async def flushed_through(watermarks_collection: AsyncCollection, source: str, now: datetime) -> datetime:
+    """
+    The time up to which every live worker has flushed its increments for a
+    source: the oldest recent watermark, or this worker's oldest pending
+    bucket if that is earlier. Samples that arrive with timestamps before it
+    are counted once their worker flushes them.
+    """
+    live_since = now - timedelta(seconds=WATERMARK_STALE_INTERVALS * motion_rollups.flush_interval_seconds)
+    oldest = await watermarks_collection.find_one(
+        {"source": source, "flushed_through": {"$gte": live_since}},
+        sort=[("flushed_through", 1)],
+    )
+    through = oldest["flushed_through"] if oldest else now
+    pending_since = motion_rollups.pending_since(source)
+    if pending_since is not None:
+        through = min(through, pending_since)
+    return through
+
+
+async def get_distribution(
+    source: str,
+    since: datetime,
+    now: datetime,
+    rollups_collection: AsyncCollection,
+    raw_collection: AsyncCollection,
+    watermarks_collection: AsyncCollection,
+    cart_id: Optional[str] = None,
+) -> List[dict]:
+    """
+    Returns [{"_id": key, "count": n, "value_sum": s}] for the window [since, now].
+
+    Whole hours come from hour rollups and the partial hours at either edge
+    from minute rollups, up to the minute of the flush watermark; everything
+    after it, including the open minute, is read from raw data. The window
+    start is aligned down to the minute.
+    """
+    start = floor_bucket(since, "minute")
+    current_minute = floor_bucket(now, "minute")
+    watermark = floor_bucket(await flushed_through(watermarks_collection, source, now), "minute")
+    rollups_end = max(start, min(current_minute, watermark))
+    hours_start = min(ceil_bucket(start, "hour"), rollups_end)
+    hours_end = max(floor_bucket(rollups_end, "hour"), hours_start)
+
+    ranges = [
+        {"granularity": "minute", "bucket": {"$gte": start, "$lt": hours_start}},
+        {"granularity": "hour", "bucket": {"$gte": hours_start, "$lt": hours_end}},
+        {"granularity": "minute", "bucket": {"$gte": hours_end, "$lt": rollups_end}},
+    ]
+    match = {"source": source, "$or": ranges}
+    if cart_id:
+        match["cart_id"] = cart_id
+
+    cursor = await rollups_collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$key", "count": {"$sum": "$count"}, "value_sum": {"$sum": "$value_sum"}}},
+    ])
+    totals = {row["_id"]: row async for row in cursor}
+
+    # Minutes after the watermark may be missing increments, so read them from raw data
+    raw_match = {"timestamp": {"$gte": rollups_end}}
+    if cart_id:
+        raw_match["cart_id"] = cart_id
+    key_field = ROLLUP_SOURCES[source]["key_field"]
+    value_field = ROLLUP_SOURCES[source]["value_field"]
+    raw_cursor = await raw_collection.aggregate([
+        {"$match": _raw_filter(source, raw_match)},
+        {"$group": {"_id": f"${key_field}", "count": {"$sum": 1}, "value_sum": {"$sum": f"${value_field}"}}},
+    ])
+    async for row in raw_cursor:
+        entry = totals.setdefault(row["_id"], {"_id": row["_id"], "count": 0, "value_sum": 0.0})
+        entry["count"] += row["count"]
+        entry["value_sum"] += row["value_sum"]
+
+    return list(totals.values())
+
+
+async def get_timeseries(
+    source: str,
+    granularity: str,
+    since: datetime,
+    rollups_collection: AsyncCollection,
+    cart_id: Optional[str] = None,
+) -> List[dict]:
+    """Returns rollup buckets since the given time, merged across carts unless cart_id is given."""
+    match = {"source": source, "granularity": granularity, "bucket": {"$gte": floor_bucket(since, granularity)}}
+    if cart_id:
+        match["cart_id"] = cart_id
+    cursor = await rollups_collection.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"bucket": "$bucket", "key": "$key"},
+            "count": {"$sum": "$count"},
+            "value_sum": {"$sum": "$value_sum"},
+        }},
+        {"$sort": {"_id.bucket": 1, "_id.key": 1}},
+    ])
+    return [
+        {
+            "bucket": row["_id"]["bucket"],
+            "key": row["_id"]["key"],
+            "count": row["count"],
+            "avg": row["value_sum"] / row["count"] if row["count"] else None,
+        }
+        async for row in cursor
+    ]
+
+
+async def rebuild(
+    since: datetime,
+    until: datetime,
+    rollups_collection: AsyncCollection,
+    raw_collections: Dict[str, AsyncCollection],
+    watermarks_collection: AsyncCollection,
+) -> Dict[str, int]:
+    """
+    Recomputes rollups for whole hours in [since, until) from raw data, e.g. to
+    backfill history that was ingested before rollups existed.
+
+    Only hours that closed before the source's flush watermark are rewritten:
+    later hours may still receive increments from any worker, and raw documents
+    for them may still sit in a log sink queue, so they keep their rollups.
+    """
+    await log_sink.join(collection.name for collection in raw_collections.values())
+    await motion_rollups.flush()
+    now = datetime.utcnow()
+    start = floor_bucket(since, "hour")
+    written = {}
+
+    for source, fields in ROLLUP_SOURCES.items():
+        # Other workers write raw documents up to one sink interval after they count them
+        through = await flushed_through(watermarks_collection, source, now)
+        through -= timedelta(seconds=log_sink.flush_interval_seconds)
+        end = min(ceil_bucket(until, "hour"), floor_bucket(through, "hour"))
+        if end <= start:
+            written[source] = 0
+            continue
+        cart_path = "$meta.cart_id" if source == "logs" else "$cart_id"
+        raw_collection = raw_collections[source]
+        cursor = await raw_collection.aggregate([
+            {"$match": {"timestamp": {"$gte": start, "$lt": end}}},
+            {"$group": {
+                "_id": {
+                    "cart_id": cart_path,
+                    "key": f"${fields['key_field']}",
+                    "bucket": {"$dateTrunc": {"date": "$timestamp", "unit": "minute"}},
+                },
+                "count": {"$sum": 1},
+                "value_sum": {"$sum": f"${fields['value_field']}"},
+            }},
+        ])
+        documents = []
+        hours: Dict[tuple, List[float]] = {}
+        async for row in cursor:
+            group = row["_id"]
+            documents.append({
+                "granularity": "minute", "source": source, "cart_id": group.get("cart_id"),
+                "key": group.get("key"), "bucket": group["bucket"],
+                "count": row["count"], "value_sum": row["value_sum"],
+            })
+            hour_key = (group.get("cart_id"), group.get("key"), floor_bucket(group["bucket"], "hour"))
+            totals = hours.setdefault(hour_key, [0, 0.0])
+            totals[0] += row["count"]
+            totals[1] += row["value_sum"]
+        documents.extend(
+            {
+                "granularity": "hour", "source": source, "cart_id": cart_id, "key": key, "bucket": bucket,
+                "count": count, "value_sum": value_sum,
+            }
+            for (cart_id, key, bucket), (count, value_sum) in hours.items()
+        )
+
+        await rollups_collection.delete_many({"source": source, "bucket": {"$gte": start, "$lt": end}})
+        if documents:
+            await rollups_collection.insert_many(documents, ordered=False)
+        written[source] = len(documents)
+
+    return written
@@ -0,0 +1,401 @@
+# backend/services/navigation.py
+import asyncio
+import hashlib
+import heapq
+import math
+import os
+import tempfile
+from io import BytesIO
+from math import inf, sqrt
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from ..config import settings
+from ..database import get_map_collection
+from .product_search import product_search
+
+Cell = Tuple[int, int]  # (row, col)
+
+_SQRT2 = sqrt(2.0)
+# (row step, col step, cost in cells)
+_NEIGHBOURS = (
+    (-1, 0, 1.0), (1, 0, 1.0), (0, -1, 1.0), (0, 1, 1.0),
+    (-1, -1, _SQRT2), (-1, 1, _SQRT2), (1, -1, _SQRT2), (1, 1, _SQRT2),
+)
+
+
+class OccupancyGrid:
+    """
+    Walkable cells of the store map, `cell_size` map units wide. Cell (row, col)
+    covers x in [col*cell_size, (col+1)*cell_size) and y in
+    [row*cell_size, (row+1)*cell_size), like the heatmap grid.
+    """
+
+    def __init__(self, walkable: np.ndarray, cell_size: float):
+        self.walkable = walkable
+        self.cell_size = cell_size
+        self.rows, self.cols = walkable.shape
+        self._open = walkable.ravel().tolist()
+        self._walkable_cells = np.argwhere(walkable)
+        digest = hashlib.sha1(np.packbits(walkable).tobytes())
+        digest.update(f"{self.rows}x{self.cols}@{cell_size}".encode())
+        self.key = digest.hexdigest()[:16]
+
+    @classmethod
+    def from_map(
+        cls,
+        image_bytes: Optional[bytes],
+        cell_size: float,
+        width_units: float,
+        height_units: float,
+        floor_color: Sequence[int],
+        color_tolerance: int,
+        obstacles: Sequence[Sequence[Tuple[float, float]]] = (),
+    ) -> "OccupancyGrid":
+        """
+        Derives the grid from the map image (it spans the whole map, like the
+        heatmap overlay): a cell is walkable when most of its pixels have the
+        floor colour, so labels painted on the floor don't block it. Obstacle
+        polygons in map units are subtracted afterwards.
+        """
+        rows = max(1, math.ceil(height_units / cell_size))
+        cols = max(1, math.ceil(width_units / cell_size))
+        if image_bytes:
+            with Image.open(BytesIO(image_bytes)) as image:
+                rgb = np.asarray(image.convert("RGB"), dtype=np.int16)
+            floor = (np.abs(rgb - np.asarray(floor_color, dtype=np.int16)).max(axis=2) <= color_tolerance)
+            share = np.asarray(Image.fromarray(floor.astype(np.float32)).resize((cols, rows), Image.BOX))
+            walkable = share >= 0.5
+        else:
+            walkable = np.ones((rows, cols), dtype=bool)
+        if obstacles:
+            mask = Image.new("1", (cols, rows), 0)
+            draw = ImageDraw.Draw(mask)
+            for polygon in obstacles:
+                draw.polygon([(x / cell_size, y / cell_size) for x, y in polygon], fill=1)
+            walkable &= ~np.asarray(mask, dtype=bool)
+        return cls(walkable, cell_size)
+
+    def to_cell(self, x: float, y: float) -> Cell:
+        row = min(max(int(y // self.cell_size), 0), self.rows - 1)
+        col = min(max(int(x // self.cell_size), 0), self.cols - 1)
+        return row, col
+
+    def to_point(self, cell: Cell) -> Tuple[float, float]:
+        row, col = cell
+        return (col + 0.5) * self.cell_size, (row + 0.5) * self.cell_size
+
+    def is_walkable(self, cell: Cell) -> bool:
+        row, col = cell
+        return 0 <= row < self.rows and 0 <= col < self.cols and self._open[row * self.cols + col]
+
+    def snap(self, cell: Cell) -> Optional[Cell]:
+        """The nearest walkable cell; shelf points and noisy UWB fixes often land in obstacles."""
+        if self.is_walkable(cell):
+            return cell
+        if not len(self._walkable_cells):
+            return None
+        nearest = np.argmin(((self._walkable_cells - np.asarray(cell)) ** 2).sum(axis=1))
+        return tuple(int(v) for v in self._walkable_cells[nearest])
+
+    def _step_allowed(self, row: int, col: int, d_row: int, d_col: int) -> bool:
+        row2, col2 = row + d_row, col + d_col
+        if not (0 <= row2 < self.rows and 0 <= col2 < self.cols) or not self._open[row2 * self.cols + col2]:
+            return False
+        # Diagonal steps may not cut obstacle corners
+        return not (d_row and d_col) or (self._open[row * self.cols + col2] and self._open[row2 * self.cols + col])
+
+    def line_of_sight(self, a: Cell, b: Cell) -> bool:
+        """True if the straight segment between the cell centres only crosses walkable cells."""
+        steps = int(max(abs(b[0] - a[0]), abs(b[1] - a[1])) * 2) + 1
+        d_row, d_col = (b[0] - a[0]) / steps, (b[1] - a[1]) / steps
+        is_open, cols = self._open, self.cols
+        # Plain loop: segments are short and this runs for every smoothed leg
+        for i in range(steps + 1):
+            if not is_open[int(a[0] + 0.5 + d_row * i) * cols + int(a[1] + 0.5 + d_col * i)]:
+                return False
+        return True
+
+    def smooth(self, cells: List[Cell]) -> List[Cell]:
+        """Drops intermediate cells while the path stays in line of sight (string pulling)."""
+        if len(cells) <= 2:
+            return list(cells)
+        smoothed = [cells[0]]
+        anchor = 0
+        while anchor < len(cells) - 1:
+            reach = anchor + 1
+            while reach + 1 < len(cells) and self.line_of_sight(cells[anchor], cells[reach + 1]):
+                reach += 1
+            smoothed.append(cells[reach])
+            anchor = reach
+        return smoothed
+
+
+def distance_field(grid: OccupancyGrid, target: Cell) -> np.ndarray:
+    """Dijkstra from `target` over 8-connected walkable cells. Returns (rows, cols) costs in cells, inf if unreachable."""
+    rows, cols, is_open = grid.rows, grid.cols, grid._open
+    dist = [inf] * (rows * cols)
+    start = target[0] * cols + target[1]
+    dist[start] = 0.0
+    heap = [(0.0, start)]
+    while heap:
+        d, index = heapq.heappop(heap)
+        if d > dist[index]:
+            continue
+        row, col = divmod(index, cols)
+        for d_row, d_col, cost in _NEIGHBOURS:
+            row2, col2 = row + d_row, col + d_col
+            if not (0 <= row2 < rows and 0 <= col2 < cols):
+                continue
+            neighbour = row2 * cols + col2
+            if not is_open[neighbour] or d + cost >= dist[neighbour]:
+                continue
+            if d_row and d_col and not (is_open[row * cols + col2] and is_open[row2 * cols + col]):
+                continue
+            dist[neighbour] = d + cost
+            heapq.heappush(heap, (d + cost, neighbour))
+    return np.asarray(dist, dtype=np.float32).reshape(rows, cols)
+
+
+def descend(grid: OccupancyGrid, field: np.ndarray, start: Cell) -> List[Cell]:
+    """Follows the distance field downhill from `start` to its target."""
+    path = [start]
+    row, col = start
+    while 0 < field[row, col] < inf:
+        # The neighbour on a shortest path minimizes its distance plus the step
+        best = None
+        for d_row, d_col, cost in _NEIGHBOURS:
+            if grid._step_allowed(row, col, d_row, d_col) and field[row + d_row, col + d_col] < field[row, col]:
+                total = field[row + d_row, col + d_col] + cost
+                if best is None or total < best[0]:
+                    best = (total, row + d_row, col + d_col)
+        if best is None:
+            break
+        _, row, col = best
+        path.append((row, col))
+    return path
+
+
+def astar(grid: OccupancyGrid, start: Cell, goal: Cell) -> Optional[Tuple[List[Cell], float]]:
+    """A* with the octile heuristic for targets without a precomputed field. Returns (cells, cost in cells)."""
+    def heuristic(cell: Cell) -> float:
+        d_row, d_col = abs(cell[0] - goal[0]), abs(cell[1] - goal[1])
+        return max(d_row, d_col) + (_SQRT2 - 1) * min(d_row, d_col)
+
+    came_from: Dict[Cell, Cell] = {}
+    cost: Dict[Cell, float] = {start: 0.0}
+    heap = [(heuristic(start), 0.0, start)]
+    while heap:
+        _, g, cell = heapq.heappop(heap)
+        if cell == goal:
+            path = [cell]
+            while cell in came_from:
+                cell = came_from[cell]
+                path.append(cell)
+            return path[::-1], g
+        if g > cost[cell]:
+            continue
+        for d_row, d_col, step in _NEIGHBOURS:
+            if not grid._step_allowed(cell[0], cell[1], d_row, d_col):
+                continue
+            neighbour = (cell[0] + d_row, cell[1] + d_col)
+            if g + step < cost.get(neighbour, inf):
+                cost[neighbour] = g + step
+                came_from[neighbour] = cell
+                heapq.heappush(heap, (g + step + heuristic(neighbour), g + step, neighbour))
+    return None
+
+
+class Navigator:
+    """
+    In-store routing. Every shelf point of the catalog is snapped to its
+    nearest walkable cell and gets a precomputed distance field, so a route
+    from a cart to a product is a walk down the field instead of a search.
+    Fields are stored as .npy files under a directory named after the grid
+    hash and memory-mapped on load: restarts reuse them, a new map or
+    obstacle layout gets a fresh directory, and a moved shelf only computes
+    the fields of the cells that are new. Ad-hoc targets use A*.
+    """
+
+    def __init__(self, cache_dir: str, refresh_interval_seconds: float):
+        self.cache_dir = cache_dir
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.grid: Optional[OccupancyGrid] = None
+        self.targets: Dict[int, List[Cell]] = {}
+        self._fields: Dict[Cell, np.ndarray] = {}
+        self._map_signature = None
+        self._shelves_revision = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.grid is not None
+
+    def set_grid(self, grid: OccupancyGrid):
+        if self.grid is None or grid.key != self.grid.key:
+            self._fields.clear()
+            self.targets = {}
+            self._shelves_revision = None
+        self.grid = grid
+
+    def _field_path(self, cell: Cell) -> str:
+        return os.path.join(self.cache_dir, self.grid.key, f"{cell[0]}_{cell[1]}.npy")
+
+    def _load_field(self, cell: Cell) -> np.ndarray:
+        path = self._field_path(cell)
+        try:
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            field = distance_field(self.grid, cell)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "wb") as f:
+                np.save(f, field)
+            os.replace(temporary, path)
+            return field
+
+    def field(self, cell: Cell) -> np.ndarray:
+        """The distance field to a walkable cell: from memory, from disk, or computed and saved."""
+        field = self._fields.get(cell)
+        if field is None:
+            field = self._load_field(cell)
+            self._fields[cell] = field
+        return field
+
+    def prepare_targets(
+        self, shelves: Dict[int, List[Tuple[float, float]]]
+    ) -> Tuple[Dict[int, List[Cell]], Dict[Cell, np.ndarray], int]:
+        """
+        Snaps shelf points to walkable cells and loads or computes a field for
+        each, without touching the navigator's state, so it can run in a thread
+        while routes are served. Returns (targets, fields, fields computed).
+        """
+        targets = {}
+        for product_id, points in shelves.items():
+            cells = {self.grid.snap(self.grid.to_cell(x, y)) for x, y in points}
+            cells.discard(None)
+            if cells:
+                targets[product_id] = sorted(cells)
+        fields = {}
+        computed = 0
+        for cell in {cell for cells in targets.values() for cell in cells}:
+            field = self._fields.get(cell)
+            if field is None:
+                if not os.path.exists(self._field_path(cell)):
+                    computed += 1
+                field = self._load_field(cell)
+            fields[cell] = field
+        return targets, fields, computed
+
+    def set_targets(self, shelves: Dict[int, List[Tuple[float, float]]]) -> int:
+        """Prepares and swaps in the targets for the given shelves. Returns the fields computed."""
+        targets, fields, computed = self.prepare_targets(shelves)
+        self._fields = fields
+        self.targets = targets
+        return computed
+
+    def _route(self, start_xy: Tuple[float, float], cells: List[Cell], cost: float, method: str) -> dict:
+        points = [self.grid.to_point(cell) for cell in self.grid.smooth(cells)]
+        # Keep the snapped start cell only when the start itself is not walkable
+        if cells and cells[0] == self.grid.to_cell(*start_xy):
+            points = points[1:]
+        path = [start_xy] + points
+        return {
+            "method": method,
+            "distance": round(cost * self.grid.cell_size, 1),
+            "path": [{"x": round(x, 1), "y": round(y, 1)} for x, y in path],
+        }
+
+    def route_to_product(self, x: float, y: float, product_id: int) -> Optional[dict]:
+        """Route from (x, y) to the nearest shelf point of a product, or None if unreachable."""
+        start = self.grid.snap(self.grid.to_cell(x, y))
+        cells = self.targets.get(product_id)
+        if start is None or not cells:
+            return None
+        costs = [(float(self.field(cell)[start]), cell) for cell in cells]
+        cost, target = min(costs)
+        if cost == inf:
+            return None
+        route = self._route((x, y), descend(self.grid, self.field(target), start), cost, "field")
+        route["target"] = dict(zip(("x", "y"), self.grid.to_point(target)))
+        return route
+
+    def route_to_point(self, x: float, y: float, to_x: float, to_y: float) -> Optional[dict]:
+        """Route between two arbitrary points with A*, or None if unreachable."""
+        start = self.grid.snap(self.grid.to_cell(x, y))
+        goal = self.grid.snap(self.grid.to_cell(to_x, to_y))
+        if start is None or goal is None:
+            return None
+        found = astar(self.grid, start, goal)
+        if found is None:
+            return None
+        cells, cost = found
+        route = self._route((x, y), cells, cost, "astar")
+        route["target"] = dict(zip(("x", "y"), self.grid.to_point(goal)))
+        return route
+
+    async def refresh(self):
+        """Rebuilds the grid when the map changes and fields when shelves change."""
+        map_collection = await get_map_collection()
+        signature_doc = await map_collection.find_one(
+            {"name": "mall_map"}, {"_id": 1, "sha256": 1, "size": {"$binarySize": "$image"}}
+        ) if settings.NAV_USE_MAP_IMAGE else None
+        signature = tuple((signature_doc or {}).get(field) for field in ("_id", "sha256", "size"))
+        if self.grid is None or signature != self._map_signature:
+            image_bytes = None
+            if signature_doc:
+                map_doc = await map_collection.find_one({"_id": signature_doc["_id"]}, {"image": 1})
+                image_bytes = bytes(map_doc["image"]) if map_doc and map_doc.get("image") else None
+            grid = await asyncio.to_thread(
+                OccupancyGrid.from_map,
+                image_bytes,
+                settings.NAV_CELL_SIZE,
+                settings.MAP_WIDTH_UNITS,
+                settings.MAP_HEIGHT_UNITS,
+                settings.NAV_FLOOR_COLOR,
+                settings.NAV_COLOR_TOLERANCE,
+                settings.NAV_OBSTACLES,
+            )
+            self.set_grid(grid)
+            self._map_signature = signature
+            print(f"--- Navigation grid {grid.rows}x{grid.cols} ready ({int(grid.walkable.sum())} walkable cells) ---")
+
+        if not product_search.ready or product_search.shelves.revision == self._shelves_revision:
+            return
+        revision = product_search.shelves.revision
+        targets, fields, computed = await asyncio.to_thread(self.prepare_targets, product_search.shelves.snapshot())
+        # Swap on the event loop, so route handlers never see a half-updated navigator
+        self._fields = fields
+        self.targets = targets
+        self._shelves_revision = revision
+        if computed:
+            print(f"--- Navigation: computed {computed} distance fields for {len(self.targets)} products ---")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Failed to refresh navigation: {e}")
+            await asyncio.sleep(self.refresh_interval_seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+navigator = Navigator(
+    cache_dir=settings.NAV_CACHE_DIR or os.path.join(tempfile.gettempdir(), "nova_nav_cache"),
+    refresh_interval_seconds=settings.NAV_REFRESH_SECONDS,
+)
@@ -0,0 +1,125 @@
+# backend/services/order_commits.py
+import asyncio
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional
+
+from pymongo.asynchronous.collection import AsyncCollection
+
+from ..config import settings
+from ..database import get_collection
+from ..models import OrderStatus
+from ..orders.tasks import process_order_batch
+
+
+class OrderCommitBatcher:
+    """
+    Coalesces inventory commits of paid orders. Instead of one process_order
+    task per order, each hitting the same popular products, the payment
+    webhook adds the order here and the orders collected over the window go
+    to one process_order_batch task, which writes each product once for the
+    whole batch. A full batch is sent without waiting for the window.
+
+    The queue lives in this process only, so every sweep_after_seconds the
+    loop also queues paid orders whose hand-off was lost (a crash before the
+    flush, a broker outage). Orders already handed to Celery may be sent
+    again; the tasks commit an order only after claiming it atomically (or in
+    a transaction that requires it to be 'paid'), so it is committed once.
+    """
+
+    def __init__(
+        self,
+        window_seconds: float,
+        max_orders: int,
+        sweep_after_seconds: float,
+        collection_resolver: Callable[[str], Awaitable[AsyncCollection]] = get_collection,
+    ):
+        self.window_seconds = window_seconds
+        self.max_orders = max_orders
+        self.sweep_after_seconds = sweep_after_seconds
+        self.collection_resolver = collection_resolver
+        self._pending: List[str] = []
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_seconds > 0
+
+    def add(self, order_id: str):
+        """Queues a paid order for the next batch."""
+        self._pending.append(order_id)
+        if len(self._pending) >= self.max_orders:
+            self._full.set()
+
+    async def flush(self) -> int:
+        """Hands one batch of pending orders to Celery. Returns the number of orders sent."""
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending[:self.max_orders], self._pending[self.max_orders:]
+        try:
+            await asyncio.to_thread(process_order_batch.delay, batch)
+        except Exception as e:
+            print(f"Failed to enqueue order batch: {e}")
+            # Retry with the next batch, ahead of orders that arrived meanwhile
+            self._pending[:0] = batch
+            return 0
+        return len(batch)
+
+    async def sweep(self) -> int:
+        """Queues paid orders older than sweep_after_seconds that are not queued yet. Returns the number queued."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.sweep_after_seconds)
+        try:
+            orders_collection = await self.collection_resolver("order_history")
+            stale = await orders_collection.find(
+                {"status": OrderStatus.PAID, "paid_at": {"$lt": cutoff}}, {"order_id": 1}
+            ).sort("paid_at", 1).limit(self.max_orders).to_list()
+        except Exception as e:
+            print(f"Failed to sweep paid orders: {e}")
+            return 0
+        queued = set(self._pending)
+        swept = [order["order_id"] for order in stale if order["order_id"] not in queued]
+        for order_id in swept:
+            self.add(order_id)
+        if swept:
+            print(f"--- [ORDER BATCHER] Re-queued {len(swept)} paid orders older than {self.sweep_after_seconds:.0f}s ---")
+        return len(swept)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_sweep = loop.time() + self.sweep_after_seconds
+        while True:
+            # Not wait_for: it can swallow the cancel from stop() when the batch fills at the same moment
+            full = asyncio.ensure_future(self._full.wait())
+            try:
+                await asyncio.wait({full}, timeout=self.window_seconds)
+            finally:
+                full.cancel()
+            self._full.clear()
+            if self.sweep_after_seconds > 0 and loop.time() >= next_sweep:
+                next_sweep = loop.time() + self.sweep_after_seconds
+                await self.sweep()
+            await self.flush()
+
+    def start(self):
+        """Starts the background flush loop on the running event loop, if batching is on."""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the flush loop and sends whatever is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._pending and await self.flush():
+            pass
+
+
+order_commit_batcher = OrderCommitBatcher(
+    window_seconds=settings.ORDER_COMMIT_BATCH_WINDOW_MS / 1000,
+    max_orders=settings.ORDER_COMMIT_BATCH_MAX_ORDERS,
+    sweep_after_seconds=settings.ORDER_COMMIT_SWEEP_AFTER_SECONDS,
+)
@@ -0,0 +1,153 @@
+# backend/services/pick_route.py
+from math import inf
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .navigation import Navigator, Cell, descend
+
+
+def distance_matrix(navigator: Navigator, cells: List[Cell], start: Cell, end: Optional[Cell]) -> np.ndarray:
+    """
+    Walking costs (in cells) between shelf cells, gathered from their distance
+    fields. Node K is the start and node K+1 the end; without an end, arriving
+    anywhere is free.
+    """
+    k = len(cells)
+    rows = np.array([cell[0] for cell in cells] + [start[0]], dtype=np.int64)
+    cols = np.array([cell[1] for cell in cells] + [start[1]], dtype=np.int64)
+    matrix = np.zeros((k + 2, k + 2))
+    for j, cell in enumerate(cells):
+        column = np.asarray(navigator.field(cell)[rows, cols], dtype=float)
+        matrix[:k + 1, j] = column
+        matrix[j, k] = column[k]  # Walking back to the start costs the same
+    matrix[k, k] = 0.0
+    if end is not None:
+        column = np.asarray(navigator.field(end)[rows, cols], dtype=float)
+        matrix[:k + 1, k + 1] = column
+        matrix[k + 1, :k + 1] = column
+    return matrix
+
+
+def nearest_neighbour(matrix: np.ndarray, start: int, candidates: List[List[int]]) -> List[int]:
+    """Greedy order: repeatedly walk to the closest shelf of any unvisited product. Returns node indices."""
+    product_of = np.empty(sum(len(options) for options in candidates), dtype=np.int64)
+    for product, options in enumerate(candidates):
+        product_of[options] = product
+    open_nodes = np.ones(len(product_of), dtype=bool)
+    tour, current = [], start
+    for _ in candidates:
+        costs = np.where(open_nodes, matrix[current, :len(product_of)], inf)
+        current = int(np.argmin(costs))
+        open_nodes[product_of == product_of[current]] = False
+        tour.append(current)
+    return tour
+
+
+def two_opt(matrix: np.ndarray, path: np.ndarray) -> np.ndarray:
+    """
+    2-opt on a path with fixed first and last nodes: reverses the segment
+    between two edges whenever that shortens the path, until no move helps.
+    Each anchor edge is tested against all later edges at once with NumPy.
+    """
+    path = path.copy()
+    n = len(path)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n - 3):
+            a, b = path[i], path[i + 1]
+            c, d = path[i + 2:n - 1], path[i + 3:n]
+            delta = matrix[a, c] + matrix[b, d] - matrix[a, b] - matrix[c, d]
+            j = int(np.argmin(delta))
+            if delta[j] < -1e-6:
+                path[i + 1:i + 3 + j] = path[i + 1:i + 3 + j][::-1]
+                improved = True
+    return path
+
+
+def reselect(matrix: np.ndarray, path: np.ndarray, alternatives: Dict[int, List[int]]) -> bool:
+    """Moves each stop to the shelf of the same product that fits best between its neighbours."""
+    changed = False
+    for position in range(1, len(path) - 1):
+        options = alternatives.get(int(path[position]))
+        if not options or len(options) < 2:
+            continue
+        before, after = path[position - 1], path[position + 1]
+        best = min(options, key=lambda cell: matrix[before, cell] + matrix[cell, after])
+        if best != path[position]:
+            path[position] = best
+            changed = True
+    return changed
+
+
+def plan(
+    navigator: Navigator,
+    start_xy: Tuple[float, float],
+    product_ids: List[int],
+    end_xy: Optional[Tuple[float, float]] = None,
+) -> dict:
+    """
+    Orders a shopping list into a short walk from start_xy (and on to end_xy,
+    e.g. the checkout, when given): nearest neighbour, then 2-opt, re-choosing
+    the shelf of products stocked in several places. Returns the visiting
+    order with leg distances, the full polyline and the products that have no
+    reachable shelf.
+    """
+    grid = navigator.grid
+    start = grid.snap(grid.to_cell(*start_xy))
+    if start is None:
+        return {"order": [], "total_distance": 0.0, "path": [], "unreachable": list(dict.fromkeys(product_ids))}
+    end = grid.snap(grid.to_cell(*end_xy)) if end_xy is not None else None
+    if end is not None and navigator.field(end)[start] == inf:
+        end = None
+
+    # One node per (product, shelf cell) that can be reached from the start
+    nodes: List[Tuple[int, Cell]] = []
+    candidates: List[List[int]] = []
+    unreachable = []
+    for product_id in dict.fromkeys(product_ids):
+        cells = [cell for cell in navigator.targets.get(product_id, ()) if navigator.field(cell)[start] < inf]
+        if not cells:
+            unreachable.append(product_id)
+            continue
+        candidates.append(list(range(len(nodes), len(nodes) + len(cells))))
+        nodes += [(product_id, cell) for cell in cells]
+
+    stops: List[int] = []
+    if nodes:
+        matrix = distance_matrix(navigator, [cell for _, cell in nodes], start, end)
+        start_node, end_node = len(nodes), len(nodes) + 1
+        path = np.array([start_node] + nearest_neighbour(matrix, start_node, candidates) + [end_node])
+        alternatives = {node: options for options in candidates for node in options}
+        for _ in range(3):
+            path = two_opt(matrix, path)
+            if not reselect(matrix, path, alternatives):
+                break
+        stops = [int(node) for node in path[1:-1]]
+
+    order, total = [], 0.0
+    polyline = [start_xy]
+    previous = start
+    for target in [nodes[node][1] for node in stops] + ([end] if end is not None else []):
+        field = navigator.field(target)
+        leg = float(field[previous])
+        total += leg
+        polyline += [grid.to_point(cell) for cell in grid.smooth(descend(grid, field, previous))[1:]]
+        previous = target
+        if len(order) < len(stops):
+            x, y = grid.to_point(target)
+            order.append({
+                "product_id": nodes[stops[len(order)]][0],
+                "stop": {"x": x, "y": y},
+                "leg_distance": round(leg * grid.cell_size, 1),
+                "distance_so_far": round(total * grid.cell_size, 1),
+            })
+
+    return {
+        "order": order,
+        "total_distance": round(total * grid.cell_size, 1),
+        "path": [{"x": round(x, 1), "y": round(y, 1)} for x, y in polyline],
+        "end": dict(zip(("x", "y"), grid.to_point(end))) if end is not None else None,
+        "unreachable": unreachable,
+    }
@@ -0,0 +1,185 @@
+# backend/services/product_cache.py
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from pymongo.asynchronous.collection import AsyncCollection
+
+from ..config import settings
+from .cache_tags import CATALOG_TAG, tag_version_key, invalidate_tags, invalidate_tags_sync
+from .stock_shards import sum_into
+
+# Redis key holding the catalog version shared by API workers and Celery; it is
+# also the version of the "catalog" cache tag used by cached endpoints
+CATALOG_VERSION_KEY = tag_version_key(CATALOG_TAG)
+
+_MISSING = object()
+
+
+class ProductCache:
+    """
+    In-process LRU+TTL cache of products keyed by barcode and by id.
+
+    Unknown barcodes are cached too (negative entries), and concurrent lookups
+    of the same key share one database query, so a burst of scans of the same
+    item costs a single find_one.
+
+    Every change to the catalog bumps a version number. Local changes clear the
+    cache right away; changes made by other processes (other API workers, the
+    Celery process_order task) are picked up by comparing against the version
+    kept in Redis, checked at most once per version check interval.
+    """
+
+    def __init__(self, ttl_seconds: float, negative_ttl_seconds: float, max_entries: int, version_check_interval_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.max_entries = max_entries
+        self.version_check_interval_seconds = version_check_interval_seconds
+        self._entries: "OrderedDict[Tuple[str, object], Tuple[float, Optional[dict]]]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, object], asyncio.Future] = {}
+        self._redis = None
+        self.version = 0
+        self._version_checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def attach_redis(self, redis_client):
+        """Shares the catalog version with other processes through an asyncio Redis client."""
+        self._redis = redis_client
+
+    def clear(self):
+        self._entries.clear()
+        self._inflight.clear()
+
+    async def bump_version(self):
+        """
+        Marks the catalog as changed: clears this process and, through the
+        catalog cache tag, other processes and cached responses.
+        """
+        self.clear()
+        self.invalidations += 1
+        if self._redis is not None:
+            try:
+                versions = await invalidate_tags(self._redis, CATALOG_TAG)
+                self.version = int(versions[0])
+                self._version_checked_at = time.monotonic()
+                return
+            except Exception as e:
+                print(f"Catalog version bump in Redis failed: {e}")
+        self.version += 1
+
+    async def _check_version(self):
+        if self._redis is None:
+            return
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_interval_seconds:
+            return
+        self._version_checked_at = now
+        try:
+            shared = int(await self._redis.get(CATALOG_VERSION_KEY) or 0)
+        except Exception as e:
+            print(f"Catalog version check in Redis failed: {e}")
+            return
+        if shared != self.version:
+            self.clear()
+            self.invalidations += 1
+            self.version = shared
+
+    def _store(self, key: Tuple[str, object], product: Optional[dict]):
+        ttl = self.ttl_seconds if product is not None else self.negative_ttl_seconds
+        self._entries[key] = (time.monotonic() + ttl, product)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key: Tuple[str, object]):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, product = entry
+        if expires_at <= time.monotonic():
+            self._entries.pop(key, None)
+            return _MISSING
+        self._entries.move_to_end(key)
+        return product
+
+    async def _get(self, field: str, value, products_collection: AsyncCollection) -> Optional[dict]:
+        await self._check_version()
+        key = (field, value)
+        product = self._lookup(key)
+        if product is not _MISSING:
+            self.hits += 1
+            return dict(product) if product is not None else None
+
+        # Another request is already loading this key: wait for its result
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.hits += 1
+            product = await asyncio.shield(pending)
+            return dict(product) if product is not None else None
+
+        self.misses += 1
+        version = self.version
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            product = await products_collection.find_one({field: value}, {'_id': 0})
+            # Sharded stock is summed here and cached with the product until the next stock change
+            await sum_into([product], products_collection)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Waiters re-raise it; mark it retrieved
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        future.set_result(product)
+
+        # Skip caching if the catalog changed while the query was running
+        if version == self.version:
+            self._store(key, product)
+            if product is not None:
+                if product.get("id") is not None:
+                    self._store(("id", product["id"]), product)
+                if product.get("barcode"):
+                    self._store(("barcode", product["barcode"]), product)
+        return dict(product) if product is not None else None
+
+    async def get_by_barcode(self, barcode: str, products_collection: AsyncCollection) -> Optional[dict]:
+        """Returns the product with this barcode, or None if there is none."""
+        return await self._get("barcode", barcode, products_collection)
+
+    async def get_by_id(self, product_id: int, products_collection: AsyncCollection) -> Optional[dict]:
+        """Returns the product with this id, or None if there is none."""
+        return await self._get("id", product_id, products_collection)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "entries": len(self._entries),
+            "invalidations": self.invalidations,
+            "catalog_version": self.version,
+        }
+
+
+product_cache = ProductCache(
+    ttl_seconds=settings.PRODUCT_CACHE_TTL_SECONDS,
+    negative_ttl_seconds=settings.PRODUCT_CACHE_NEGATIVE_TTL_SECONDS,
+    max_entries=settings.PRODUCT_CACHE_MAX_ENTRIES,
+    version_check_interval_seconds=settings.PRODUCT_CACHE_VERSION_CHECK_SECONDS,
+)
+
+
+def bump_catalog_version_sync(redis_client) -> Optional[int]:
+    """Bumps the shared catalog version from synchronous code such as Celery tasks."""
+    try:
+        versions = invalidate_tags_sync(redis_client, CATALOG_TAG)
+        return int(versions[0])
+    except Exception as e:
+        print(f"Catalog version bump in Redis failed: {e}")
+        return None
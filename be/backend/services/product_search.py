@@ -0,0 +1,306 @@
+# backend/services/product_search.py
+import asyncio
+import re
+import unicodedata
+from bisect import bisect_left
+from math import ceil
+from typing import Dict, Iterable, List, Optional, Set
+
+from ..config import settings
+from ..database import get_products_collection, get_catalog_changes_collection, product_name_key
+from .catalog_sync import catalog_sync
+from .spatial_index import GridIndex, location_points
+
+_SEPARATORS = re.compile(r"[\W_]+")
+
+# Product fields returned by /api/map/location
+LOCATION_FIELDS = ("name", "subtitle", "price", "currency", "quantity", "unit", "product_img_url", "location")
+
+
+def fold(text: str) -> str:
+    """
+    Normalizes text for matching: lowercase, diacritics removed (Vietnamese
+    "Sữa đậu nành" becomes "sua dau nanh") and punctuation collapsed to spaces.
+    """
+    text = unicodedata.normalize("NFD", text.lower().replace("đ", "d"))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _SEPARATORS.sub(" ", text).strip()
+
+
+def trigrams(folded: str, pad_end: bool = True) -> Set[str]:
+    """Character trigrams of folded text, padded so word starts (and ends) count."""
+    padded = f" {folded} " if pad_end else f" {folded}"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _Entry:
+    """One distinct product name in the index."""
+
+    __slots__ = ("name", "folded", "tokens", "trigrams", "product_ids")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.folded = fold(name)
+        self.tokens = set(self.folded.split())
+        self.trigrams = trigrams(self.folded)
+        self.product_ids: Set[int] = set()
+
+
+class ProductSearchIndex:
+    """
+    In-process search index over product names for /api/map/search.
+
+    Names are folded (lowercase, no diacritics) and indexed by word and by
+    character trigram. A query is ranked in tiers: exact name, name prefix,
+    every query word a word prefix (autocomplete), substring, and finally
+    fuzzy matches whose trigram overlap with the query is at least
+    `min_similarity`. Within a tier, names matching the query's own accents
+    come first, then shorter names.
+
+    It also maps normalized names (product_name_key) to the product fields
+    /api/map/location returns, so kiosk location lookups are a dict hit, and
+    keeps shelf locations in a grid for /api/map/nearby.
+
+    The index is loaded from MongoDB at startup and kept current from the
+    catalog change journal (see catalog_sync), so queries never touch the
+    database. Local product writes are applied right away as well.
+    """
+
+    def __init__(self, min_similarity: float, refresh_interval_seconds: float, grid_cell_size: float = 500.0):
+        self.min_similarity = min_similarity
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.shelves = GridIndex(grid_cell_size)
+        self.ready = False
+        self.version = 0
+        self._names_by_id: Dict[int, str] = {}
+        self._entries: Dict[str, _Entry] = {}
+        self._by_token: Dict[str, Set[str]] = {}
+        self._by_trigram: Dict[str, Set[str]] = {}
+        self._vocabulary: Optional[List[str]] = None
+        self._by_name_key: Dict[str, Dict[int, dict]] = {}
+        self._name_keys_by_id: Dict[int, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    # --- Maintenance ---
+
+    def _add_name(self, name: str, product_id: int):
+        entry = self._entries.get(name)
+        if entry is None:
+            entry = self._entries[name] = _Entry(name)
+            for token in entry.tokens:
+                if token not in self._by_token:
+                    self._vocabulary = None
+                self._by_token.setdefault(token, set()).add(name)
+            for trigram in entry.trigrams:
+                self._by_trigram.setdefault(trigram, set()).add(name)
+        entry.product_ids.add(product_id)
+
+    def _drop_name(self, name: str, product_id: int):
+        entry = self._entries.get(name)
+        if entry is None:
+            return
+        entry.product_ids.discard(product_id)
+        if entry.product_ids:
+            return
+        del self._entries[name]
+        for token in entry.tokens:
+            names = self._by_token[token]
+            names.discard(name)
+            if not names:
+                del self._by_token[token]
+                self._vocabulary = None
+        for trigram in entry.trigrams:
+            names = self._by_trigram[trigram]
+            names.discard(name)
+            if not names:
+                del self._by_trigram[trigram]
+
+    def _drop_location(self, product_id: int):
+        key = self._name_keys_by_id.pop(product_id, None)
+        if key is None:
+            return
+        products = self._by_name_key[key]
+        products.pop(product_id, None)
+        if not products:
+            del self._by_name_key[key]
+
+    def upsert(self, product: dict):
+        product_id, name = product.get("id"), product.get("name")
+        if product_id is None:
+            return
+        previous = self._names_by_id.get(product_id)
+        if previous != name:
+            if previous is not None:
+                self._drop_name(previous, product_id)
+                del self._names_by_id[product_id]
+            if name:
+                self._names_by_id[product_id] = name
+                self._add_name(name, product_id)
+
+        self._drop_location(product_id)
+        if name:
+            key = product_name_key(name)
+            self._by_name_key.setdefault(key, {})[product_id] = {
+                field: product[field] for field in LOCATION_FIELDS if field in product
+            }
+            self._name_keys_by_id[product_id] = key
+        # Moved products are re-gridded; only their own cells change
+        self.shelves.set(product_id, location_points(product.get("location")) if name else [])
+
+    def remove(self, product_id: int):
+        name = self._names_by_id.pop(product_id, None)
+        if name is not None:
+            self._drop_name(name, product_id)
+        self._drop_location(product_id)
+        self.shelves.remove(product_id)
+
+    def load(self, products: Iterable[dict]):
+        """Replaces the whole index."""
+        self._names_by_id.clear()
+        self._entries.clear()
+        self._by_token.clear()
+        self._by_trigram.clear()
+        self._vocabulary = None
+        self._by_name_key.clear()
+        self._name_keys_by_id.clear()
+        self.shelves.clear()
+        for product in products:
+            self.upsert(product)
+
+    def apply(self, delta: dict):
+        """Applies a catalog_sync.changes_since() result."""
+        if delta["full"]:
+            self.load(delta["products"])
+        else:
+            for product in delta["products"]:
+                self.upsert(product)
+            for product_id in delta["deleted"]:
+                self.remove(product_id)
+        self.version = delta["version"]
+        self.ready = True
+
+    async def refresh(self):
+        """Catches up with the catalog change journal; loads everything the first time."""
+        products_collection = await get_products_collection()
+        changes_collection = await get_catalog_changes_collection()
+        watermark = await catalog_sync.advance(products_collection, changes_collection)
+        if self.ready and watermark == self.version:
+            return
+        since = self.version if self.ready else 0
+        self.apply(await catalog_sync.changes_since(since, products_collection, changes_collection))
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Failed to refresh product search index: {e}")
+            await asyncio.sleep(self.refresh_interval_seconds)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # --- Queries ---
+
+    def locate(self, name: str) -> Optional[dict]:
+        """
+        Returns the location fields of the product with this name (case-insensitive),
+        or None. Among products sharing a name, the lowest id with a location wins.
+        """
+        products = self._by_name_key.get(product_name_key(name))
+        if not products:
+            return None
+        product_id = min(products, key=lambda i: ("location" not in products[i], i))
+        return dict(products[product_id])
+
+    def nearby(self, x: float, y: float, radius: float, limit: int = 20) -> List[dict]:
+        """
+        Returns products with a shelf location within `radius` of (x, y), nearest
+        first, with their distance and nearest shelf point.
+        """
+        products = []
+        for distance, product_id, (px, py) in self.shelves.query(x, y, radius, limit):
+            fields = self._by_name_key[self._name_keys_by_id[product_id]][product_id]
+            products.append({
+                "id": product_id,
+                **fields,
+                "distance": round(distance, 1),
+                "nearest": {"x": px, "y": py},
+            })
+        return products
+
+    def _names_with_prefix(self, prefix: str) -> Set[str]:
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._by_token)
+        vocabulary = self._vocabulary
+        names: Set[str] = set()
+        i = bisect_left(vocabulary, prefix)
+        while i < len(vocabulary) and vocabulary[i].startswith(prefix):
+            names |= self._by_token[vocabulary[i]]
+            i += 1
+        return names
+
+    def search(self, query: str, limit: int = 20) -> List[str]:
+        """Returns up to `limit` product names for the query, best match first."""
+        folded = fold(query)
+        if not folded:
+            return []
+        words = folded.split()
+        word_prefix = set.intersection(*(self._names_with_prefix(word) for word in words))
+
+        # Exact and prefix matches are all word-prefix matches and outrank the rest,
+        # so the trigram pass is only needed while they don't fill the page
+        similarity: Dict[str, float] = {}
+        if len(word_prefix) < limit and len(folded) >= 3:
+            query_trigrams = trigrams(folded, pad_end=False)
+            # A name sharing enough trigrams must share at least one of the rarest
+            # len - needed + 1 of them, so only their postings are probed
+            needed = max(1, ceil(self.min_similarity * len(query_trigrams)))
+            rarest = sorted(query_trigrams, key=lambda t: len(self._by_trigram.get(t, ())))
+            candidates: Set[str] = set()
+            for trigram in rarest[:len(rarest) - needed + 1]:
+                candidates |= self._by_trigram.get(trigram, set())
+            for name in candidates:
+                shared = len(query_trigrams & self._entries[name].trigrams)
+                if shared >= needed:
+                    similarity[name] = shared / len(query_trigrams)
+        elif len(word_prefix) < limit:
+            # Too short for trigrams: substring scan, as cheap as it gets for a few characters
+            similarity = {name: 0.0 for name, entry in self._entries.items() if folded in entry.folded}
+
+        lowered = query.strip().lower()
+        ranked = []
+        for name in word_prefix | similarity.keys():
+            entry = self._entries[name]
+            if entry.folded == folded:
+                tier = 5
+            elif entry.folded.startswith(folded):
+                tier = 4
+            elif name in word_prefix:
+                tier = 3
+            elif folded in entry.folded:
+                tier = 2
+            else:
+                tier = 1
+            fuzzy = similarity.get(name, 0.0) if tier == 1 else 0.0
+            accents_match = lowered in name.lower()
+            ranked.append((-tier, -fuzzy, not accents_match, len(entry.folded), name))
+        ranked.sort()
+        return [item[-1] for item in ranked[:limit]]
+
+
+product_search = ProductSearchIndex(
+    min_similarity=settings.PRODUCT_SEARCH_MIN_SIMILARITY,
+    refresh_interval_seconds=settings.PRODUCT_SEARCH_REFRESH_SECONDS,
+    grid_cell_size=settings.NEARBY_GRID_CELL_SIZE,
+)
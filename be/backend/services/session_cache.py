@@ -0,0 +1,180 @@
+# backend/services/session_cache.py
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from ..config import settings
+from ..models import SessionInfo
+from ..database import get_sessions_collection
+
+
+class SessionCache:
+    """
+    Short-lived cache of active sessions keyed by session_id.
+
+    Entries live in process memory and, when a Redis client is attached, in Redis
+    so that other workers can share them. The TTL bounds how long a session
+    deactivated by another worker can still be accepted by this one.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, SessionInfo]]" = OrderedDict()
+        self._redis = None
+
+    def attach_redis(self, redis_client):
+        """Enables the shared Redis layer using an existing asyncio Redis client."""
+        self._redis = redis_client
+
+    @staticmethod
+    def _redis_key(session_id: str) -> str:
+        return f"session-cache:{session_id}"
+
+    def _store_local(self, session_info: SessionInfo):
+        self._entries[session_info.session_id] = (time.monotonic() + self.ttl_seconds, session_info)
+        self._entries.move_to_end(session_info.session_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, session_id: str) -> Optional[SessionInfo]:
+        """Returns the cached session, or None on a miss or expired entry."""
+        entry = self._entries.get(session_id)
+        if entry:
+            expires_at, session_info = entry
+            if expires_at > time.monotonic():
+                return session_info
+            self._entries.pop(session_id, None)
+
+        if self._redis is not None:
+            try:
+                raw = await self._redis.get(self._redis_key(session_id))
+            except Exception as e:
+                print(f"Session cache Redis read failed: {e}")
+                return None
+            if raw:
+                session_info = SessionInfo.model_validate_json(raw)
+                self._store_local(session_info)
+                return session_info
+        return None
+
+    async def set(self, session_info: SessionInfo):
+        """Caches an active session in memory and, if enabled, in Redis."""
+        self._store_local(session_info)
+        if self._redis is not None:
+            try:
+                await self._redis.set(
+                    self._redis_key(session_info.session_id),
+                    session_info.model_dump_json(),
+                    ex=self.ttl_seconds,
+                )
+            except Exception as e:
+                print(f"Session cache Redis write failed: {e}")
+
+    async def invalidate(self, session_ids: Iterable[str]):
+        """Drops the given sessions from every cache layer."""
+        session_ids = list(session_ids)
+        for session_id in session_ids:
+            self._entries.pop(session_id, None)
+        if self._redis is not None and session_ids:
+            try:
+                await self._redis.delete(*(self._redis_key(s) for s in session_ids))
+            except Exception as e:
+                print(f"Session cache Redis invalidation failed: {e}")
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SessionActivityBuffer:
+    """
+    Coalesces last_activity updates so each session is written at most once per
+    write interval. Pending timestamps are flushed with a single unordered
+    bulk_write by a background task.
+    """
+
+    def __init__(self, write_interval_seconds: int, flush_interval_seconds: int):
+        self.write_interval_seconds = write_interval_seconds
+        self.flush_interval_seconds = flush_interval_seconds
+        self._pending: Dict[str, datetime] = {}
+        self._last_written: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(self, session_id: str):
+        """Records activity for a session unless it was recorded within the write interval."""
+        now = time.monotonic()
+        last = self._last_written.get(session_id)
+        if last is not None and now - last < self.write_interval_seconds:
+            return
+        self._last_written[session_id] = now
+        self._pending[session_id] = datetime.utcnow()
+
+    def discard(self, session_id: str):
+        """Forgets pending activity for a session, e.g. after logout."""
+        self._pending.pop(session_id, None)
+        self._last_written.pop(session_id, None)
+
+    async def flush(self) -> int:
+        """Writes all pending last_activity updates. Returns the number of sessions flushed."""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        operations = [
+            UpdateOne(
+                {"session_id": session_id, "is_active": True},
+                {"$set": {"last_activity": last_activity}},
+            )
+            for session_id, last_activity in pending.items()
+        ]
+        try:
+            sessions_collection = await get_sessions_collection()
+            await sessions_collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            print(f"Failed to flush session activity: {e}")
+            # Keep the updates for the next flush unless newer ones arrived meanwhile
+            for session_id, last_activity in pending.items():
+                self._pending.setdefault(session_id, last_activity)
+            return 0
+
+        cutoff = time.monotonic() - self.write_interval_seconds
+        self._last_written = {
+            session_id: written_at
+            for session_id, written_at in self._last_written.items()
+            if written_at >= cutoff or session_id in self._pending
+        }
+        return len(operations)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval_seconds)
+            await self.flush()
+
+    def start(self):
+        """Starts the background flush loop on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the flush loop and writes whatever is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+session_cache = SessionCache(
+    ttl_seconds=settings.SESSION_CACHE_TTL_SECONDS,
+    max_entries=settings.SESSION_CACHE_MAX_ENTRIES,
+)
+session_activity_buffer = SessionActivityBuffer(
+    write_interval_seconds=settings.SESSION_ACTIVITY_WRITE_INTERVAL_SECONDS,
+    flush_interval_seconds=settings.SESSION_ACTIVITY_FLUSH_INTERVAL_SECONDS,
+)
@@ -2,11 +2,12 @@
 from typing import Optional
 from datetime import datetime, timedelta
 from bson import ObjectId
-from pymongo import collection
+from pymongo.asynchronous.collection import AsyncCollection
 from fastapi import HTTPException, status
 
 from ..models import SessionInfo, SessionCreate
 from ..database import get_sessions_collection
+from .session_cache import session_cache, session_activity_buffer
 
 
 class SessionService:
@@ -15,7 +16,7 @@ class SessionService:
     @staticmethod
     async def create_session(
         session_data: SessionCreate,
-        sessions_collection: collection.Collection = None
+        sessions_collection: AsyncCollection = None
     ) -> str:
         """
         Create a new session and return the session_id (MongoDB ObjectId as string).
@@ -28,7 +29,7 @@ class SessionService:
             str: Session ID (MongoDB ObjectId as string)
         """
         if sessions_collection is None:
-            sessions_collection = get_sessions_collection()
+            sessions_collection = await get_sessions_collection()
             
         # Create session with MongoDB ObjectId
         session_id = str(ObjectId())
@@ -45,23 +46,25 @@ class SessionService:
         )
         
         # Insert session into database
-        result = sessions_collection.insert_one(session_info.model_dump())
+        result = await sessions_collection.insert_one(session_info.model_dump())
         
         if not result.inserted_id:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail="Failed to create session"
             )
-            
+        
+        await session_cache.set(session_info)
         return session_id
     
     @staticmethod
     async def get_session(
         session_id: str,
-        sessions_collection: collection.Collection = None
+        sessions_collection: AsyncCollection = None
     ) -> Optional[SessionInfo]:
         """
         Retrieve session information by session_id.
+        Active sessions are served from the session cache when possible.
         
         Args:
             session_id: Session identifier
@@ -70,24 +73,30 @@ class SessionService:
         Returns:
             SessionInfo or None if not found
         """
+        cached = await session_cache.get(session_id)
+        if cached is not None:
+            return cached
+        
         if sessions_collection is None:
-            sessions_collection = get_sessions_collection()
+            sessions_collection = await get_sessions_collection()
             
-        session_doc = sessions_collection.find_one({
+        session_doc = await sessions_collection.find_one({
             "session_id": session_id,
             "is_active": True
         })
         
         if session_doc:
             session_doc.pop('_id', None)  # Remove MongoDB _id field
-            return SessionInfo(**session_doc)
+            session_info = SessionInfo(**session_doc)
+            await session_cache.set(session_info)
+            return session_info
         
         return None
     
     @staticmethod
     async def update_session_activity(
         session_id: str,
-        sessions_collection: collection.Collection = None
+        sessions_collection: AsyncCollection = None
     ) -> bool:
         """
         Update the last_activity timestamp for a session.
@@ -100,19 +109,30 @@ class SessionService:
             bool: True if session was updated, False if not found
         """
         if sessions_collection is None:
-            sessions_collection = get_sessions_collection()
+            sessions_collection = await get_sessions_collection()
             
-        result = sessions_collection.update_one(
+        result = await sessions_collection.update_one(
             {"session_id": session_id, "is_active": True},
             {"$set": {"last_activity": datetime.utcnow()}}
         )
         
         return result.modified_count > 0
     
+    @staticmethod
+    def record_session_activity(session_id: str) -> None:
+        """
+        Record activity for a session without a database round-trip.
+        The write is coalesced and flushed in bulk by the session activity buffer.
+        
+        Args:
+            session_id: Session identifier
+        """
+        session_activity_buffer.touch(session_id)
+    
     @staticmethod
     async def deactivate_session(
         session_id: str,
-        sessions_collection: collection.Collection = None
+        sessions_collection: AsyncCollection = None
     ) -> bool:
         """
         Deactivate a session (soft delete).
@@ -125,20 +145,22 @@ class SessionService:
             bool: True if session was deactivated, False if not found
         """
         if sessions_collection is None:
-            sessions_collection = get_sessions_collection()
+            sessions_collection = await get_sessions_collection()
             
-        result = sessions_collection.update_one(
+        result = await sessions_collection.update_one(
             {"session_id": session_id, "is_active": True},
             {"$set": {"is_active": False, "last_activity": datetime.utcnow()}}
         )
         
+        await session_cache.invalidate([session_id])
+        session_activity_buffer.discard(session_id)
         return result.modified_count > 0
     
     @staticmethod
     async def deactivate_user_sessions(
         user_identity: str,
         exclude_session_id: Optional[str] = None,
-        sessions_collection: collection.Collection = None
+        sessions_collection: AsyncCollection = None
     ) -> int:
         """
         Deactivate all sessions for a user, optionally excluding one session.
@@ -152,7 +174,7 @@ class SessionService:
             int: Number of sessions deactivated
         """
         if sessions_collection is None:
-            sessions_collection = get_sessions_collection()
+            sessions_collection = await get_sessions_collection()
             
         filter_query = {
             "user_identity": user_identity,
@@ -161,18 +183,22 @@ class SessionService:
         
         if exclude_session_id:
             filter_query["session_id"] = {"$ne": exclude_session_id}
-            
-        result = sessions_collection.update_many(
+        
+        session_ids = await sessions_collection.distinct("session_id", filter_query)
+        result = await sessions_collection.update_many(
             filter_query,
             {"$set": {"is_active": False, "last_activity": datetime.utcnow()}}
         )
         
+        await session_cache.invalidate(session_ids)
+        for session_id in session_ids:
+            session_activity_buffer.discard(session_id)
         return result.modified_count
     
     @staticmethod
     async def cleanup_expired_sessions(
         expiry_hours: int = 24,
-        sessions_collection: collection.Collection = None
+        sessions_collection: AsyncCollection = None
     ) -> int:
         """
         Clean up sessions that haven't been active for the specified hours.
@@ -185,25 +211,30 @@ class SessionService:
             int: Number of sessions cleaned up
         """
         if sessions_collection is None:
-            sessions_collection = get_sessions_collection()
+            sessions_collection = await get_sessions_collection()
             
         expiry_time = datetime.utcnow() - timedelta(hours=expiry_hours)
+        filter_query = {
+            "last_activity": {"$lt": expiry_time},
+            "is_active": True
+        }
         
-        result = sessions_collection.update_many(
-            {
-                "last_activity": {"$lt": expiry_time},
-                "is_active": True
-            },
+        # Write pending activity first so recently used sessions are not expired
+        await session_activity_buffer.flush()
+        session_ids = await sessions_collection.distinct("session_id", filter_query)
+        result = await sessions_collection.update_many(
+            filter_query,
             {"$set": {"is_active": False}}
         )
         
+        await session_cache.invalidate(session_ids)
         return result.modified_count
     
     @staticmethod
     async def validate_session(
         session_id: str,
         user_identity: str,
-        sessions_collection: collection.Collection = None
+        sessions_collection: AsyncCollection = None
     ) -> bool:
         """
         Validate that a session exists, is active, and belongs to the specified user.
@@ -0,0 +1,102 @@
+# backend/services/spatial_index.py
+from math import floor, hypot
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+Point = Tuple[float, float]
+
+
+def location_points(location) -> List[Point]:
+    """Returns the (x, y) points of a product 'location' value (a point or a list of points)."""
+    if location is None:
+        return []
+    if not isinstance(location, list):
+        location = [location]
+    points = []
+    for point in location:
+        if isinstance(point, dict) and isinstance(point.get("x"), (int, float)) and isinstance(point.get("y"), (int, float)):
+            points.append((float(point["x"]), float(point["y"])))
+    return points
+
+
+class GridIndex:
+    """
+    Uniform grid over map coordinates. Every key (a product id) owns a few
+    points; a radius query only visits the cells overlapping the circle's
+    bounding box, so its cost depends on the local density, not on the
+    catalog size. Keys can be moved or removed one at a time.
+    """
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self._cells: Dict[Tuple[int, int], Set[Hashable]] = {}
+        self._points: Dict[Hashable, List[Point]] = {}
+        # Bumped on every change so consumers can tell when to recompute
+        self.revision = 0
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return floor(x / self.cell_size), floor(y / self.cell_size)
+
+    def points(self, key: Hashable) -> List[Point]:
+        return list(self._points.get(key, ()))
+
+    def snapshot(self) -> Dict[Hashable, List[Point]]:
+        """A copy of every key's points."""
+        return {key: list(points) for key, points in self._points.items()}
+
+    def clear(self):
+        self._cells.clear()
+        self._points.clear()
+        self.revision += 1
+
+    def remove(self, key: Hashable):
+        if key in self._points:
+            self.revision += 1
+        for point in self._points.pop(key, ()):
+            cell = self._cell(*point)
+            keys = self._cells.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._cells[cell]
+
+    def set(self, key: Hashable, points: Iterable[Point]):
+        """Replaces the points of a key; no points removes it."""
+        points = list(points)
+        if points == self._points.get(key):
+            return
+        self.remove(key)
+        if not points:
+            return
+        self.revision += 1
+        self._points[key] = points
+        for point in points:
+            self._cells.setdefault(self._cell(*point), set()).add(key)
+
+    def query(self, x: float, y: float, radius: float, limit: Optional[int] = None) -> List[Tuple[float, Hashable, Point]]:
+        """
+        Returns (distance, key, nearest point) for every key with a point within
+        `radius` of (x, y), nearest first.
+        """
+        min_col, min_row = self._cell(x - radius, y - radius)
+        max_col, max_row = self._cell(x + radius, y + radius)
+        candidates: Set[Hashable] = set()
+        if (max_col - min_col + 1) * (max_row - min_row + 1) > len(self._cells):
+            # The circle covers more cells than are occupied: walk the occupied ones
+            for (col, row), keys in self._cells.items():
+                if min_col <= col <= max_col and min_row <= row <= max_row:
+                    candidates |= keys
+        else:
+            for col in range(min_col, max_col + 1):
+                for row in range(min_row, max_row + 1):
+                    candidates |= self._cells.get((col, row), set())
+
+        results = []
+        for key in candidates:
+            distance, point = min((hypot(px - x, py - y), (px, py)) for px, py in self._points[key])
+            if distance <= radius:
+                results.append((distance, key, point))
+        results.sort(key=lambda result: (result[0], result[1]))
+        return results[:limit] if limit is not None else results
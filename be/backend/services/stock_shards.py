@@ -0,0 +1,196 @@
+# backend/services/stock_shards.py
+import random
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.database import Database
+
+# Stock of a hot product can be split over sub-counters so concurrent orders
+# don't all write the one product document. A sharded product carries
+# `stock_shards: <count>` and its stock is its own `quantity` (normally 0) plus
+# the `quantity` of its documents in the stock_shards collection,
+# {product_id, shard, quantity}. Readers get the sum in `quantity` through
+# sum_into(), and the product cache keeps that sum until the next stock change.
+SHARDS_COLLECTION = "stock_shards"
+SHARD_COUNT_FIELD = "stock_shards"
+
+
+def split(quantity: int, shard_count: int) -> List[int]:
+    """Spreads a quantity as evenly as possible over the shards."""
+    base, extra = divmod(quantity, shard_count)
+    return [base + (1 if shard < extra else 0) for shard in range(shard_count)]
+
+
+async def sum_into(products: Iterable[dict], products_collection: AsyncCollection) -> None:
+    """
+    Sets `quantity` of the sharded products among `products` to their total
+    stock, in place. Costs nothing when none of them is sharded.
+    """
+    sharded = [product for product in products if product and product.get(SHARD_COUNT_FIELD)]
+    if not sharded:
+        return
+    shards_collection = products_collection.database[SHARDS_COLLECTION]
+    cursor = await shards_collection.aggregate([
+        {"$match": {"product_id": {"$in": [product["id"] for product in sharded]}}},
+        {"$group": {"_id": "$product_id", "quantity": {"$sum": "$quantity"}}},
+    ])
+    totals = {row["_id"]: row["quantity"] async for row in cursor}
+    for product in sharded:
+        product["quantity"] = product.get("quantity", 0) + totals.get(product["id"], 0)
+
+
+async def set_quantity(products_collection: AsyncCollection, product_id: int, shard_count: int, quantity: int) -> None:
+    """
+    Sets a sharded product's stock (e.g. an admin edit) by resetting its
+    sub-counters; the caller then sets the product's own quantity to 0.
+    """
+    await products_collection.database[SHARDS_COLLECTION].bulk_write([
+        UpdateOne({"product_id": product_id, "shard": shard}, {"$set": {"quantity": part}}, upsert=True)
+        for shard, part in enumerate(split(quantity, shard_count))
+    ], ordered=False)
+
+
+# --- Synchronous helpers for the Celery worker and migrations ---
+
+def shard_counts_sync(db: Database, product_ids: Iterable[int], session=None) -> Dict[int, int]:
+    """Shard count of each sharded product among `product_ids`; unsharded ones are left out."""
+    return {product["id"]: product[SHARD_COUNT_FIELD] for product in db["products"].find(
+        {"id": {"$in": list(product_ids)}, SHARD_COUNT_FIELD: {"$gt": 0}}, {"id": 1, SHARD_COUNT_FIELD: 1}, session=session
+    )}
+
+
+def stock_on_hand_sync(db: Database, product_ids: Iterable[int], session=None) -> Dict[int, int]:
+    """Total stock per product, summing the shards of sharded products."""
+    stock, sharded = {}, []
+    for product in db["products"].find(
+        {"id": {"$in": list(product_ids)}}, {"id": 1, "quantity": 1, SHARD_COUNT_FIELD: 1}, session=session
+    ):
+        stock[product["id"]] = product.get("quantity", 0)
+        if product.get(SHARD_COUNT_FIELD):
+            sharded.append(product["id"])
+    if sharded:
+        for row in db[SHARDS_COLLECTION].aggregate([
+            {"$match": {"product_id": {"$in": sharded}}},
+            {"$group": {"_id": "$product_id", "quantity": {"$sum": "$quantity"}}},
+        ], session=session):
+            stock[row["_id"]] += row["quantity"]
+    return stock
+
+
+def _unsharded_decrement(product_id: int, quantity: int, version: int):
+    return (
+        {"id": product_id, "quantity": {"$gte": quantity}, SHARD_COUNT_FIELD: {"$exists": False}},
+        {"$inc": {"quantity": -quantity}, "$set": {"catalog_version": version}},
+    )
+
+
+def unsharded_decrement(product_id: int, quantity: int, version: int) -> UpdateOne:
+    """Guarded decrement of a product's own quantity for bulk writes; never matches once the product is sharded."""
+    return UpdateOne(*_unsharded_decrement(product_id, quantity, version))
+
+
+def take_sync(db: Database, product_id: int, quantity: int, version: int, shard_count: int = 0, session=None) -> bool:
+    """
+    Guarded decrement of a product's stock in whichever form it is kept.
+    A sharded product is decremented on a random shard; only when that shard
+    is short is the quantity gathered from the fullest shards, and given back
+    if they don't add up. Returns False, with nothing taken, if stock is short.
+    """
+    if not shard_count:
+        return db["products"].update_one(*_unsharded_decrement(product_id, quantity, version), session=session).matched_count == 1
+
+    shards_collection = db[SHARDS_COLLECTION]
+    result = shards_collection.update_one(
+        {"product_id": product_id, "shard": random.randrange(shard_count), "quantity": {"$gte": quantity}},
+        {"$inc": {"quantity": -quantity}, "$set": {"catalog_version": version}},
+        session=session
+    )
+    if result.matched_count:
+        return True
+
+    remaining, taken = quantity, []
+    for shard in shards_collection.find(
+        {"product_id": product_id, "quantity": {"$gt": 0}}, {"shard": 1, "quantity": 1}, session=session
+    ).sort([("quantity", DESCENDING), ("shard", ASCENDING)]):
+        part = min(shard["quantity"], remaining)
+        result = shards_collection.update_one(
+            {"product_id": product_id, "shard": shard["shard"], "quantity": {"$gte": part}},
+            {"$inc": {"quantity": -part}, "$set": {"catalog_version": version}},
+            session=session
+        )
+        if result.matched_count:
+            taken.append((shard["shard"], part))
+            remaining -= part
+            if remaining == 0:
+                return True
+    # Stock returned to the product itself (e.g. during a migration) is the last resort
+    if db["products"].update_one(
+        {"id": product_id, "quantity": {"$gte": remaining}}, {"$inc": {"quantity": -remaining}}, session=session
+    ).matched_count:
+        return True
+    if taken:
+        shards_collection.bulk_write([
+            UpdateOne({"product_id": product_id, "shard": shard}, {"$inc": {"quantity": part}}) for shard, part in taken
+        ], ordered=False, session=session)
+    return False
+
+
+def give_back_sync(db: Database, product_id: int, quantity: int, version: int, shard_count: int = 0, session=None):
+    """Returns stock taken by take_sync(). A shard that no longer exists hands it to the product itself."""
+    if shard_count and db[SHARDS_COLLECTION].update_one(
+        {"product_id": product_id, "shard": random.randrange(shard_count)},
+        {"$inc": {"quantity": quantity}, "$set": {"catalog_version": version}},
+        session=session
+    ).matched_count:
+        return
+    db["products"].update_one(
+        {"id": product_id}, {"$inc": {"quantity": quantity}, "$set": {"catalog_version": version}}, session=session
+    )
+
+
+def shard_product_sync(db: Database, product_id: int, shard_count: int, session=None) -> Optional[int]:
+    """
+    Moves a product's stock into `shard_count` sub-counters. The product is
+    flagged first, so unsharded decrements stop matching, then its quantity
+    is moved over. Returns the quantity moved, or None if the product is
+    missing or already sharded.
+    """
+    flagged = db["products"].update_one(
+        {"id": product_id, SHARD_COUNT_FIELD: {"$exists": False}}, {"$set": {SHARD_COUNT_FIELD: shard_count}}, session=session
+    )
+    if flagged.matched_count == 0:
+        return None
+    db[SHARDS_COLLECTION].bulk_write([
+        UpdateOne({"product_id": product_id, "shard": shard}, {"$setOnInsert": {"quantity": 0}}, upsert=True)
+        for shard in range(shard_count)
+    ], ordered=False, session=session)
+    product = db["products"].find_one_and_update(
+        {"id": product_id}, {"$set": {"quantity": 0}}, {"quantity": 1}, return_document=ReturnDocument.BEFORE, session=session
+    )
+    moved = product.get("quantity", 0)
+    if moved:
+        db[SHARDS_COLLECTION].bulk_write([
+            UpdateOne({"product_id": product_id, "shard": shard}, {"$inc": {"quantity": part}})
+            for shard, part in enumerate(split(moved, shard_count)) if part
+        ], ordered=False, session=session)
+    return moved
+
+
+def unshard_product_sync(db: Database, product_id: int, session=None) -> Optional[int]:
+    """
+    Folds a sharded product's sub-counters back into its quantity, one shard
+    at a time, so its total stays right while orders keep coming. Returns the
+    quantity moved, or None if the product is not sharded.
+    """
+    product = db["products"].find_one({"id": product_id, SHARD_COUNT_FIELD: {"$gt": 0}}, {SHARD_COUNT_FIELD: 1}, session=session)
+    if product is None:
+        return None
+    moved = 0
+    for shard in db[SHARDS_COLLECTION].find({"product_id": product_id}, {"shard": 1}, session=session):
+        deleted = db[SHARDS_COLLECTION].find_one_and_delete({"_id": shard["_id"]}, session=session)
+        if deleted and deleted.get("quantity"):
+            db["products"].update_one({"id": product_id}, {"$inc": {"quantity": deleted["quantity"]}}, session=session)
+            moved += deleted["quantity"]
+    db["products"].update_one({"id": product_id}, {"$unset": {SHARD_COUNT_FIELD: ""}}, session=session)
+    return moved
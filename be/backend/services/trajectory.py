@@ -0,0 +1,118 @@
+# backend/services/trajectory.py
+from typing import List, Tuple
+
+import numpy as np
+
+
+def detect_stops(xy: np.ndarray, t: np.ndarray, radius: float, min_duration: float) -> List[Tuple[int, int]]:
+    """
+    Finds stops: runs of consecutive points that stay within `radius` of the
+    run's first point for at least `min_duration` seconds.
+
+    Args:
+        xy: (n, 2) positions in time order
+        t: (n,) timestamps in seconds
+
+    Returns:
+        (first_index, last_index) pairs, one per stop.
+    """
+    stops = []
+    anchor = 0
+    for i in range(1, len(xy) + 1):
+        if i < len(xy) and np.hypot(*(xy[i] - xy[anchor])) <= radius:
+            continue
+        if i - 1 > anchor and t[i - 1] - t[anchor] >= min_duration:
+            stops.append((anchor, i - 1))
+        anchor = i
+    return stops
+
+
+def rdp_mask(xy: np.ndarray, tolerance: float, keep: np.ndarray = None) -> np.ndarray:
+    """
+    Ramer-Douglas-Peucker simplification. Returns a boolean mask of points to keep.
+
+    Points already set in `keep` are always kept and split the path into
+    independent segments, so stop points survive any tolerance.
+    """
+    n = len(xy)
+    mask = np.zeros(n, dtype=bool) if keep is None else keep.copy()
+    if n == 0:
+        return mask
+    mask[0] = mask[-1] = True
+
+    anchors = np.flatnonzero(mask)
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = xy[start + 1:end]
+        direction = xy[end] - xy[start]
+        length = np.hypot(*direction)
+        offsets = segment - xy[start]
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            mask[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return mask
+
+
+def bucket_groups(t: np.ndarray, bucket_seconds: float, keep: np.ndarray) -> np.ndarray:
+    """
+    Assigns every point to a time bucket of `bucket_seconds`. Points set in
+    `keep` get a group of their own and start a new segment, so averaging
+    never smears a stop into the movement around it.
+
+    Returns (n,) group ids, numbered in time order.
+    """
+    n = len(t)
+    if n == 0:
+        return np.empty(0, dtype=int)
+    segment = np.cumsum(keep)
+    bucket = np.floor((t - t[0]) / bucket_seconds).astype(np.int64)
+    # Forced points become unique keys; everything else shares (segment, bucket)
+    keys = np.where(keep, -1 - np.arange(n), bucket)
+    boundaries = np.ones(n, dtype=bool)
+    boundaries[1:] = (segment[1:] != segment[:-1]) | (keys[1:] != keys[:-1])
+    return np.cumsum(boundaries) - 1
+
+
+def simplify(
+    xy: np.ndarray,
+    t: np.ndarray,
+    mode: str,
+    tolerance: float,
+    bucket_seconds: float,
+    stop_radius: float,
+    stop_seconds: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Simplifies one trajectory given in time order.
+
+    Returns (xy, t, source_index, is_stop) for the output points, where
+    source_index points at the first input sample each output point came from.
+    """
+    keep = np.zeros(len(xy), dtype=bool)
+    for first, last in detect_stops(xy, t, stop_radius, stop_seconds):
+        keep[first] = keep[last] = True
+
+    if mode == "rdp":
+        indices = np.flatnonzero(rdp_mask(xy, tolerance, keep))
+        return xy[indices], t[indices], indices, keep[indices]
+
+    groups = bucket_groups(t, bucket_seconds, keep)
+    count = groups[-1] + 1 if len(groups) else 0
+    sizes = np.bincount(groups, minlength=count)
+    averaged = np.column_stack([
+        np.bincount(groups, weights=xy[:, 0], minlength=count),
+        np.bincount(groups, weights=xy[:, 1], minlength=count),
+    ]) / sizes[:, None]
+    times = np.bincount(groups, weights=t, minlength=count) / sizes
+    first = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if len(groups) else groups
+    return averaged, times, first, keep[first]
@@ -0,0 +1,289 @@
+# backend/services/uwb_positioning.py
+import math
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..config import settings
+
+
+def solve_positions(
+    distances: np.ndarray,
+    anchors: np.ndarray,
+    min_range: float,
+    max_range: float,
+    residual_threshold: float,
+    refine_iterations: int = 3,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Solves 2D positions for a whole batch of range measurements.
+
+    Each anchor i gives  -2*xi*x - 2*yi*y + (x^2 + y^2) = di^2 - xi^2 - yi^2,
+    which is linear in (x, y, x^2 + y^2). Every row can therefore be weighted
+    independently, so out-of-bounds or outlier ranges are simply masked out.
+    The linear estimate is refined with a few Gauss-Newton steps on the true
+    range residuals. Samples with the worst residual above the threshold drop
+    that anchor and are solved again.
+
+    Args:
+        distances: (n, k) ranges to k anchors, NaN for missing values
+        anchors: (k, 2) anchor coordinates
+        min_range, max_range: plausible range bounds; others are rejected
+        residual_threshold: max |range residual| before an anchor is dropped
+
+    Returns:
+        positions (n, 2), NaN where fewer than three usable ranges remain,
+        and the (n, k) mask of ranges that were used.
+    """
+    distances = np.asarray(distances, dtype=float)
+    anchors = np.asarray(anchors, dtype=float)
+    mask = np.isfinite(distances) & (distances >= min_range) & (distances <= max_range)
+
+    positions = _weighted_solve(distances, anchors, mask, refine_iterations)
+
+    # Drop the worst range once for samples that still disagree with their solution
+    residuals = np.abs(np.linalg.norm(positions[:, None, :] - anchors[None, :, :], axis=2) - distances)
+    residuals = np.where(mask, residuals, -np.inf)
+    worst = np.argmax(residuals, axis=1)
+    rows = np.arange(len(distances))
+    needs_retry = (residuals[rows, worst] > residual_threshold) & (mask.sum(axis=1) > 3)
+    if needs_retry.any():
+        mask[rows[needs_retry], worst[needs_retry]] = False
+        positions[needs_retry] = _weighted_solve(
+            distances[needs_retry], anchors, mask[needs_retry], refine_iterations
+        )
+
+    positions[mask.sum(axis=1) < 3] = np.nan
+    return positions, mask
+
+
+def _weighted_solve(distances: np.ndarray, anchors: np.ndarray, mask: np.ndarray, refine_iterations: int) -> np.ndarray:
+    n = len(distances)
+    if n == 0:
+        return np.empty((0, 2))
+    weights = mask.astype(float)
+    d = np.where(mask, distances, 0.0)
+
+    # Linear least squares in (x, y, x^2 + y^2), one 3x3 normal system per sample
+    design = np.column_stack([-2 * anchors[:, 0], -2 * anchors[:, 1], np.ones(len(anchors))])  # (k, 3)
+    rhs = d ** 2 - (anchors ** 2).sum(axis=1)[None, :]  # (n, k)
+    ata = np.einsum("nk,ki,kj->nij", weights, design, design)
+    atb = np.einsum("nk,ki,nk->ni", weights, design, rhs)
+    solvable = weights.sum(axis=1) >= 3
+    ata[~solvable] = np.eye(3)
+    atb[~solvable] = 0.0
+    try:
+        solution = np.linalg.solve(ata, atb[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        solution = np.einsum("nij,nj->ni", np.linalg.pinv(ata), atb)
+    positions = solution[:, :2]
+
+    # Gauss-Newton refinement on the actual range residuals
+    for _ in range(refine_iterations):
+        delta = positions[:, None, :] - anchors[None, :, :]  # (n, k, 2)
+        predicted = np.maximum(np.linalg.norm(delta, axis=2), 1e-6)  # (n, k)
+        jacobian = delta / predicted[..., None]
+        residual = d - predicted
+        jtj = np.einsum("nk,nki,nkj->nij", weights, jacobian, jacobian) + np.eye(2) * 1e-9
+        jtr = np.einsum("nk,nki,nk->ni", weights, jacobian, residual)
+        positions = positions + np.linalg.solve(jtj, jtr[..., None])[..., 0]
+
+    positions[~solvable] = np.nan
+    return positions
+
+
+def _sort_key(timestamp: Optional[datetime]) -> float:
+    if timestamp is None:
+        return math.inf
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.timestamp()
+
+
+class AlphaBetaSmoother:
+    """Constant-velocity alpha-beta filter for one cart."""
+
+    def __init__(self, alpha: float, beta: float, gate: float):
+        self.alpha = alpha
+        self.beta = beta
+        self.gate = gate
+        self.position: Optional[np.ndarray] = None
+        self.velocity = np.zeros(2)
+
+    def update(self, dt: float, measurement: np.ndarray) -> np.ndarray:
+        if self.position is None:
+            self.position = measurement.copy()
+            return self.position.copy()
+        predicted = self.position + self.velocity * dt
+        innovation = measurement - predicted
+        if np.linalg.norm(innovation) > self.gate:
+            # Implausible jump: keep the prediction
+            self.position = predicted
+            return predicted.copy()
+        self.position = predicted + self.alpha * innovation
+        if dt > 0:
+            self.velocity = self.velocity + (self.beta / dt) * innovation
+        return self.position.copy()
+
+
+class KalmanSmoother:
+    """Constant-velocity Kalman filter (independent x and y axes) for one cart."""
+
+    def __init__(self, process_noise: float, measurement_noise: float, gate: float):
+        self.q = process_noise
+        self.r = measurement_noise
+        self.gate = gate
+        self.state: Optional[np.ndarray] = None  # (2 axes, [position, velocity])
+        self.covariance = np.zeros((2, 2, 2))
+
+    def update(self, dt: float, measurement: np.ndarray) -> np.ndarray:
+        if self.state is None:
+            self.state = np.column_stack([measurement, np.zeros(2)])
+            self.covariance = np.tile(np.diag([self.r, self.r * 10]), (2, 1, 1))
+            return measurement.copy()
+        transition = np.array([[1.0, dt], [0.0, 1.0]])
+        process = self.q * np.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]])
+        state = self.state @ transition.T
+        covariance = transition @ self.covariance @ transition.T + process
+        innovation = measurement - state[:, 0]
+        if np.linalg.norm(innovation) > self.gate:
+            self.state, self.covariance = state, covariance
+            return state[:, 0].copy()
+        innovation_var = covariance[:, 0, 0] + self.r
+        gain = covariance[:, :, 0] / innovation_var[:, None]  # (2 axes, 2)
+        self.state = state + gain * innovation[:, None]
+        self.covariance = covariance - gain[:, :, None] * covariance[:, None, 0, :]
+        return self.state[:, 0].copy()
+
+
+class UWBPositioningEngine:
+    """
+    Server-side UWB positioning: batch trilateration followed by an optional
+    per-cart smoother. Live ingest keeps smoother state per cart in memory;
+    replay() runs with fresh state so history can be reprocessed with other
+    parameters without disturbing live tracking.
+    """
+
+    def __init__(
+        self,
+        anchors: Sequence[Sequence[float]],
+        smoother: str = "none",
+        min_range: float = 0.0,
+        max_range: float = math.inf,
+        residual_threshold: float = math.inf,
+        alpha: float = 0.5,
+        beta: float = 0.1,
+        process_noise: float = 100.0,
+        measurement_noise: float = 400.0,
+        gate: float = math.inf,
+        reset_after_seconds: float = 30.0,
+    ):
+        self.anchors = np.asarray(anchors, dtype=float)
+        self.smoother = smoother
+        self.min_range = min_range
+        self.max_range = max_range
+        self.residual_threshold = residual_threshold
+        self.alpha = alpha
+        self.beta = beta
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.gate = gate
+        self.reset_after_seconds = reset_after_seconds
+        self._tracks: Dict[Optional[str], Tuple[object, datetime]] = {}
+
+    def _new_smoother(self):
+        if self.smoother == "alpha_beta":
+            return AlphaBetaSmoother(self.alpha, self.beta, self.gate)
+        if self.smoother == "kalman":
+            return KalmanSmoother(self.process_noise, self.measurement_noise, self.gate)
+        return None
+
+    def _distance_matrix(self, samples: List[dict]) -> np.ndarray:
+        k = len(self.anchors)
+        matrix = np.full((len(samples), k), np.nan)
+        for row, sample in enumerate(samples):
+            ranges = sample.get("raw_distances") or []
+            count = min(len(ranges), k)
+            if count:
+                matrix[row, :count] = [np.nan if r is None else r for r in ranges[:count]]
+        return matrix
+
+    def _smooth(self, samples: List[dict], positions: np.ndarray, tracks: Dict) -> np.ndarray:
+        if self.smoother == "none":
+            return positions
+        smoothed = positions.copy()
+        # Filters are sequential per cart, so visit samples in time order
+        order = sorted(range(len(samples)), key=lambda i: _sort_key(samples[i].get("timestamp")))
+        for i in order:
+            if not np.isfinite(positions[i]).all():
+                continue
+            cart_id = samples[i].get("cart_id")
+            timestamp = samples[i].get("timestamp") or datetime.utcnow()
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+            track = tracks.get(cart_id)
+            dt = (timestamp - track[1]).total_seconds() if track else None
+            if track is None or dt is None or dt < 0 or dt > self.reset_after_seconds:
+                track = (self._new_smoother(), timestamp)
+                dt = 0.0
+            smoother = track[0]
+            smoothed[i] = smoother.update(dt, positions[i])
+            tracks[cart_id] = (smoother, timestamp)
+        return smoothed
+
+    def locate(self, samples: List[dict], tracks: Optional[Dict] = None) -> np.ndarray:
+        """Returns (n, 2) positions for the samples, NaN where unsolvable."""
+        if not samples:
+            return np.empty((0, 2))
+        positions, _ = solve_positions(
+            self._distance_matrix(samples),
+            self.anchors,
+            self.min_range,
+            self.max_range,
+            self.residual_threshold,
+        )
+        return self._smooth(samples, positions, self._tracks if tracks is None else tracks)
+
+    def apply(self, samples: List[dict]) -> int:
+        """
+        Overwrites x/y of ingested samples in place with server-solved positions,
+        using the live per-cart smoother state. Returns the number of samples solved.
+        """
+        positions = self.locate(samples)
+        solved = 0
+        for sample, (x, y) in zip(samples, positions):
+            if np.isfinite(x) and np.isfinite(y):
+                sample["x"] = round(float(x), 1)
+                sample["y"] = round(float(y), 1)
+                sample["position_source"] = "server"
+                solved += 1
+            elif not sample.get("position_source"):
+                sample["position_source"] = "device"
+        return solved
+
+    def replay(self, samples: List[dict]) -> np.ndarray:
+        """Recomputes positions for historical samples with fresh smoother state."""
+        return self.locate(samples, tracks={})
+
+
+def engine_from_settings(**overrides) -> UWBPositioningEngine:
+    """Builds an engine from Settings; keyword overrides replace individual parameters."""
+    params = {
+        "anchors": settings.UWB_ANCHORS,
+        "smoother": settings.UWB_SMOOTHER,
+        "min_range": settings.UWB_MIN_RANGE,
+        "max_range": settings.UWB_MAX_RANGE,
+        "residual_threshold": settings.UWB_RESIDUAL_THRESHOLD,
+        "alpha": settings.UWB_ALPHA,
+        "beta": settings.UWB_BETA,
+        "process_noise": settings.UWB_KALMAN_PROCESS_NOISE,
+        "measurement_noise": settings.UWB_KALMAN_MEASUREMENT_NOISE,
+        "gate": settings.UWB_GATE_DISTANCE,
+        "reset_after_seconds": settings.UWB_TRACK_RESET_SECONDS,
+    }
+    params.update({key: value for key, value in overrides.items() if value is not None})
+    return UWBPositioningEngine(**params)
+
+
+positioning_engine = engine_from_settings()
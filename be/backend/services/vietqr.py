@@ -0,0 +1,120 @@
+# backend/services/vietqr.py
+import io
+import unicodedata
+from typing import Optional
+
+import httpx
+import qrcode
+import qrcode.image.svg
+
+from ..config import settings
+from ..models import VietQRGenerateRequest, VietQRGenerateResponse
+
+# NAPAS application id and service codes of VietQR (EMVCo merchant account information, tag 38)
+NAPAS_GUID = "A000000727"
+SERVICE_TRANSFER_TO_ACCOUNT = "QRIBFTTA"
+CURRENCY_VND = "704"
+COUNTRY_VN = "VN"
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16_ccitt(data: bytes) -> int:
+    """CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF), the EMVCo QR checksum."""
+    crc = 0xFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def tlv(tag: str, value: str) -> str:
+    """One EMVCo field: two-digit tag, two-digit length, value."""
+    if len(value) > 99:
+        raise ValueError(f"EMVCo field {tag} is longer than 99 characters")
+    return f"{tag}{len(value):02d}{value}"
+
+
+def ascii_text(text: str) -> str:
+    """Banking apps show transfer notes as plain ASCII: drops diacritics ("Thanh toán" -> "Thanh toan")."""
+    text = unicodedata.normalize("NFD", text.replace("đ", "d").replace("Đ", "D"))
+    return "".join(ch for ch in text if ch.isascii() and not unicodedata.combining(ch) and ch.isprintable())
+
+
+def build_payload(bank_bin: str, account_no: str, amount: Optional[int] = None, add_info: str = "") -> str:
+    """
+    Builds the EMVCo payload of a VietQR transfer to a bank account, the same
+    string the VietQR generate API returns in `qrCode`. With an amount the QR
+    is dynamic (for one payment), without one it is static.
+    """
+    if not bank_bin.isdigit() or len(bank_bin) != 6:
+        raise ValueError("VietQR bank BIN must be 6 digits")
+    if not account_no or not account_no.isalnum():
+        raise ValueError("VietQR account number must be alphanumeric")
+    beneficiary = tlv("00", bank_bin) + tlv("01", account_no)
+    fields = [
+        tlv("00", "01"),
+        tlv("01", "12" if amount is not None else "11"),
+        tlv("38", tlv("00", NAPAS_GUID) + tlv("01", beneficiary) + tlv("02", SERVICE_TRANSFER_TO_ACCOUNT)),
+        tlv("53", CURRENCY_VND),
+    ]
+    if amount is not None:
+        if amount <= 0:
+            raise ValueError("VietQR amount must be positive")
+        fields.append(tlv("54", str(int(amount))))
+    fields.append(tlv("58", COUNTRY_VN))
+    add_info = ascii_text(add_info)
+    if add_info:
+        fields.append(tlv("62", tlv("08", add_info)))
+    payload = "".join(fields) + "6304"
+    return payload + f"{crc16_ccitt(payload.encode('ascii')):04X}"
+
+
+def render_svg(payload: str) -> str:
+    """SVG of the QR code; CPU-bound, so callers on the event loop run it in a thread."""
+    img = qrcode.make(payload, image_factory=qrcode.image.svg.SvgPathImage)
+    stream = io.BytesIO()
+    img.save(stream)
+    return stream.getvalue().decode('utf-8')
+
+
+class VietQRClient:
+    """
+    The VietQR generate API, kept as an optional fallback for the local
+    payload builder. One pooled HTTP client is shared by all requests of the
+    process and closed at shutdown.
+    """
+
+    def __init__(self, api_url: str, timeout_seconds: float):
+        self.api_url = api_url
+        self.timeout_seconds = timeout_seconds
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def generate(self, request: VietQRGenerateRequest) -> VietQRGenerateResponse:
+        """Raises httpx.HTTPError if the API can't be reached or answers with an error status."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout_seconds)
+        response = await self._client.post(self.api_url, json=request.model_dump())
+        response.raise_for_status()
+        return VietQRGenerateResponse.model_validate(response.json())
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+vietqr_client = VietQRClient(
+    api_url=settings.VIETQR_API_URL,
+    timeout_seconds=settings.VIETQR_API_TIMEOUT_SECONDS,
+)
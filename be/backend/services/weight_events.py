@@ -0,0 +1,209 @@
+# backend/services/weight_events.py
+from collections import deque
+from datetime import datetime, timezone
+from itertools import accumulate
+from statistics import median
+from typing import Dict, List, Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from ..config import settings
+
+PROCESSED_BY = "server"
+
+
+def _naive_utc(timestamp: datetime) -> datetime:
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def _stream_key(document: dict) -> Optional[str]:
+    return document.get("cart_id") or document.get("session_id")
+
+
+class _StreamState:
+    """Per-cart detector state for incremental mode."""
+
+    def __init__(self, filter_window: int, stable_samples: int):
+        self.raw = deque(maxlen=filter_window)
+        self.ema: Optional[float] = None
+        self.recent = deque(maxlen=stable_samples)
+        self.was_stable = False
+        self.stable_weight: Optional[float] = None
+        self.last_timestamp: Optional[datetime] = None
+
+    def reset_filter(self):
+        self.raw.clear()
+        self.ema = None
+        self.recent.clear()
+        self.was_stable = False
+
+
+class WeightEventDetector:
+    """
+    Detects add/remove events in the weight stream of each cart.
+
+    Readings are smoothed with a causal median or EMA filter. A plateau is
+    reached when the last `stable_samples` filtered readings stay within
+    `stable_tolerance` grams; its weight is their mean. When a new plateau
+    differs from the previous stable weight (initially the cart's
+    last_stable_weight) by at least `min_step` grams, an event is emitted.
+    Gaps longer than `reset_after_seconds` restart the filter but keep the
+    stable weight.
+
+    process() is the incremental mode with per-cart state in memory;
+    detect_batch() re-processes a history with NumPy and yields the same events.
+    """
+
+    def __init__(
+        self,
+        filter_type: str = "median",
+        filter_window: int = 5,
+        ema_alpha: float = 0.3,
+        stable_samples: int = 5,
+        stable_tolerance: float = 5.0,
+        min_step: float = 20.0,
+        reset_after_seconds: float = 30.0,
+    ):
+        self.filter_type = filter_type
+        self.filter_window = filter_window
+        self.ema_alpha = ema_alpha
+        self.stable_samples = stable_samples
+        self.stable_tolerance = stable_tolerance
+        self.min_step = min_step
+        self.reset_after_seconds = reset_after_seconds
+        self._streams: Dict[Optional[str], _StreamState] = {}
+
+    def _event(self, reading: dict, weight_before: float, weight_after: float) -> dict:
+        return {
+            "event_type": "add" if weight_after > weight_before else "remove",
+            "weight_before": round(weight_before, 1),
+            "weight_after": round(weight_after, 1),
+            "weight_difference": round(weight_after - weight_before, 1),
+            "timestamp": reading["timestamp"],
+            "session_id": reading.get("session_id"),
+            "cart_id": reading.get("cart_id"),
+            "processed_by": PROCESSED_BY,
+        }
+
+    def _plateau(self, reading: dict, plateau: float, stable_weight: Optional[float]):
+        """Returns (event or None, new stable weight) for a newly reached plateau."""
+        if stable_weight is None:
+            stable_weight = reading.get("last_stable_weight")
+        if stable_weight is None:
+            return None, plateau
+        if abs(plateau - stable_weight) >= self.min_step:
+            return self._event(reading, stable_weight, plateau), plateau
+        return None, stable_weight
+
+    # --- Incremental mode ---
+
+    def _update(self, state: _StreamState, reading: dict) -> Optional[dict]:
+        timestamp = _naive_utc(reading["timestamp"])
+        if state.last_timestamp is not None and (timestamp - state.last_timestamp).total_seconds() > self.reset_after_seconds:
+            state.reset_filter()
+        state.last_timestamp = timestamp
+
+        weight = float(reading["weight"])
+        if self.filter_type == "ema":
+            state.ema = weight if state.ema is None else state.ema + self.ema_alpha * (weight - state.ema)
+            filtered = state.ema
+        else:
+            state.raw.append(weight)
+            filtered = float(median(state.raw))
+        state.recent.append(filtered)
+
+        stable = (
+            len(state.recent) == self.stable_samples
+            and max(state.recent) - min(state.recent) <= self.stable_tolerance
+        )
+        event = None
+        if stable and not state.was_stable:
+            event, state.stable_weight = self._plateau(reading, sum(state.recent) / len(state.recent), state.stable_weight)
+        state.was_stable = stable
+        return event
+
+    def process(self, readings: List[dict]) -> List[dict]:
+        """Feeds live MotionLogEntry documents through the per-cart state. Returns detected events."""
+        events = []
+        valid = [r for r in readings if isinstance(r.get("timestamp"), datetime) and r.get("weight") is not None]
+        for reading in sorted(valid, key=lambda r: _naive_utc(r["timestamp"])):
+            key = _stream_key(reading)
+            state = self._streams.get(key)
+            if state is None:
+                state = self._streams[key] = _StreamState(self.filter_window, self.stable_samples)
+            event = self._update(state, reading)
+            if event:
+                events.append(event)
+        return events
+
+    # --- Batch mode ---
+
+    def _filter(self, weights: np.ndarray) -> np.ndarray:
+        if self.filter_type == "ema":
+            alpha = self.ema_alpha
+            return np.fromiter(accumulate(weights, lambda prev, w: prev + alpha * (w - prev)), dtype=float, count=len(weights))
+        # Causal median over the last filter_window readings; the first ones use what is available
+        medians = np.empty(len(weights))
+        head = min(self.filter_window - 1, len(weights))
+        for i in range(head):
+            medians[i] = np.median(weights[:i + 1])
+        if len(weights) >= self.filter_window:
+            medians[head:] = np.median(sliding_window_view(weights, self.filter_window), axis=1)
+        return medians
+
+    def _segment_plateaus(self, filtered: np.ndarray):
+        """Yields (index, plateau weight) where each stable run starts."""
+        n, k = len(filtered), self.stable_samples
+        if n < k:
+            return
+        windows = sliding_window_view(filtered, k)
+        stable = np.zeros(n, dtype=bool)
+        stable[k - 1:] = windows.max(axis=1) - windows.min(axis=1) <= self.stable_tolerance
+        starts = np.flatnonzero(stable & ~np.r_[False, stable[:-1]])
+        means = windows.mean(axis=1)
+        for index in starts:
+            yield index, means[index - k + 1]
+
+    def detect_batch(self, readings: List[dict]) -> List[dict]:
+        """Re-processes a history of readings (any order, any carts) with fresh state."""
+        streams: Dict[Optional[str], List[dict]] = {}
+        for reading in readings:
+            if isinstance(reading.get("timestamp"), datetime) and reading.get("weight") is not None:
+                streams.setdefault(_stream_key(reading), []).append(reading)
+
+        events = []
+        for stream in streams.values():
+            stream.sort(key=lambda r: _naive_utc(r["timestamp"]))
+            weights = np.array([r["weight"] for r in stream], dtype=float)
+            seconds = np.array([(_naive_utc(r["timestamp"]) - datetime(1970, 1, 1)).total_seconds() for r in stream])
+            # Split where the filter would be reset
+            breaks = np.flatnonzero(np.diff(seconds) > self.reset_after_seconds) + 1
+            stable_weight = None
+            for start, end in zip(np.r_[0, breaks], np.r_[breaks, len(stream)]):
+                for index, plateau in self._segment_plateaus(self._filter(weights[start:end])):
+                    event, stable_weight = self._plateau(stream[start + index], float(plateau), stable_weight)
+                    if event:
+                        events.append(event)
+        events.sort(key=lambda e: _naive_utc(e["timestamp"]))
+        return events
+
+
+def detector_from_settings(**overrides) -> WeightEventDetector:
+    """Builds a detector from Settings; keyword overrides replace individual parameters."""
+    params = {
+        "filter_type": settings.MOTION_FILTER,
+        "filter_window": settings.MOTION_MEDIAN_WINDOW,
+        "ema_alpha": settings.MOTION_EMA_ALPHA,
+        "stable_samples": settings.MOTION_STABLE_SAMPLES,
+        "stable_tolerance": settings.MOTION_STABLE_TOLERANCE_GRAMS,
+        "min_step": settings.MOTION_MIN_STEP_GRAMS,
+        "reset_after_seconds": settings.MOTION_STREAM_RESET_SECONDS,
+    }
+    params.update({key: value for key, value in overrides.items() if value is not None})
+    return WeightEventDetector(**params)
+
+
+weight_event_detector = detector_from_settings()
@@ -24,7 +24,7 @@ async def get_sessions(
     Get session information. Admin only.
     """
     from ..database import get_sessions_collection
-    sessions_collection = get_sessions_collection()
+    sessions_collection = await get_sessions_collection()
     
     # Build filter query
     filter_query = {}
@@ -34,10 +34,10 @@ async def get_sessions(
         filter_query["is_active"] = True
     
     # Query sessions
-    sessions = list(sessions_collection.find(
+    sessions = await sessions_collection.find(
         filter_query,
         {'_id': 0}
-    ).sort("created_at", -1).limit(limit))
+    ).sort("created_at", -1).limit(limit).to_list()
     
     return [SessionInfo(**session) for session in sessions]
 
@@ -132,20 +132,20 @@ async def get_session_stats(
     Get session statistics. Admin only.
     """
     from ..database import get_sessions_collection
-    sessions_collection = get_sessions_collection()
+    sessions_collection = await get_sessions_collection()
     
     # Get stats
-    total_sessions = sessions_collection.count_documents({})
-    active_sessions = sessions_collection.count_documents({"is_active": True})
+    total_sessions = await sessions_collection.count_documents({})
+    active_sessions = await sessions_collection.count_documents({"is_active": True})
     
     # Sessions created in last 24 hours
     recent_cutoff = datetime.utcnow() - timedelta(hours=24)
-    recent_sessions = sessions_collection.count_documents({
+    recent_sessions = await sessions_collection.count_documents({
         "created_at": {"$gte": recent_cutoff}
     })
     
     # Active sessions by user (top 10)
-    active_by_user = list(sessions_collection.aggregate([
+    active_by_user = await (await sessions_collection.aggregate([
         {"$match": {"is_active": True}},
         {"$group": {
             "_id": "$user_identity",
@@ -153,7 +153,7 @@ async def get_session_stats(
         }},
         {"$sort": {"session_count": -1}},
         {"$limit": 10}
-    ]))
+    ])).to_list()
     
     return {
         "total_sessions": total_sessions,
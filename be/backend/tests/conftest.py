@@ -1,5 +1,5 @@
 import pytest
-from pymongo import MongoClient
+from pymongo import MongoClient, AsyncMongoClient
 from fastapi.testclient import TestClient
 from backend.app import app
 from backend import config
@@ -7,8 +7,23 @@ from backend.database import (
     get_products_collection,
     get_users_collection,
     get_orders_collection,
+    get_motion_logs_collection,
+    get_motion_events_collection,
+    get_uwb_locations_collection,
+    get_counters_collection,
+    get_catalog_changes_collection,
+    get_carts_collection,
+    get_motion_rollups_collection,
+    get_motion_rollup_watermarks_collection,
+    get_uwb_heatmap_collection,
 )
 from backend.models import Role
+from backend.services.product_cache import product_cache
+from backend.services.catalog_sync import catalog_sync
+from backend.services.log_sink import log_sink
+from backend.services.motion_rollups import motion_rollups
+from backend.services.heatmap import heatmap_accumulator, heatmap_cache
+from backend.services.order_commits import order_commit_batcher
 import hmac
 import hashlib
 
@@ -24,22 +39,60 @@ def test_db():
     client.drop_database("test_shopping_cart_db")
     client.close()
 
+@pytest.fixture(scope="session")
+def async_test_db():
+    """
+    Async handle on the test database for dependency overrides. The client connects
+    lazily, so it binds to the TestClient's event loop on first use.
+    """
+    client = AsyncMongoClient(TEST_MONGO_URI)
+    yield client.get_database("test_shopping_cart_db")
+
 @pytest.fixture(scope="function", autouse=True)
-def setup_test_db(test_db):
+def setup_test_db(test_db, async_test_db):
     """
     - Overrides database dependencies to use the test database.
     - Cleans all collections and seeds products before each test.
     """
-    def override_get_products(): return test_db["products"]
-    def override_get_users(): return test_db["users"]
-    def override_get_orders(): return test_db["order_history"]
+    async def override_get_products(): return async_test_db["products"]
+    async def override_get_users(): return async_test_db["users"]
+    async def override_get_orders(): return async_test_db["order_history"]
+    async def override_get_motion_logs(): return async_test_db["motion_logs"]
+    async def override_get_motion_events(): return async_test_db["motion_events"]
+    async def override_get_uwb_locations(): return async_test_db["uwb_locations"]
+    async def override_get_counters(): return async_test_db["counters"]
+    async def override_get_catalog_changes(): return async_test_db["catalog_changes"]
+    async def override_get_carts(): return async_test_db["carts"]
+    async def override_get_motion_rollups(): return async_test_db["motion_rollups"]
+    async def override_get_motion_rollup_watermarks(): return async_test_db["motion_rollup_watermarks"]
+    async def override_get_uwb_heatmap(): return async_test_db["uwb_heatmap"]
+    async def resolve_test_collection(name): return async_test_db[name]
 
     app.dependency_overrides[get_products_collection] = override_get_products
     app.dependency_overrides[get_users_collection] = override_get_users
     app.dependency_overrides[get_orders_collection] = override_get_orders
+    app.dependency_overrides[get_motion_logs_collection] = override_get_motion_logs
+    app.dependency_overrides[get_motion_events_collection] = override_get_motion_events
+    app.dependency_overrides[get_uwb_locations_collection] = override_get_uwb_locations
+    app.dependency_overrides[get_counters_collection] = override_get_counters
+    app.dependency_overrides[get_catalog_changes_collection] = override_get_catalog_changes
+    app.dependency_overrides[get_carts_collection] = override_get_carts
+    app.dependency_overrides[get_motion_rollups_collection] = override_get_motion_rollups
+    app.dependency_overrides[get_motion_rollup_watermarks_collection] = override_get_motion_rollup_watermarks
+    app.dependency_overrides[get_uwb_heatmap_collection] = override_get_uwb_heatmap
+    # Background writers resolve their collections themselves
+    log_sink.collection_resolver = resolve_test_collection
+    motion_rollups.collection_resolver = resolve_test_collection
+    order_commit_batcher.collection_resolver = resolve_test_collection
+    heatmap_accumulator.collection_resolver = resolve_test_collection
 
     for c in test_db.list_collection_names():
         test_db.drop_collection(c)
+    product_cache.clear()
+    catalog_sync.reset()
+    motion_rollups.clear()
+    heatmap_accumulator.clear()
+    heatmap_cache.clear()
 
     # Seed initial products for tests that need them
     initial_products = [
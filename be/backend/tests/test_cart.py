@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+
+CONSOLE = "8930000000028"
+HEADSET = "8930000000035"
+
+
+def _scan(client, headers, barcode, action, quantity):
+    response = client.post('/api/cart/op', headers=headers, json={"barcode": barcode, "action": action, "quantity": quantity})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_cart_add_and_remove_keep_total_items(client, shop_client_auth_headers, db):
+    """Test that adds merge into one line per product, removals drop empty lines and total_items follows."""
+    access_headers, _ = shop_client_auth_headers
+    db.products.update_one({"id": 2}, {"$set": {"barcode": CONSOLE}})
+
+    assert _scan(client, access_headers, CONSOLE, "add", 2)['cart_total_items'] == 2
+    assert _scan(client, access_headers, CONSOLE, "add", 1)['cart_total_items'] == 3
+    cart = db.carts.find_one({})
+    assert [(item['barcode'], item['quantity']) for item in cart['items']] == [(CONSOLE, 3)]
+
+    result = _scan(client, access_headers, CONSOLE, "remove", 4)
+    assert not result['success'] and result['cart_total_items'] == 3
+    assert _scan(client, access_headers, CONSOLE, "remove", 3)['cart_total_items'] == 0
+    cart = db.carts.find_one({})
+    assert cart['items'] == [] and cart['total_items'] == 0
+
+    result = _scan(client, access_headers, CONSOLE, "add", 6)
+    assert not result['success'] and "Insufficient stock" in result['message']
+
+
+def test_concurrent_cart_operations_lose_nothing(client, shop_client_auth_headers, db):
+    """Test that concurrent scans of the same items are neither lost nor duplicated."""
+    access_headers, _ = shop_client_auth_headers
+    db.carts.create_index("user_identity", unique=True)
+    db.products.update_one({"id": 2}, {"$set": {"barcode": CONSOLE}})
+    db.products.update_one({"id": 3}, {"$set": {"barcode": HEADSET}})
+
+    adds = [(CONSOLE, "add", 1)] * 40 + [(HEADSET, "add", 2)] * 20
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(lambda op: _scan(client, access_headers, *op), adds))
+    assert all(result['success'] for result in results)
+    # Every operation saw its own total: none applied twice or on a stale cart
+    assert sorted(result['cart_total_items'] for result in results)[-1] == 80
+    assert len({result['cart_total_items'] for result in results}) == len(results)
+
+    removes = [(CONSOLE, "remove", 1)] * 50
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(lambda op: _scan(client, access_headers, *op), removes))
+    assert sum(result['success'] for result in results) == 40
+
+    assert db.carts.count_documents({}) == 1
+    cart = db.carts.find_one({})
+    assert [(item['barcode'], item['quantity']) for item in cart['items']] == [(HEADSET, 40)]
+    assert cart['total_items'] == 40
@@ -0,0 +1,115 @@
+import os
+import time
+
+import numpy as np
+
+from backend.services.navigation import OccupancyGrid, Navigator
+from backend.services import pick_route
+from backend.services.map_tiles import MapTileStore
+
+
+def _store_with_wall():
+    """A 10x10 grid of 100-unit cells with a wall across column 5, open only at the bottom row."""
+    walkable = np.ones((10, 10), dtype=bool)
+    walkable[:9, 5] = False
+    return OccupancyGrid(walkable, cell_size=100)
+
+
+def test_route_follows_distance_field_around_wall(tmp_path):
+    """Test that product routes go around obstacles and match A* on the same grid."""
+    navigator = Navigator(cache_dir=str(tmp_path), refresh_interval_seconds=30)
+    navigator.set_grid(_store_with_wall())
+    assert navigator.set_targets({1: [(850, 50)]}) == 1
+
+    route = navigator.route_to_product(50, 50, 1)
+    assert route['method'] == "field"
+    assert route['target'] == {"x": 850.0, "y": 50.0}
+    # Every leg of the polyline stays on walkable cells, so the path dips to the open bottom row
+    assert max(point['y'] for point in route['path']) >= 900
+    assert route['distance'] == navigator.route_to_point(50, 50, 850, 50)['distance']
+
+    # Fields are reused from disk by a fresh navigator on the same grid
+    again = Navigator(cache_dir=str(tmp_path), refresh_interval_seconds=30)
+    again.set_grid(_store_with_wall())
+    assert again.set_targets({1: [(850, 50)]}) == 0
+    assert again.route_to_product(50, 50, 1)['distance'] == route['distance']
+
+
+def test_occupancy_grid_from_map_colours_and_obstacles():
+    """Test that floor-coloured pixels become walkable cells and obstacle polygons are carved out."""
+    from io import BytesIO
+    from PIL import Image
+
+    image = Image.new("RGB", (100, 50), (0, 0, 0))
+    image.paste((246, 245, 214), (0, 0, 50, 50))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+
+    grid = OccupancyGrid.from_map(
+        buffer.getvalue(), cell_size=100, width_units=1000, height_units=500,
+        floor_color=(246, 245, 214), color_tolerance=10,
+        obstacles=[[(0, 0), (200, 0), (200, 200), (0, 200)]],
+    )
+    assert grid.walkable.shape == (5, 10)
+    assert not grid.walkable[:, 5:].any()
+    assert grid.walkable[3, 3] and not grid.walkable[0, 0]
+
+
+def test_pick_route_orders_shopping_list_along_the_walk(tmp_path):
+    """Test that the pick route visits shelves in walking order, picks the handiest shelf and skips unknown products."""
+    navigator = Navigator(cache_dir=str(tmp_path), refresh_interval_seconds=30)
+    navigator.set_grid(OccupancyGrid(np.ones((10, 10), dtype=bool), cell_size=100))
+    navigator.set_targets({
+        1: [(750, 50)],
+        2: [(250, 50)],
+        3: [(950, 50), (50, 950)],  # Stocked at both ends of the store
+        4: [(550, 50)],
+    })
+
+    route = pick_route.plan(navigator, (50, 50), [1, 2, 3, 4, 5])
+    assert [stop['product_id'] for stop in route['order']] == [2, 4, 1, 3]
+    assert route['order'][-1]['stop'] == {"x": 950.0, "y": 50.0}
+    assert route['total_distance'] == 900.0
+    assert route['order'][-1]['distance_so_far'] == route['total_distance']
+    assert route['path'][0] == {"x": 50, "y": 50} and route['path'][-1] == {"x": 950.0, "y": 50.0}
+    assert route['unreachable'] == [5]
+
+    # Finishing near the far corner makes the other shelf of product 3 the better last stop
+    route = pick_route.plan(navigator, (50, 50), [1, 2, 3, 4], end_xy=(50, 950))
+    assert [stop['product_id'] for stop in route['order']][-1] == 3
+    assert route['order'][-1]['stop'] == {"x": 50.0, "y": 950.0}
+    assert route['end'] == {"x": 50.0, "y": 950.0}
+
+
+def _png(size, colour):
+    from io import BytesIO
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new("RGB", size, colour).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_map_tile_store_builds_pyramid_and_swaps_versions(tmp_path):
+    """Test that a map version gets a complete tile pyramid and new uploads replace versions no worker still uses."""
+    store = MapTileStore(cache_dir=str(tmp_path), refresh_interval_seconds=30, tile_size=256, formats=["webp", "png"], webp_quality=90)
+    first = store.install(_png((600, 300), (246, 245, 214)))
+    assert first['max_zoom'] == 2
+    assert [(level['columns'], level['rows']) for level in first['levels']] == [(1, 1), (2, 1), (3, 2)]
+    assert store.tile_path(first['version'], 2, 2, 1, "webp") is not None
+    assert store.tile_path(first['version'], 2, 3, 0, "png") is None
+    assert store.tile_path("../" + first['version'][3:], 0, 0, 0, "png") is None
+    with open(store.original_path(first), "rb") as f:
+        assert f.read() == _png((600, 300), (246, 245, 214))
+
+    second = store.install(_png((600, 300), (0, 0, 0)))
+    # The first version has not been touched by any worker for two refresh intervals
+    unused_since = time.time() - 120
+    os.utime(store.directory(first['version']), (unused_since, unused_since))
+    third = store.install(_png((200, 100), (0, 0, 0)))
+    assert store.current['version'] == third['version'] and third['max_zoom'] == 0
+    # Unused versions are pruned, with no staging leftovers
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([second['version'], third['version']])
+    # A version used recently (here: the second, by other workers) outlives being the previous one
+    fourth = store.install(_png((200, 100), (255, 255, 255)))
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([second['version'], third['version'], fourth['version']])
@@ -0,0 +1,312 @@
+import asyncio
+import json
+import numpy as np
+from datetime import datetime, timedelta
+from backend.database import to_timeseries_document
+from backend.services.uwb_positioning import solve_positions
+from backend.services import trajectory, heatmap
+from backend.services import motion_rollups as rollups
+from backend.services.log_sink import LogSink, log_sink
+from backend.services.weight_events import WeightEventDetector
+
+def test_uwb_batch_json_array(client, db):
+    """Test batch UWB ingest from a JSON array with one invalid record."""
+    records = [
+        {"x": 1500.0, "y": 400.0, "cart_id": "cart_1", "session_id": "s1", "raw_distances": [500, 4400, 2800, 3000]},
+        {"x": 1510.0, "y": 405.0, "cart_id": "cart_1", "session_id": "s1"},
+        {"x": "not-a-number", "y": 410.0, "cart_id": "cart_1"},
+    ]
+    response = client.post('/api/motion/uwb-log/batch', json=records)
+    assert response.status_code == 201
+    data = response.json()
+    assert data['received'] == 3
+    assert data['inserted'] == 2
+    assert data['rejected'] == 1
+    assert data['errors'][0]['index'] == 2
+    assert db.uwb_locations.count_documents({"meta.cart_id": "cart_1"}) == 2
+
+def test_motion_log_batch_ndjson(client, db):
+    """Test batch motion ingest from an NDJSON body."""
+    lines = [
+        {"state": 0, "weight": 120.5, "cart_id": "cart_2"},
+        {"state": 1, "weight": 180.0, "last_stable_weight": 120.5, "cart_id": "cart_2"},
+    ]
+    body = "\n".join(json.dumps(line) for line in lines)
+    response = client.post(
+        '/api/motion/log/batch',
+        content=body,
+        headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert response.status_code == 201
+    data = response.json()
+    assert data['inserted'] == 2
+    assert data['success'] is True
+    assert db.motion_logs.count_documents({"meta.cart_id": "cart_2"}) == 2
+
+def test_motion_event_batch_all_invalid(client):
+    """Test that a batch with no valid records is rejected."""
+    response = client.post('/api/motion/event/batch', json=[{"event_type": "add"}])
+    assert response.status_code == 422
+    assert response.json()['detail']['rejected'] == 1
+
+def test_motion_batch_malformed_body(client):
+    """Test that a malformed body is rejected."""
+    response = client.post(
+        '/api/motion/log/batch',
+        content='[{"state": 0',
+        headers={"Content-Type": "application/json"}
+    )
+    assert response.status_code == 400
+
+def test_uwb_solver_rejects_outlier_range():
+    """Test server-side trilateration with one corrupted anchor range."""
+    anchors = np.array([[1100, 320], [6200, 320], [6200, 3180], [1100, 3180]], dtype=float)
+    truth = np.array([[2500.0, 1200.0], [4800.0, 2600.0]])
+    distances = np.linalg.norm(truth[:, None, :] - anchors[None, :, :], axis=2)
+    distances[0, 2] += 2000
+    positions, mask = solve_positions(distances, anchors, 50, 10000, 150)
+    assert np.allclose(positions, truth, atol=1.0)
+    assert not mask[0, 2]
+    assert mask[1].all()
+
+def test_trajectory_rdp_keeps_stop_points():
+    """Test that RDP simplification collapses straight runs but keeps stops."""
+    moving = np.column_stack([np.arange(0, 1000, 10.0), np.zeros(100)])
+    stopped = np.tile([[1000.0, 0.0]], (30, 1))
+    xy = np.vstack([moving, stopped, moving + [1000.0, 0.0]])
+    t = np.arange(len(xy)) * 0.5
+    out_xy, out_t, indices, is_stop = trajectory.simplify(xy, t, "rdp", 50.0, 2.0, 20.0, 5.0)
+    assert len(out_xy) < 10
+    assert is_stop.sum() == 2
+    assert out_t[is_stop][1] - out_t[is_stop][0] >= 5.0
+
+def test_heatmap_histogram_follows_map_axes():
+    """Test that heatmap rows follow y and columns follow x in map units."""
+    grid = heatmap.histogram(np.array([250.0, 250.0, 1050.0, -10.0]), np.array([150.0, 160.0, 20.0, 50.0]), 100.0)
+    assert grid.shape == heatmap.grid_shape(100.0)
+    assert grid[1, 2] == 2
+    assert grid[0, 10] == 1
+    assert grid.sum() == 3
+
+def test_heatmap_endpoint_counts_flushed_uwb_locations(client, db, admin_auth_headers):
+    """Test that /api/map/heatmap sums the flushed hourly grids for the window."""
+    headers, _ = admin_auth_headers
+    now = datetime.utcnow()
+    records = [
+        {"x": 250.0, "y": 150.0, "cart_id": "cart_heat", "timestamp": (now - timedelta(minutes=m)).isoformat()}
+        for m in (70, 30, 0)
+    ]
+    assert client.post('/api/motion/uwb-log/batch', json=records).json()['inserted'] == len(records)
+    client.portal.call(heatmap.heatmap_accumulator.flush)
+    assert db.uwb_heatmap.count_documents({}) >= 1
+
+    response = client.get('/api/map/heatmap', params={"hours": 3}, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total"] == len(records)
+    row, col = int(150.0 // data["cell_size"]), int(250.0 // data["cell_size"])
+    assert data["cells"][row][col] == len(records)
+
+def test_weight_detector_batch_matches_incremental():
+    """Test that batch re-processing and live per-cart detection emit the same events."""
+    levels = [1000.0] * 15 + [1250.0] * 15 + [1248.0] * 10 + [1100.0] * 15
+    noise = [0.0, 1.5, -1.0, 0.5, 120.0, -0.5, 1.0, -1.5]  # includes a single spike
+    start = datetime(2025, 1, 1)
+    readings = [
+        {"weight": level + noise[i % len(noise)], "last_stable_weight": 1000.0,
+         "timestamp": start + timedelta(milliseconds=200 * i), "cart_id": "cart_9"}
+        for i, level in enumerate(levels)
+    ]
+    batch = WeightEventDetector().detect_batch(readings)
+    live_detector = WeightEventDetector()
+    live = [event for i in range(0, len(readings), 4) for event in live_detector.process(readings[i:i + 4])]
+    assert [e["event_type"] for e in batch] == ["add", "remove"]
+    assert all(e["processed_by"] == "server" for e in batch)
+    assert [(e["weight_difference"], e["timestamp"]) for e in batch] == [(e["weight_difference"], e["timestamp"]) for e in live]
+
+def _raw_distribution(collection, cart_field, key_field, value_field):
+    rows = collection.aggregate([
+        {"$match": {cart_field: "cart_stats"}},
+        {"$group": {"_id": f"${key_field}", "count": {"$sum": 1}, "value_sum": {"$sum": f"${value_field}"}}},
+    ])
+    return {row["_id"]: (row["count"], round(row["value_sum"] / row["count"], 6)) for row in rows}
+
+def _assert_stats_match_raw(client, db, headers):
+    response = client.get('/api/motion/stats', params={"hours": 2, "cart_id": "cart_stats"}, headers=headers)
+    assert response.status_code == 200
+    data = response.json()
+    states = {row["_id"]: (row["count"], round(row["avg_weight"], 6)) for row in data["state_distribution"]}
+    events = {row["_id"]: (row["count"], round(row["avg_weight_change"], 6)) for row in data["event_distribution"]}
+    assert states == _raw_distribution(db.motion_logs, "meta.cart_id", "state", "weight")
+    assert events == _raw_distribution(db.motion_events, "cart_id", "event_type", "weight_difference")
+    assert data["total_logs"] == db.motion_logs.count_documents({"meta.cart_id": "cart_stats"})
+    assert data["total_events"] == db.motion_events.count_documents({"cart_id": "cart_stats"})
+
+def test_motion_stats_match_raw_data_around_flushes(client, db, admin_auth_headers, monkeypatch):
+    """Test that /stats, /stats/timeseries and /stats/rebuild agree with the raw data whether or not rollups are flushed."""
+    headers, _ = admin_auth_headers
+    now = datetime.utcnow()
+    # 75 minutes of samples always cross an hour boundary
+    minutes_ago = [75, 62, 58, 31, 2, 0.5, 0]
+    logs = [
+        {"state": i % 3, "weight": 100.0 + 10 * i, "cart_id": "cart_stats",
+         "timestamp": (now - timedelta(minutes=m)).isoformat()}
+        for i, m in enumerate(minutes_ago)
+    ]
+    events = [
+        {"event_type": "add" if i % 2 else "remove", "weight_before": 0.0, "weight_after": 5.0 * i,
+         "weight_difference": 5.0 * i, "cart_id": "cart_stats", "timestamp": (now - timedelta(minutes=m)).isoformat()}
+        for i, m in enumerate(minutes_ago)
+    ]
+    assert client.post('/api/motion/log/batch', json=logs).json()['inserted'] == len(logs)
+    assert client.post('/api/motion/event/batch', json=events).json()['inserted'] == len(events)
+
+    # Nothing flushed yet: closed minutes come from raw data
+    _assert_stats_match_raw(client, db, headers)
+
+    client.portal.call(rollups.motion_rollups.flush)
+    assert db.motion_rollups.count_documents({"cart_id": "cart_stats", "granularity": "hour"}) > 0
+    assert db.motion_rollup_watermarks.count_documents({"worker": rollups.motion_rollups.worker_id}) == len(rollups.ROLLUP_SOURCES)
+    _assert_stats_match_raw(client, db, headers)
+
+    # Another worker flushed five minutes ago and still holds a sample from after that
+    monkeypatch.setattr(rollups, "WATERMARK_STALE_INTERVALS", 1000)
+    db.motion_rollup_watermarks.insert_one({
+        "_id": "events:other-worker", "source": "events", "worker": "other-worker",
+        "flushed_through": now - timedelta(minutes=5),
+    })
+    db.motion_events.insert_one({
+        "event_type": "add", "weight_before": 0.0, "weight_after": 40.0, "weight_difference": 40.0,
+        "cart_id": "cart_stats", "timestamp": now - timedelta(minutes=3),
+    })
+    _assert_stats_match_raw(client, db, headers)
+
+    response = client.get(
+        '/api/motion/stats/timeseries',
+        params={"source": "logs", "granularity": "minute", "hours": 2, "cart_id": "cart_stats"},
+        headers=headers
+    )
+    assert response.status_code == 200
+    assert sum(point["count"] for point in response.json()["points"]) == len(logs)
+
+    # Rebuilding from raw data restores lost rollups for the hours that closed before the watermark
+    closed = rollups.floor_bucket(now - timedelta(minutes=6), "hour")
+    db.motion_rollups.delete_many({"bucket": {"$lt": closed}})
+    response = client.post('/api/motion/stats/rebuild', params={"hours": 3}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["rollups_written"]["events"] > 0
+    _assert_stats_match_raw(client, db, headers)
+    response = client.get(
+        '/api/motion/stats/timeseries',
+        params={"source": "events", "granularity": "hour", "hours": 3, "cart_id": "cart_stats"},
+        headers=headers
+    )
+    points = [point for point in response.json()["points"] if datetime.fromisoformat(point["bucket"]) < closed]
+    assert sum(point["count"] for point in points) == db.motion_events.count_documents(
+        {"cart_id": "cart_stats", "timestamp": {"$lt": closed}}
+    )
+
+def test_motion_rebuild_leaves_hours_with_pending_increments(client, db, admin_auth_headers, monkeypatch):
+    """Test that a rebuild does not rewrite hours that queued documents or another worker's increments still reach."""
+    headers, _ = admin_auth_headers
+    monkeypatch.setattr(rollups, "WATERMARK_STALE_INTERVALS", 1000)
+    other = rollups.MotionRollupAccumulator(
+        flush_interval_seconds=60, collection_resolver=rollups.motion_rollups.collection_resolver
+    )
+    other.worker_id = "other-worker"
+    client.portal.call(other.flush)
+
+    # A closed hour with a sample no rollup counted, and the other worker's unflushed sample
+    old = {"state": 0, "weight": 50.0, "cart_id": "cart_rebuild", "timestamp": datetime.utcnow() - timedelta(minutes=90)}
+    pending = {"state": 1, "weight": 70.0, "cart_id": "cart_rebuild", "timestamp": datetime.utcnow()}
+    db.motion_logs.insert_many([to_timeseries_document(old), to_timeseries_document(pending)])
+    other.record("logs", [pending])
+    # This worker's sample still waits in the log sink
+    response = client.post('/api/motion/log', json={"state": 2, "weight": 90.0, "cart_id": "cart_rebuild"})
+    assert response.status_code == 201
+
+    response = client.post('/api/motion/stats/rebuild', params={"hours": 3}, headers=headers)
+    assert response.status_code == 200
+    client.portal.call(other.flush)
+    client.portal.call(rollups.motion_rollups.flush)
+
+    response = client.get(
+        '/api/motion/stats/timeseries',
+        params={"source": "logs", "granularity": "hour", "hours": 3, "cart_id": "cart_rebuild"},
+        headers=headers
+    )
+    assert sum(point["count"] for point in response.json()["points"]) == 3
+    assert db.motion_logs.count_documents({"meta.cart_id": "cart_rebuild"}) == 3
+
+class _RecordingCollection:
+    """Collection stand-in for the sink; insert_many waits for the gate when there is one."""
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.batches = []
+
+    async def insert_many(self, documents, ordered=True):
+        if self.gate is not None:
+            await self.gate.wait()
+        self.batches.append([document["n"] for document in documents])
+
+def _sink_writing_to(collection, **options):
+    async def resolve(name):
+        return collection
+    settings = dict(max_queue_size=100, batch_size=3, flush_interval_seconds=0.2,
+                    enqueue_timeout_seconds=0.01, drain_timeout_seconds=2.0)
+    settings.update(options)
+    return LogSink(collection_resolver=resolve, **settings)
+
+def test_log_sink_flushes_full_batches_and_on_interval():
+    """Test that a full batch is written at once and a partial one when the flush interval ends."""
+    async def scenario():
+        collection = _RecordingCollection()
+        sink = _sink_writing_to(collection)
+        for n in range(4):
+            assert await sink.emit("cart_logs", {"n": n})
+        await asyncio.sleep(0.05)
+        assert collection.batches == [[0, 1, 2]]
+        await asyncio.sleep(0.3)
+        assert collection.batches == [[0, 1, 2], [3]]
+        stats = sink.stats()["cart_logs"]
+        assert (stats["enqueued"], stats["written"], stats["batches"], stats["dropped"]) == (4, 4, 2, 0)
+        await sink.stop()
+
+    asyncio.run(scenario())
+
+def test_log_sink_drops_when_queue_stays_full_and_drains_on_stop():
+    """Test backpressure: emit() gives up after the enqueue timeout, and stop() writes everything queued."""
+    async def scenario():
+        collection = _RecordingCollection(gate=asyncio.Event())
+        sink = _sink_writing_to(collection, max_queue_size=2, batch_size=1)
+        assert await sink.emit("cart_logs", {"n": 0})
+        await asyncio.sleep(0.01)  # The worker takes it and waits on the gate
+        assert await sink.emit("cart_logs", {"n": 1})
+        assert await sink.emit("cart_logs", {"n": 2})
+        assert not await sink.emit("cart_logs", {"n": 3})
+        stats = sink.stats()["cart_logs"]
+        assert (stats["enqueued"], stats["dropped"], stats["written"], stats["queue_depth"]) == (3, 1, 0, 2)
+
+        collection.gate.set()
+        await sink.stop()
+        assert collection.batches == [[0], [1], [2]]
+        stats = sink.stats()["cart_logs"]
+        assert (stats["written"], stats["batches"], stats["dropped"], stats["queue_depth"]) == (3, 3, 1, 0)
+
+    asyncio.run(scenario())
+
+def test_log_sink_writes_through_the_collection_resolver(client, db):
+    """Test that the sink writes to the collection its resolver returns, here the test database."""
+    async def scenario():
+        sink = LogSink(
+            max_queue_size=100, batch_size=500, flush_interval_seconds=0.1, enqueue_timeout_seconds=0.01,
+            drain_timeout_seconds=2.0, collection_resolver=log_sink.collection_resolver
+        )
+        for n in range(5):
+            await sink.emit("cart_logs", {"n": n})
+        await sink.stop()
+        return sink.stats()["cart_logs"]
+
+    stats = client.portal.call(scenario)
+    assert stats["written"] == 5
+    assert db.cart_logs.count_documents({}) == 5
@@ -1,6 +1,20 @@
 from backend.models import OrderStatus
+from backend.orders import tasks
+from backend.services import stock_shards, vietqr
+from backend.services.order_commits import OrderCommitBatcher, order_commit_batcher
+from backend.services.product_cache import product_cache
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pymongo import MongoClient
+import asyncio
+import os
+import pytest
 import time
 
+# Transactions need a replica set; start a single-node one with
+#   mongod --replSet rs0 --dbpath <dir> && mongosh --eval "rs.initiate()"
+TEST_REPLICA_SET_URI = os.environ.get("TEST_MONGO_REPLICA_SET_URI", "mongodb://localhost:27017/?directConnection=true")
+
 def test_checkout_requires_auth(client):
     """Test that checkout requires authentication."""
     response = client.post('/api/orders/checkout', json={
@@ -44,7 +58,7 @@ def test_initiate_checkout_success(client, shop_client_auth_headers, db):
     assert response.status_code == 200
     data = response.json()
     assert "order_id" in data
-    assert "qr_svg" in data
+    assert "qr_svg" in data and "<svg" in data['qr_svg']
     assert "message" in data
     
     # Verify order is in pending state in DB
@@ -233,4 +247,298 @@ def test_receive_payment_webhook_validation_error(client):
     assert response.status_code == 422
     data = response.json()
     assert "detail" in data
-    assert any(err['loc'] == ['body', 'amount'] for err in data['detail'])
\ No newline at end of file
+    assert any(err['loc'] == ['body', 'amount'] for err in data['detail'])
+
+def test_concurrent_orders_commit_inventory_atomically(monkeypatch):
+    """Test that concurrent orders never oversell and short orders change no stock (single-node replica set)."""
+    client = MongoClient(TEST_REPLICA_SET_URI, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except Exception:
+        pytest.skip("MongoDB is not reachable")
+    if not tasks.supports_transactions(client):
+        client.close()
+        pytest.skip("Needs a replica set: set TEST_MONGO_REPLICA_SET_URI")
+    monkeypatch.setattr(tasks, "notify_catalog_changed", lambda: None)
+
+    db = client["test_inventory_transactions_db"]
+    client.drop_database(db.name)
+    db.products.insert_many([
+        {"id": 1, "name": "Fifa 19", "price": 1500000, "quantity": 10},
+        {"id": 2, "name": "Platinum Headset", "price": 2500000, "quantity": 100},
+    ])
+    orders = []
+    for n in range(40):
+        # Every third order wants two copies of the game, split over two cart lines
+        items = [{"id": 1, "name": "Fifa 19", "subtitle": "PS4", "price": 1500000, "quantity": 1, "unit": "pack"}] * (2 if n % 3 == 0 else 1)
+        items.append({"id": 2, "name": "Platinum Headset", "subtitle": "PS4", "price": 2500000, "quantity": 1, "unit": "each"})
+        subtotal = sum(item["price"] * item["quantity"] for item in items)
+        orders.append({
+            "order_id": f"order-{n}", "user_identity": "client@example.com", "items": items, "created_at": datetime.utcnow(),
+            "shipping_cost": 0, "subtotal": subtotal, "total_cost": subtotal, "status": OrderStatus.PAID.value,
+        })
+    db.order_history.insert_many([dict(order) for order in orders])
+
+    def commit(order):
+        return tasks.commit_inventory(db, tasks.OrderHistoryItem.model_validate(order))
+
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(commit, orders))
+
+        completed = [order for order, short in zip(orders, results) if short is None]
+        games_sold = sum(item["quantity"] for order in completed for item in order["items"] if item["id"] == 1)
+        stock = {product["id"]: product["quantity"] for product in db.products.find()}
+        assert 0 <= stock[1] == 10 - games_sold
+        assert stock[2] == 100 - len(completed)
+        # Stock only falls, so whatever is left cannot fill any failed order
+        for order, short in zip(orders, results):
+            if short is not None:
+                assert short == "Fifa 19"
+                assert sum(item["quantity"] for item in order["items"] if item["id"] == 1) > stock[1]
+
+        statuses = {doc["order_id"]: doc["status"] for doc in db.order_history.find()}
+        for order, short in zip(orders, results):
+            assert statuses[order["order_id"]] == (OrderStatus.COMPLETED.value if short is None else OrderStatus.FAILED.value)
+        # Every reserved catalog version is journaled exactly once
+        versions = sorted(entry["version"] for entry in db.catalog_changes.find())
+        assert versions == list(range(1, db.counters.find_one({"_id": "catalog_version"})["seq"] + 1))
+        # A second delivery of a processed order is refused
+        with pytest.raises(tasks.OrderNotPaid):
+            commit(orders[0])
+        assert db.products.find_one({"id": 2})["quantity"] == stock[2]
+    finally:
+        client.drop_database(db.name)
+        client.close()
+
+
+@pytest.mark.parametrize("transactional", [True, False])
+def test_batched_orders_share_stock_and_fail_alone(monkeypatch, transactional):
+    """Test that a coalesced batch writes each product once and fails only the orders it can't fill."""
+    client = MongoClient(TEST_REPLICA_SET_URI, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except Exception:
+        pytest.skip("MongoDB is not reachable")
+    if transactional and not tasks.supports_transactions(client):
+        client.close()
+        pytest.skip("Needs a replica set: set TEST_MONGO_REPLICA_SET_URI")
+    monkeypatch.setattr(tasks, "notify_catalog_changed", lambda: None)
+    monkeypatch.setattr(tasks.config.settings, "ORDER_INVENTORY_TRANSACTIONS", transactional)
+
+    db = client["test_inventory_batches_db"]
+    client.drop_database(db.name)
+    db.products.insert_many([
+        {"id": 1, "name": "Fifa 19", "price": 1500000, "quantity": 5},
+        {"id": 2, "name": "Platinum Headset", "price": 2500000, "quantity": 100},
+    ])
+    game = {"id": 1, "name": "Fifa 19", "subtitle": "PS4", "price": 1500000, "unit": "pack"}
+    headset = {"id": 2, "name": "Platinum Headset", "subtitle": "PS4", "price": 2500000, "unit": "each"}
+    # Games wanted per order: the third order can't get 3 once the first two took 4 of 5, the fourth still gets 1
+    wanted = [2, 2, 3, 1, 0]
+    orders = []
+    for n, games in enumerate(wanted):
+        items = ([dict(game, quantity=games)] if games else []) + [dict(headset, quantity=1)]
+        subtotal = sum(item["price"] * item["quantity"] for item in items)
+        orders.append({
+            "order_id": f"order-{n}", "user_identity": "client@example.com", "items": items, "created_at": datetime.utcnow(),
+            "shipping_cost": 0, "subtotal": subtotal, "total_cost": subtotal, "status": OrderStatus.PAID.value,
+        })
+    db.order_history.insert_many([dict(order) for order in orders])
+    db.order_history.update_one({"order_id": "order-4"}, {"$set": {"status": OrderStatus.COMPLETED.value}})
+
+    try:
+        completed, failed = tasks.commit_inventory_batch(db, [tasks.OrderHistoryItem.model_validate(order) for order in orders])
+        assert [order.order_id for order in completed] == ["order-0", "order-1", "order-3"]
+        assert failed == {"order-2": "Fifa 19"}
+        stock = {product["id"]: product["quantity"] for product in db.products.find()}
+        assert stock == {1: 0, 2: 97}
+        statuses = {doc["order_id"]: doc["status"] for doc in db.order_history.find()}
+        assert statuses == {
+            "order-0": OrderStatus.COMPLETED.value, "order-1": OrderStatus.COMPLETED.value, "order-2": OrderStatus.FAILED.value,
+            "order-3": OrderStatus.COMPLETED.value, "order-4": OrderStatus.COMPLETED.value,
+        }
+        # One catalog version per product for the whole batch, each journaled once
+        changes = sorted((entry["version"], entry["product_id"]) for entry in db.catalog_changes.find())
+        assert changes == [(1, 1), (2, 2)]
+    finally:
+        client.drop_database(db.name)
+        client.close()
+
+def test_duplicate_batches_without_transactions_take_stock_once(monkeypatch):
+    """Test that two batch commits of the same order on the fallback path decrement stock only once."""
+    client = MongoClient(TEST_REPLICA_SET_URI, serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except Exception:
+        pytest.skip("MongoDB is not reachable")
+    monkeypatch.setattr(tasks, "notify_catalog_changed", lambda: None)
+    monkeypatch.setattr(tasks.config.settings, "ORDER_INVENTORY_TRANSACTIONS", False)
+
+    db = client["test_inventory_duplicates_db"]
+    client.drop_database(db.name)
+    db.products.insert_many([
+        {"id": 1, "name": "Fifa 19", "price": 1500000, "quantity": 10},
+        {"id": 2, "name": "Platinum Headset", "price": 2500000, "quantity": 100},
+    ])
+    items = [
+        {"id": 1, "name": "Fifa 19", "subtitle": "PS4", "price": 1500000, "quantity": 2, "unit": "pack"},
+        {"id": 2, "name": "Platinum Headset", "subtitle": "PS4", "price": 2500000, "quantity": 1, "unit": "each"},
+    ]
+    subtotal = sum(item["price"] * item["quantity"] for item in items)
+    order = {
+        "order_id": "order-0", "user_identity": "client@example.com", "items": items, "created_at": datetime.utcnow(),
+        "shipping_cost": 0, "subtotal": subtotal, "total_cost": subtotal, "status": OrderStatus.PAID.value,
+    }
+    db.order_history.insert_one(dict(order))
+
+    def commit(_):
+        return tasks.commit_inventory_batch(db, [tasks.OrderHistoryItem.model_validate(order)])
+
+    try:
+        # The sweep re-dispatched an order whose first batch was still queued
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            results = list(pool.map(commit, range(2)))
+        assert sorted(len(completed) for completed, failed in results) == [0, 1]
+        assert all(not failed for completed, failed in results)
+        stock = {product["id"]: product["quantity"] for product in db.products.find()}
+        assert stock == {1: 8, 2: 99}
+        assert db.order_history.find_one({"order_id": "order-0"})["status"] == OrderStatus.COMPLETED.value
+        # A later delivery finds nothing to claim
+        assert commit(None) == ([], {})
+        assert db.products.find_one({"id": 1})["quantity"] == 8
+    finally:
+        client.drop_database(db.name)
+        client.close()
+
+def _recording_batch_task(monkeypatch, failures=0):
+    """Replaces process_order_batch; its first `failures` enqueues raise like an unreachable broker."""
+    sent = []
+    remaining_failures = [failures]
+    class RecordingBatchTask:
+        def delay(self, order_ids):
+            if remaining_failures[0]:
+                remaining_failures[0] -= 1
+                raise ConnectionError("broker unreachable")
+            sent.append(list(order_ids))
+    monkeypatch.setattr("backend.services.order_commits.process_order_batch", RecordingBatchTask())
+    return sent
+
+def test_order_commit_batcher_sends_full_batches_early(monkeypatch):
+    """Test that a full batch goes out at once and the rest waits for the window."""
+    sent = _recording_batch_task(monkeypatch)
+
+    async def scenario():
+        batcher = OrderCommitBatcher(window_seconds=0.3, max_orders=3, sweep_after_seconds=0)
+        batcher.start()
+        for n in range(4):
+            batcher.add(f"order-{n}")
+        await asyncio.sleep(0.1)
+        assert sent == [["order-0", "order-1", "order-2"]]
+        await asyncio.sleep(0.4)
+        assert sent == [["order-0", "order-1", "order-2"], ["order-3"]]
+        await batcher.stop()
+
+    asyncio.run(scenario())
+
+def test_order_commit_batcher_requeues_failed_batch_and_drains_on_stop(monkeypatch):
+    """Test that a batch the broker refused is sent again ahead of newer orders, and stop() sends everything left."""
+    sent = _recording_batch_task(monkeypatch, failures=1)
+
+    async def scenario():
+        batcher = OrderCommitBatcher(window_seconds=60, max_orders=2, sweep_after_seconds=0)
+        batcher.start()
+        batcher.add("order-0")
+        batcher.add("order-1")
+        await asyncio.sleep(0.1)
+        assert sent == []
+        batcher.add("order-2")
+        await batcher.stop()
+
+    asyncio.run(scenario())
+    assert sent == [["order-0", "order-1"], ["order-2"]]
+
+def test_order_commit_batcher_sweeps_stale_paid_orders(client, db, monkeypatch):
+    """Test that paid orders left behind longer than the sweep age are queued once, and nothing else is."""
+    sent = _recording_batch_task(monkeypatch)
+    now = datetime.utcnow()
+    db.order_history.insert_many([
+        {"order_id": "lost", "status": OrderStatus.PAID.value, "paid_at": now - timedelta(minutes=10)},
+        {"order_id": "in-flight", "status": OrderStatus.PAID.value, "paid_at": now},
+        {"order_id": "done", "status": OrderStatus.COMPLETED.value, "paid_at": now - timedelta(minutes=10)},
+    ])
+    batcher = OrderCommitBatcher(
+        window_seconds=60, max_orders=10, sweep_after_seconds=300,
+        collection_resolver=order_commit_batcher.collection_resolver
+    )
+    assert client.portal.call(batcher.sweep) == 1
+    assert client.portal.call(batcher.sweep) == 0
+    client.portal.call(batcher.stop)
+    assert sent == [["lost"]]
+
+def test_sharded_stock_is_transparent_to_reads_and_orders(client, db, admin_auth_headers, monkeypatch):
+    """Test that a product with sharded stock reads, sells, updates and unshards like a plain one."""
+    monkeypatch.setattr(tasks, "notify_catalog_changed", lambda: product_cache.clear())
+    db.stock_shards.create_index([("product_id", 1), ("shard", 1)], unique=True)
+    assert stock_shards.shard_product_sync(db, 1, 4) == 10
+    assert stock_shards.shard_product_sync(db, 1, 4) is None
+    assert db.products.find_one({"id": 1})["quantity"] == 0
+    assert sorted(shard["quantity"] for shard in db.stock_shards.find({"product_id": 1})) == [2, 2, 3, 3]
+    assert client.get('/api/products/1').json()['quantity'] == 10
+
+    def order(order_id, quantity):
+        item = {"id": 1, "name": "Fifa 19", "subtitle": "PS4", "price": 1500000, "quantity": quantity, "unit": "pack"}
+        doc = {
+            "order_id": order_id, "user_identity": "client@example.com", "items": [item], "created_at": datetime.utcnow(),
+            "shipping_cost": 0, "subtotal": 1500000 * quantity, "total_cost": 1500000 * quantity, "status": OrderStatus.PAID.value,
+        }
+        db.order_history.insert_one(dict(doc))
+        return tasks.commit_inventory(db, tasks.OrderHistoryItem.model_validate(doc))
+
+    assert order("sharded-1", 3) is None
+    assert client.get('/api/products/1').json()['quantity'] == 7
+    # More than any one shard holds: gathered from several
+    assert order("sharded-2", 7) is None
+    assert order("sharded-3", 1) == "Fifa 19"
+    assert client.get('/api/products/1').json()['quantity'] == 0
+    assert all(shard["quantity"] == 0 for shard in db.stock_shards.find({"product_id": 1}))
+
+    admin_access_headers, _ = admin_auth_headers
+    response = client.put('/api/products/1', headers=admin_access_headers, json={"quantity": 12})
+    assert response.status_code == 200 and response.json()['quantity'] == 12
+    assert sum(shard["quantity"] for shard in db.stock_shards.find({"product_id": 1})) == 12
+
+    assert stock_shards.unshard_product_sync(db, 1) == 12
+    product = db.products.find_one({"id": 1})
+    assert product["quantity"] == 12 and "stock_shards" not in product
+    assert db.stock_shards.count_documents({}) == 0
+    product_cache.clear()
+    assert client.get('/api/products/1').json()['quantity'] == 12
+
+def test_vietqr_payload_is_valid_emvco():
+    """Test that the local VietQR payload has the EMVCo fields of a bank transfer and a valid CRC."""
+    assert vietqr.crc16_ccitt(b"123456789") == 0x29B1
+
+    payload = vietqr.build_payload("970436", "1234567890", amount=69000, add_info="Thanh toán đơn hàng 42")
+
+    def fields(data):
+        parsed, position = {}, 0
+        while position < len(data):
+            tag, length = data[position:position + 2], int(data[position + 2:position + 4])
+            parsed[tag] = data[position + 4:position + 4 + length]
+            position += 4 + length
+        return parsed
+
+    top = fields(payload)
+    assert top["00"] == "01" and top["01"] == "12"
+    assert top["53"] == "704" and top["54"] == "69000" and top["58"] == "VN"
+    merchant = fields(top["38"])
+    assert merchant["00"] == "A000000727" and merchant["02"] == "QRIBFTTA"
+    assert fields(merchant["01"]) == {"00": "970436", "01": "1234567890"}
+    assert fields(top["62"]) == {"08": "Thanh toan don hang 42"}
+    assert payload.endswith(f"6304{vietqr.crc16_ccitt(payload[:-4].encode()):04X}")
+
+    # Without an amount the QR is static
+    assert fields(vietqr.build_payload("970436", "1234567890"))["01"] == "11"
+    with pytest.raises(ValueError):
+        vietqr.build_payload("97043", "1234567890", amount=1000)
@@ -1,4 +1,7 @@
+from datetime import datetime, timedelta
 from backend.models import Role
+from backend.services.catalog_sync import OP_UPSERT, record_changes_sync, reserve_versions_sync
+from backend.services.product_search import ProductSearchIndex
 
 def test_get_products(client):
     """Test retrieving all products."""
@@ -116,4 +119,133 @@ def test_delete_product_not_found(client, admin_auth_headers):
     response = client.delete('/api/products/999', headers=admin_access_headers)
     assert response.status_code == 404
     data = response.json()
-    assert "Product not found" in data['detail']
\ No newline at end of file
+    assert "Product not found" in data['detail']
+
+def test_barcode_lookup_cached_and_invalidated(client, db, admin_auth_headers):
+    """Test that barcode lookups are cached and refreshed after a product update."""
+    db.products.update_one({"id": 1}, {"$set": {"barcode": "8930000000011"}})
+    response = client.get('/api/products/barcode/8930000000011')
+    assert response.status_code == 200
+    assert response.json()['price'] == 1500000
+
+    # The second lookup is served from the cache
+    assert client.get('/api/products/barcode/8930000000011').json()['price'] == 1500000
+
+    admin_access_headers, _ = admin_auth_headers
+    client.put('/api/products/1', headers=admin_access_headers, json={"price": 1400000})
+    assert client.get('/api/products/barcode/8930000000011').json()['price'] == 1400000
+
+    stats = client.get('/api/products/cache/stats', headers=admin_access_headers).json()
+    assert stats['hits'] >= 1 and stats['misses'] >= 2
+
+def test_product_list_cache_invalidated_on_update(client, admin_auth_headers):
+    """Test that the cached catalog reflects an admin update immediately."""
+    assert next(p for p in client.get('/api/products').json() if p['id'] == 2)['price'] == 8000000
+    admin_access_headers, _ = admin_auth_headers
+    client.put('/api/products/2', headers=admin_access_headers, json={"price": 7500000})
+    assert next(p for p in client.get('/api/products').json() if p['id'] == 2)['price'] == 7500000
+
+def test_catalog_sync_returns_changes_and_snapshot_etag(client, admin_auth_headers):
+    """Test delta sync after product changes and 304 on an unchanged snapshot."""
+    admin_access_headers, _ = admin_auth_headers
+    full = client.get('/api/products/sync').json()
+    assert full['full'] is True and len(full['products']) == 3
+
+    client.put('/api/products/1', headers=admin_access_headers, json={"price": 1400000})
+    version = client.get('/api/products/sync', params={"since": full['version']}).json()['version']
+    client.put('/api/products/2', headers=admin_access_headers, json={"price": 7500000})
+    client.delete('/api/products/3', headers=admin_access_headers)
+
+    delta = client.get('/api/products/sync', params={"since": version}).json()
+    assert delta['full'] is False
+    assert [p['id'] for p in delta['products']] == [2]
+    assert delta['products'][0]['price'] == 7500000
+    assert delta['deleted'] == [3]
+    assert delta['version'] == version + 2
+
+    snapshot = client.get('/api/products/snapshot')
+    assert snapshot.status_code == 200
+    assert snapshot.headers['x-catalog-version'] == str(delta['version'])
+    assert len(snapshot.json()['products']) == 2
+    not_modified = client.get('/api/products/snapshot', headers={"If-None-Match": snapshot.headers['etag']})
+    assert not_modified.status_code == 304
+
+def test_catalog_sync_journals_late_writes_before_skipping_a_gap(client, db, admin_auth_headers):
+    """Test that a product write whose journal entry is late still reaches carts once the gap is skipped."""
+    admin_access_headers, _ = admin_auth_headers
+    client.put('/api/products/3', headers=admin_access_headers, json={"price": 2400000})
+    since = client.get('/api/products/sync').json()['version']
+
+    # A slow writer stamped product 1 but has not journaled its version yet
+    version = reserve_versions_sync(db.counters)
+    db.products.update_one({"id": 1}, {"$set": {"price": 1300000, "catalog_version": version}})
+    client.put('/api/products/2', headers=admin_access_headers, json={"price": 7500000})
+    db.catalog_changes.update_one(
+        {"version": version + 1}, {"$set": {"timestamp": datetime.utcnow() - timedelta(minutes=1)}}
+    )
+
+    delta = client.get('/api/products/sync', params={"since": since}).json()
+    assert delta['version'] == version + 1
+    assert [p['id'] for p in delta['products']] == [1, 2]
+    assert db.catalog_changes.count_documents({"version": version, "product_id": 1}) == 1
+    # The writer's own entry arrives late and is accepted as a duplicate
+    record_changes_sync(db.catalog_changes, [(version, 1, OP_UPSERT)])
+    assert db.catalog_changes.count_documents({"version": version}) == 1
+
+def test_product_search_index_ranks_and_folds_diacritics():
+    """Test accent-insensitive, prefix and typo-tolerant ranking of the search index."""
+    index = ProductSearchIndex(min_similarity=0.5, refresh_interval_seconds=5)
+    index.load([
+        {"id": 1, "name": "Sữa tươi Vinamilk"},
+        {"id": 2, "name": "Sữa tươi"},
+        {"id": 3, "name": "Trà sữa trân châu"},
+        {"id": 4, "name": "Nước mắm Nam Ngư"},
+    ])
+    assert index.search("sua tuoi")[:2] == ["Sữa tươi", "Sữa tươi Vinamilk"]
+    assert index.search("sữa")[:2] == ["Sữa tươi", "Sữa tươi Vinamilk"]
+    assert index.search("nuoc mam")[0] == "Nước mắm Nam Ngư"
+    assert index.search("vinamlik") == ["Sữa tươi Vinamilk"]
+
+    index.upsert({"id": 2, "name": "Bơ lạt"})
+    index.remove(3)
+    assert index.search("sua") == ["Sữa tươi Vinamilk"]
+    assert index.search("bo") == ["Bơ lạt"]
+
+def test_product_name_key_and_location_lookup(client, db, admin_auth_headers):
+    """Test that name keys are stored on write and location lookups ignore case and regex characters."""
+    admin_access_headers, _ = admin_auth_headers
+    response = client.post('/api/products', headers=admin_access_headers, json={
+        "name": "Bánh Quy (Hộp 200g)+", "subtitle": "Snack", "price": 35000, "unit": "box"
+    })
+    product_id = response.json()['id']
+    assert db.products.find_one({"id": product_id})['name_key'] == "bánh quy (hộp 200g)+"
+    client.put(f'/api/products/{product_id}', headers=admin_access_headers, json={"name": "Bánh Quy Bơ"})
+    assert db.products.find_one({"id": product_id})['name_key'] == "bánh quy bơ"
+
+    index = ProductSearchIndex(min_similarity=0.5, refresh_interval_seconds=5)
+    index.load([
+        {"id": 7, "name": "Cà Phê (Rang Xay)+", "price": 90000, "location": [{"x": 1, "y": 2}]},
+        {"id": 8, "name": "Trà Xanh", "price": 20000},
+    ])
+    assert index.locate("cà phê  (rang xay)+")['location'] == [{"x": 1, "y": 2}]
+    assert index.locate("Cà Phê .*") is None
+    assert "location" not in index.locate("TRÀ XANH")
+    index.remove(7)
+    assert index.locate("Cà Phê (Rang Xay)+") is None
+
+def test_nearby_products_follow_moved_shelves():
+    """Test that nearby queries return the closest shelf first and follow product moves."""
+    index = ProductSearchIndex(min_similarity=0.5, refresh_interval_seconds=5, grid_cell_size=500)
+    index.load([
+        {"id": 1, "name": "Apple", "location": [{"x": 100, "y": 100}, {"x": 3000, "y": 3000}]},
+        {"id": 2, "name": "Banana", "location": [{"x": 180, "y": 100}]},
+        {"id": 3, "name": "Cherry", "location": [{"x": 900, "y": 900}]},
+    ])
+    nearby = index.nearby(120, 100, radius=200)
+    assert [p['id'] for p in nearby] == [1, 2]
+    assert nearby[0]['distance'] == 20.0 and nearby[0]['nearest'] == {"x": 100.0, "y": 100.0}
+
+    index.upsert({"id": 2, "name": "Banana", "location": [{"x": 2990, "y": 3000}]})
+    index.remove(1)
+    assert index.nearby(120, 100, radius=200) == []
+    assert [p['id'] for p in index.nearby(3000, 3000, radius=50)] == [2]
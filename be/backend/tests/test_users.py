@@ -120,4 +120,17 @@ def test_guest_login_success(client):
     decoded_token = jwt.decode(data['access_token'], config.JWT_SECRET_KEY, algorithms=["HS256"])
     assert decoded_token['sub'].startswith("guest_")
     assert decoded_token['sub'].endswith("@temp.com")
-    assert decoded_token['role'] == "guest"
\ No newline at end of file
+    assert decoded_token['role'] == "guest"
+
+def test_logout_invalidates_cached_session(client, shop_client_auth_headers):
+    """Test that a logged-out session is rejected even though it was cached."""
+    access_headers, _ = shop_client_auth_headers
+    # Validate once so the session is served from the cache afterwards
+    response = client.get('/api/sessions/current', headers=access_headers)
+    assert response.status_code == 200
+
+    response = client.post('/api/auth/logout', headers=access_headers)
+    assert response.status_code == 200
+
+    response = client.get('/api/sessions/current', headers=access_headers)
+    assert response.status_code == 401
@@ -1,7 +1,8 @@
 # backend/users/routes.py
 from fastapi import APIRouter, HTTPException, status, Depends, Request
 from fastapi.security import OAuth2PasswordRequestForm
-from pymongo import collection
+from pymongo.asynchronous.collection import AsyncCollection
+from starlette.concurrency import run_in_threadpool
 import uuid
 
 from .. import pwd_context, config
@@ -15,12 +16,12 @@ router = APIRouter(
 )
 
 @router.post('/register', status_code=status.HTTP_201_CREATED)
-def register_user(
+async def register_user(
     user_data: UserCreate,
-    users_collection: collection.Collection = Depends(get_users_collection),
+    users_collection: AsyncCollection = Depends(get_users_collection),
 ):
     """Registers a new user."""
-    if users_collection.find_one({"email": user_data.email}):
+    if await users_collection.find_one({"email": user_data.email}):
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail="User with this email already exists"
@@ -29,13 +30,13 @@ def register_user(
     # Assign role based on email
     user_role = Role.ADMIN if user_data.email == config.ADMIN_EMAIL else Role.SHOP_CLIENT
 
-    hashed_password = pwd_context.hash(user_data.password)
+    hashed_password = await run_in_threadpool(pwd_context.hash, user_data.password)
     new_user = User(
         email=user_data.email, 
         hashed_password=hashed_password, 
         role=user_role)
     
-    users_collection.insert_one(new_user.model_dump())
+    await users_collection.insert_one(new_user.model_dump())
     
     return {"message": f"User {user_data.email} created successfully"}
 
@@ -43,12 +44,12 @@ def register_user(
 async def login_user(
     form_data: OAuth2PasswordRequestForm = Depends(),
     request: Request = None,
-    users_collection: collection.Collection = Depends(get_users_collection),
+    users_collection: AsyncCollection = Depends(get_users_collection),
 ):
     """Logs in a user and returns JWT access and refresh tokens."""
-    user_doc = users_collection.find_one({"email": form_data.username})
+    user_doc = await users_collection.find_one({"email": form_data.username})
     
-    if user_doc and pwd_context.verify(form_data.password, user_doc["hashed_password"]):
+    if user_doc and await run_in_threadpool(pwd_context.verify, form_data.password, user_doc["hashed_password"]):
         user_role = user_doc.get("role", Role.SHOP_CLIENT.value) # Default to SHOP_CLIENT if role not found
         
         # Extract client information
@@ -121,7 +122,7 @@ async def card_login(
 @router.post('/refresh')
 async def refresh_access_token(
     current_user: auth.TokenData = Depends(auth.get_current_user),
-    users_collection: collection.Collection = Depends(get_users_collection),
+    users_collection: AsyncCollection = Depends(get_users_collection),
 ):
     """
     Endpoint to refresh an expired access token using a valid refresh token.
@@ -129,7 +130,7 @@ async def refresh_access_token(
     For simplicity, we're allowing any valid token to generate a new access token.
     """
     # The role might not be in the refresh token, so we fetch it from the DB
-    user_doc = users_collection.find_one({"email": current_user.identity})
+    user_doc = await users_collection.find_one({"email": current_user.identity})
     user_role = Role.SHOP_CLIENT # Default for card IDs or if not found
     if user_doc:
         user_role = user_doc.get("role", Role.SHOP_CLIENT)
@@ -151,7 +152,7 @@ async def refresh_access_token(
 @router.post('/guest_login')
 async def guest_login(
     request: Request = None,
-    users_collection: collection.Collection = Depends(get_users_collection),
+    users_collection: AsyncCollection = Depends(get_users_collection),
 ):
     """
     Creates a temporary guest user and logs them in, returning JWT tokens.
@@ -160,14 +161,14 @@ async def guest_login(
     guest_id = str(uuid.uuid4())
     guest_email = f"guest_{guest_id}@temp.com"
     # Guests don't need a memorable password, but we hash one for consistency with User model
-    hashed_password = pwd_context.hash(str(uuid.uuid4())) 
+    hashed_password = await run_in_threadpool(pwd_context.hash, str(uuid.uuid4()))
 
     new_guest_user = User(
         email=guest_email,
         hashed_password=hashed_password,
         role=Role.SHOP_CLIENT
     )
-    users_collection.insert_one(new_guest_user.model_dump())
+    await users_collection.insert_one(new_guest_user.model_dump())
 
     # Extract client information
     user_agent = request.headers.get("user-agent") if request else None